@@ -1,41 +1,41 @@
+import argparse
+import asyncio
 import json
+import os
+import time
 from langgraph_workflow import build_graph  
+from batch_runner import run_batch, write_predictions, summarize, print_summary
+from response_cache import get_response_cache
 
 
-with open("sampled_questions.json") as f:
+parser = argparse.ArgumentParser()
+parser.add_argument("--questions", default="sampled_questions.json")
+parser.add_argument("--out", default="sample_predictions.tsv")
+parser.add_argument("--concurrency", type=int, default=8)
+parser.add_argument("--checkpoint", help="resume file (default: next to --out)")
+parser.add_argument("--max-retries", type=int, default=3)
+args = parser.parse_args()
+checkpoint_path = args.checkpoint or os.path.splitext(args.out)[0] + ".checkpoint.jsonl"
+
+with open(args.questions) as f:
     sampled_questions = json.load(f)
 
 
 graph = build_graph()
 
-
-lines = []
-
-for idx, item in enumerate(sampled_questions, 1):
-    question = item["question"]
-    db_id = item["db_id"]
-
-    print(f"\n🔹 [{idx}/{len(sampled_questions)}] {question}. use {db_id} database.")
-
-    try:
-        result = graph.invoke({
-            "question": question,
-            "dbs": [db_id]  
-        })
-
-        sql = result.get("final_sql", "").replace("\n", " ").replace("\t", " ").strip()
-        print("Result object:", result)
-
-        if not sql:
-            sql = "SELECT 1" 
-
-        lines.append(f"{sql}\t{db_id}")
-    except Exception as e:
-        print(f"❌ Error: {e}")
-        lines.append(f"SELECT 1\t{db_id}")  
-
-
-with open("sample_predictions.tsv", "w") as f:
-    f.write("\n".join(lines))
-
-print("\n Done. Predictions written to sample_predictions.tsv")
+t0 = time.time()
+records, processed = asyncio.run(run_batch(
+    graph,
+    sampled_questions,
+    concurrency=args.concurrency,
+    checkpoint_path=checkpoint_path,
+    max_retries=args.max_retries,
+))
+elapsed = time.time() - t0
+
+write_predictions(records, args.out)
+
+print(f"\n Done. Predictions written to {args.out}")
+print_summary(summarize(records, elapsed, processed))
+if get_response_cache():
+    print(f" Response cache: {get_response_cache().stats()}")
@@ -1,7 +1,23 @@
+import asyncio
+import json
 from fastapi import FastAPI
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 from fastapi.middleware.cors import CORSMiddleware
 from langgraph_workflow import build_graph
+from schema_catalog import get_catalog
+from embedding_service import memory_footprint
+from response_cache import get_response_cache
+import db_pool
+import prompt_builder
+import sql_rules
+import hint_classifier
+import model_runner
+import self_correction
+import sql_validator
+import self_consistency
+import join_graph
+from spider import parse_cache
 
 app = FastAPI()
 graph = build_graph()
@@ -18,23 +34,24 @@ class QueryRequest(BaseModel):
     question: str
     db_id: str = None  
 
+def build_initial_state(data: QueryRequest):
+    return {
+        "question": data.question,
+        "dbs": [data.db_id] if data.db_id else [],
+        "output": "",
+        "attempt": 0,
+        "hinted_db": None,
+        "hinted_column": None,
+        "gpt_selected_dbs": [],
+        "all_outputs": {},
+        "final_db": None,
+        "final_sql": None
+    }
+
 @app.post("/query")
-def query_handler(data: QueryRequest):
+async def query_handler(data: QueryRequest):
     try:
-        initial_state = {
-            "question": data.question,
-            "dbs": [data.db_id] if data.db_id else [],
-            "output": "",
-            "attempt": 0,
-            "hinted_db": None,
-            "hinted_column": None,
-            "gpt_selected_dbs": [],
-            "all_outputs": {},
-            "final_db": None,
-            "final_sql": None
-        }
-
-        result = graph.invoke(initial_state)
+        result = await graph.ainvoke(build_initial_state(data))
 
         return {
         "result": result.get("output", "No meaningful answer found."),
@@ -45,3 +62,60 @@ def query_handler(data: QueryRequest):
 
     except Exception as e:
         return {"error": str(e)}
+
+
+@app.post("/query/stream")
+async def query_stream_handler(data: QueryRequest):
+    """
+    Generate the SQL like /query, then stream every result row back as NDJSON:
+    a header line with db/sql/columns, one {"row": [...]} line per row and a final
+    {"done": true, "row_count": n} line. Nothing is materialised server-side, so this
+    is the endpoint for result sets larger than the truncated /query answer.
+    """
+    try:
+        result = await graph.ainvoke(build_initial_state(data))
+    except Exception as e:
+        return {"error": str(e)}
+
+    db_id = result.get("final_db")
+    sql = result.get("final_sql")
+    if not db_id or not sql or sql == "SQL generation failed":
+        return {"error": "SQL generation failed", "result": result.get("output")}
+
+    try:
+        columns, rows = await asyncio.to_thread(db_pool.open_stream, db_id, sql)
+    except Exception as e:
+        return {"error": f"[Execution Error] {e}", "db": db_id, "sql": sql}
+
+    def ndjson_lines():
+        yield json.dumps({"db": db_id, "sql": sql, "columns": columns}) + "\n"
+        row_count = 0
+        try:
+            for row in rows:
+                row_count += 1
+                yield json.dumps({"row": list(row)}, default=str) + "\n"
+        except Exception as e:
+            yield json.dumps({"error": f"[Execution Error] {e}", "row_count": row_count}) + "\n"
+            return
+        yield json.dumps({"done": True, "row_count": row_count}) + "\n"
+
+    return StreamingResponse(ndjson_lines(), media_type="application/x-ndjson")
+
+
+@app.get("/stats")
+def stats_handler():
+    return {
+        "schema_catalog": get_catalog().stats(),
+        "embeddings": memory_footprint(),
+        "response_cache": get_response_cache().stats() if get_response_cache() else None,
+        "db_pool": db_pool.stats(),
+        "prompts": prompt_builder.stats(),
+        "sql_rules": sql_rules.stats(),
+        "hint_classifier": hint_classifier.stats(),
+        "structured_outputs": model_runner.stats(),
+        "self_correction": self_correction.stats(),
+        "sql_validator": sql_validator.stats(),
+        "self_consistency": self_consistency.stats(),
+        "parse_cache": parse_cache.stats(),
+        "join_graph": join_graph.stats(),
+    }
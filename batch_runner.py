@@ -0,0 +1,174 @@
+import asyncio
+import json
+import math
+import os
+import random
+import time
+
+# A prediction whose output carries this marker failed on an exception (e.g. the API
+# still rate limiting after the SDK's own retries) and is worth another attempt.
+TRANSIENT_ERROR_MARKER = "[Error]"
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(0, math.ceil(pct / 100.0 * len(ordered)) - 1)
+    return ordered[rank]
+
+
+def _matches(record, items):
+    index = record.get("index")
+    if not isinstance(index, int) or not 0 <= index < len(items):
+        return False
+    item = items[index]
+    return record.get("question") == item["question"] and record.get("db_id") == item["db_id"]
+
+
+def load_checkpoint(path, items=None):
+    """
+    Return {index: record} for every question already completed in `path`. With
+    `items`, records whose question or db_id differ from the item at their index
+    (a checkpoint of another questions file) are ignored. Failed records are never
+    done, so a resumed run retries them.
+    """
+    done = {}
+    if not path or not os.path.exists(path):
+        return done
+    mismatched = 0
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # A run killed mid-write leaves a truncated last line; that question is redone.
+                continue
+            if items is not None and not _matches(record, items):
+                mismatched += 1
+            elif record.get("error"):
+                done.pop(record.get("index"), None)
+            else:
+                done[record["index"]] = record
+    if mismatched:
+        print(f" Ignoring {mismatched} records of {path} that do not match the questions being run")
+    return done
+
+
+def _clean_sql(sql):
+    sql = (sql or "").replace("\n", " ").replace("\t", " ").strip()
+    return sql or "SELECT 1"
+
+
+async def _run_one(graph, index, item, semaphore, max_retries, base_delay):
+    question = item["question"]
+    db_id = item["db_id"]
+
+    async with semaphore:
+        for attempt in range(max_retries + 1):
+            t0 = time.perf_counter()
+            try:
+                result = await graph.ainvoke({"question": question, "dbs": [db_id]})
+                error = None
+                if TRANSIENT_ERROR_MARKER in (result.get("output") or ""):
+                    error = result.get("output")
+            except Exception as e:
+                result = None
+                error = str(e)
+
+            if error is None or attempt == max_retries:
+                break
+            delay = base_delay * (2 ** attempt) * (1 + random.random())
+            print(f" [{index}] attempt {attempt + 1} failed ({error.strip()[:80]}), retrying in {delay:.1f}s")
+            await asyncio.sleep(delay)
+
+    return {
+        "index": index,
+        "question": question,
+        "db_id": db_id,
+        "sql": _clean_sql(result.get("final_sql") if result else None),
+        "error": error,
+        "attempts": attempt + 1,
+        "latency": time.perf_counter() - t0,
+        "timings": (result or {}).get("timings", {}),
+    }
+
+
+async def run_batch(graph, items, concurrency=8, checkpoint_path=None, max_retries=3, base_delay=2.0):
+    """
+    Run every {"question", "db_id"} item through graph.ainvoke with at most `concurrency`
+    requests in flight. Successful items are appended to `checkpoint_path` so an
+    interrupted run resumes where it stopped; the checkpoint is deleted once every item
+    has succeeded. Returns (records ordered by input index, number of questions
+    processed in this run).
+    """
+    done = load_checkpoint(checkpoint_path, items)
+    pending = [(i, item) for i, item in enumerate(items) if i not in done]
+    if done:
+        print(f" Resuming: {len(done)} of {len(items)} questions already in {checkpoint_path}")
+
+    semaphore = asyncio.Semaphore(concurrency)
+    tasks = [
+        asyncio.create_task(_run_one(graph, i, item, semaphore, max_retries, base_delay))
+        for i, item in pending
+    ]
+
+    checkpoint = open(checkpoint_path, "a", encoding="utf-8") if checkpoint_path else None
+    try:
+        for finished, task in enumerate(asyncio.as_completed(tasks), 1):
+            record = await task
+            done[record["index"]] = record
+            if checkpoint and not record["error"]:
+                checkpoint.write(json.dumps(record) + "\n")
+                checkpoint.flush()
+            status = "failed" if record["error"] else "ok"
+            print(f"🔹 [{finished}/{len(pending)}] #{record['index']} {record['db_id']} {status} "
+                  f"in {record['latency']:.2f}s")
+    finally:
+        if checkpoint:
+            checkpoint.close()
+
+    if checkpoint and len(done) == len(items) and not any(record["error"] for record in done.values()):
+        # A finished checkpoint would make the next run of the same file skip every question
+        os.remove(checkpoint_path)
+        print(f" All {len(items)} questions succeeded, removed {checkpoint_path}")
+
+    return [done[i] for i in sorted(done)], len(pending)
+
+
+def write_predictions(records, path):
+    with open(path, "w") as f:
+        f.write("\n".join(f"{record['sql']}\t{record['db_id']}" for record in records))
+
+
+def summarize(records, elapsed, processed=None):
+    """Throughput plus p50/p95 latency overall and per graph node."""
+    processed = len(records) if processed is None else processed
+    latencies = [record["latency"] for record in records]
+    node_latencies = {}
+    for record in records:
+        for node, seconds in record.get("timings", {}).items():
+            node_latencies.setdefault(node, []).append(seconds)
+
+    return {
+        "questions": len(records),
+        "failed": sum(1 for record in records if record.get("error")),
+        "elapsed": elapsed,
+        "questions_per_sec": processed / elapsed if elapsed else 0.0,
+        "latency": {"p50": percentile(latencies, 50), "p95": percentile(latencies, 95)},
+        "nodes": {
+            node: {"p50": percentile(values, 50), "p95": percentile(values, 95)}
+            for node, values in sorted(node_latencies.items())
+        },
+    }
+
+
+def print_summary(summary):
+    print(f"\n Questions: {summary['questions']} ({summary['failed']} failed) in {summary['elapsed']:.1f}s "
+          f"-> {summary['questions_per_sec']:.2f} questions/sec")
+    print(f" {'latency':25} p50 {summary['latency']['p50']:.2f}s   p95 {summary['latency']['p95']:.2f}s")
+    for node, stats in summary["nodes"].items():
+        print(f" {node:25} p50 {stats['p50']:.2f}s   p95 {stats['p95']:.2f}s")
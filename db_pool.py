@@ -0,0 +1,184 @@
+import os
+import sqlite3
+import threading
+import time
+from urllib.request import pathname2url
+
+SPIDER_PATH = "spider/database"
+
+# Spider databases never change while the service runs, so they are opened
+# read-only and immutable (no locking, no change detection).
+IMMUTABLE = True
+MMAP_SIZE = 256 * 1024 * 1024
+CACHE_SIZE_KIB = 64 * 1024
+STATEMENT_TIMEOUT = 10.0
+MAX_FETCH_ROWS = 10000
+# Streams are consumed at the client's pace, so they get a longer overall budget.
+STREAM_TIMEOUT = 120.0
+# SQLite VM instructions between two timeout checks
+PROGRESS_STEPS = 10000
+
+
+class QueryLimitExceeded(Exception):
+    pass
+
+
+class ResultSet:
+    """The first `len(rows)` rows of a query, and whether it produced more."""
+    def __init__(self, rows, total_count, truncated):
+        self.rows = rows
+        # None when truncated: the rows past the cap are never read
+        self.total_count = total_count
+        self.truncated = truncated
+
+    def __repr__(self):
+        return f"ResultSet(rows={len(self.rows)}, total_count={self.total_count}, truncated={self.truncated})"
+
+
+_local = threading.local()
+_stats_lock = threading.Lock()
+_opened = 0
+_reused = 0
+_timeouts = 0
+_truncated = 0
+
+
+def db_path_for(db_id):
+    return os.path.join(SPIDER_PATH, db_id, f"{db_id}.sqlite")
+
+
+def _open(db_path, check_same_thread=True):
+    if not os.path.exists(db_path):
+        raise FileNotFoundError(f"Database file not found: {db_path}")
+    uri = f"file:{pathname2url(os.path.abspath(db_path))}?mode=ro"
+    if IMMUTABLE:
+        uri += "&immutable=1"
+    conn = sqlite3.connect(uri, uri=True, check_same_thread=check_same_thread)
+    conn.execute(f"PRAGMA mmap_size = {MMAP_SIZE}")
+    conn.execute(f"PRAGMA cache_size = -{CACHE_SIZE_KIB}")
+    conn.execute("PRAGMA query_only = 1")
+    return conn
+
+
+def get_connection(db_id, db_path=None):
+    """Return this thread's read-only connection to `db_id`, opening it on first use."""
+    global _opened, _reused
+    connections = getattr(_local, "connections", None)
+    if connections is None:
+        connections = _local.connections = {}
+
+    conn = connections.get(db_id)
+    with _stats_lock:
+        if conn is None:
+            _opened += 1
+        else:
+            _reused += 1
+    if conn is None:
+        conn = _open(db_path or db_path_for(db_id))
+        connections[db_id] = conn
+    return conn
+
+
+def _install_deadline(conn, timeout):
+    """Interrupt statements on `conn` after `timeout` seconds; returns the timed-out flag list."""
+    timed_out = []
+    if not timeout:
+        return timed_out
+    deadline = time.monotonic() + timeout
+
+    def check_deadline():
+        if time.monotonic() > deadline:
+            timed_out.append(True)
+            return 1
+        return 0
+
+    conn.set_progress_handler(check_deadline, PROGRESS_STEPS)
+    return timed_out
+
+
+def execute(db_id, query, timeout=STATEMENT_TIMEOUT, max_rows=MAX_FETCH_ROWS, db_path=None):
+    """
+    Run `query` on the pooled connection of `db_id`. The statement is interrupted after
+    `timeout` seconds. At most `max_rows` rows are kept; one more is read to detect
+    truncation and the rest are never computed, so neither memory nor time depends on
+    the full result size.
+    """
+    global _timeouts, _truncated
+    conn = get_connection(db_id, db_path)
+    timed_out = _install_deadline(conn, timeout)
+    cursor = conn.cursor()
+    try:
+        cursor.execute(query)
+        rows = cursor.fetchmany(max_rows + 1) if max_rows else cursor.fetchall()
+        truncated = bool(max_rows) and len(rows) > max_rows
+        if truncated:
+            rows = rows[:max_rows]
+            with _stats_lock:
+                _truncated += 1
+            print(f" Result of query on '{db_id}' truncated to {max_rows} rows")
+        return ResultSet(rows, None if truncated else len(rows), truncated)
+    except sqlite3.OperationalError:
+        if timed_out:
+            with _stats_lock:
+                _timeouts += 1
+            raise QueryLimitExceeded(f"statement timeout of {timeout}s exceeded")
+        raise
+    finally:
+        cursor.close()
+        if timeout:
+            conn.set_progress_handler(None, PROGRESS_STEPS)
+
+
+def open_stream(db_id, query, timeout=STREAM_TIMEOUT, batch_size=500, db_path=None):
+    """
+    Execute `query` on a dedicated connection and return (column names, row iterator).
+    Rows are fetched lazily in batches; the connection closes when the iterator is
+    exhausted or closed. Unlike pooled connections, it may be consumed from any thread.
+    """
+    conn = _open(db_path or db_path_for(db_id), check_same_thread=False)
+    timed_out = _install_deadline(conn, timeout)
+    try:
+        cursor = conn.execute(query)
+    except sqlite3.OperationalError:
+        conn.close()
+        if timed_out:
+            raise QueryLimitExceeded(f"statement timeout of {timeout}s exceeded")
+        raise
+    except Exception:
+        conn.close()
+        raise
+    columns = [column[0] for column in cursor.description or []]
+
+    def rows():
+        try:
+            while True:
+                try:
+                    batch = cursor.fetchmany(batch_size)
+                except sqlite3.OperationalError:
+                    if timed_out:
+                        raise QueryLimitExceeded(f"statement timeout of {timeout}s exceeded")
+                    raise
+                if not batch:
+                    return
+                yield from batch
+        finally:
+            conn.close()
+
+    return columns, rows()
+
+
+def close_thread_connections():
+    connections = getattr(_local, "connections", {})
+    for conn in connections.values():
+        conn.close()
+    connections.clear()
+
+
+def stats():
+    with _stats_lock:
+        return {
+            "opened": _opened,
+            "reused": _reused,
+            "timeouts": _timeouts,
+            "truncated": _truncated,
+        }
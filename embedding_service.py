@@ -0,0 +1,94 @@
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+EMBEDDING_MODEL = "all-MiniLM-L6-v2"
+QUERY_CACHE_SIZE = 1024
+
+_model = None
+_model_lock = threading.Lock()
+
+_query_cache = OrderedDict()
+_query_cache_size = QUERY_CACHE_SIZE
+_cache_lock = threading.Lock()
+_cache_hits = 0
+_cache_misses = 0
+
+
+def get_model():
+    """Return the process-wide SentenceTransformer, loading it on first use."""
+    global _model
+    if _model is None:
+        with _model_lock:
+            if _model is None:
+                from sentence_transformers import SentenceTransformer
+                _model = SentenceTransformer(EMBEDDING_MODEL)
+    return _model
+
+
+def encode(texts, batch_size=64, normalize=True):
+    """Embed a list of texts in batches; returns a float32 (n, dim) array."""
+    embeddings = get_model().encode(
+        list(texts),
+        batch_size=batch_size,
+        normalize_embeddings=normalize,
+        convert_to_numpy=True,
+    )
+    return np.asarray(embeddings, dtype=np.float32)
+
+
+def encode_query(text, normalize=True):
+    """Embed a single question, served from the LRU cache when seen before."""
+    global _cache_hits, _cache_misses
+    key = (text, normalize)
+    if _query_cache_size > 0:
+        with _cache_lock:
+            cached = _query_cache.get(key)
+            if cached is not None:
+                _query_cache.move_to_end(key)
+                _cache_hits += 1
+                return cached
+
+    embedding = encode([text], normalize=normalize)[0]
+    embedding.flags.writeable = False
+
+    if _query_cache_size > 0:
+        with _cache_lock:
+            _cache_misses += 1
+            _query_cache[key] = embedding
+            while len(_query_cache) > _query_cache_size:
+                _query_cache.popitem(last=False)
+    return embedding
+
+
+def set_query_cache_size(size):
+    """Resize the question cache; 0 disables it."""
+    global _query_cache_size
+    with _cache_lock:
+        _query_cache_size = max(0, int(size))
+        while len(_query_cache) > _query_cache_size:
+            _query_cache.popitem(last=False)
+
+
+def memory_footprint():
+    """Report the bytes held by the model weights and the question cache."""
+    parameter_bytes = 0
+    parameters = 0
+    if _model is not None:
+        for param in _model.parameters():
+            parameters += param.numel()
+            parameter_bytes += param.numel() * param.element_size()
+
+    with _cache_lock:
+        cache_bytes = sum(emb.nbytes for emb in _query_cache.values())
+        return {
+            "model": EMBEDDING_MODEL,
+            "loaded": _model is not None,
+            "parameters": parameters,
+            "parameter_bytes": parameter_bytes,
+            "query_cache_entries": len(_query_cache),
+            "query_cache_bytes": cache_bytes,
+            "query_cache_hits": _cache_hits,
+            "query_cache_misses": _cache_misses,
+        }
@@ -0,0 +1,198 @@
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+
+import numpy as np
+from embedding_service import encode, encode_query
+from prompt_builder import count_tokens
+
+SPIDER_DIR = "spider"
+TRAIN_FILES = [os.path.join(SPIDER_DIR, "train_spider.json"), os.path.join(SPIDER_DIR, "train_others.json")]
+FEW_SHOT_INDEX_PATH = os.path.join("schema_index", "few_shot.npz")
+HARDNESS_LEVELS = ["easy", "medium", "hard", "extra"]
+
+FEW_SHOT_K = 6
+FEW_SHOT_TOKEN_BUDGET = 600
+# "" (no filter), "auto" (predicted from the nearest training questions) or a level
+FEW_SHOT_HARDNESS = os.environ.get("TEXT2SQL_FEW_SHOT_HARDNESS", "") or None
+# Neighbours consulted by predict_hardness
+HARDNESS_NEIGHBOURS = 15
+
+
+def format_example(question, query):
+    return f"Q: {question}\nSQL: {query}"
+
+
+def load_training_examples(paths=TRAIN_FILES):
+    """Read Spider-format json files into (question, query, db_id, hardness) tuples."""
+    # evaluation.py imports its siblings as top-level modules
+    if SPIDER_DIR not in sys.path:
+        sys.path.insert(0, SPIDER_DIR)
+    from evaluation import Evaluator
+    evaluator = Evaluator()
+
+    examples = []
+    for path in paths:
+        if not os.path.exists(path):
+            print(f" Skipping {path}: not found")
+            continue
+        with open(path, "r") as f:
+            for item in json.load(f):
+                query = " ".join(item["query"].split())
+                examples.append((item["question"].strip(), query, item["db_id"], evaluator.eval_hardness(item["sql"])))
+    return examples
+
+
+def build_few_shot_index(paths=TRAIN_FILES, out=FEW_SHOT_INDEX_PATH):
+    t0 = time.time()
+    examples = load_training_examples(paths)
+    if not examples:
+        raise ValueError("No training examples found")
+    questions, queries, db_ids, hardness = zip(*examples)
+    embeddings = encode(questions, batch_size=64, normalize=True)
+
+    os.makedirs(os.path.dirname(out) or ".", exist_ok=True)
+    np.savez(
+        out,
+        embeddings=np.asarray(embeddings, dtype=np.float16),
+        questions=np.array(questions, dtype=np.str_),
+        queries=np.array(queries, dtype=np.str_),
+        db_ids=np.array(db_ids, dtype=np.str_),
+        hardness=np.array(hardness, dtype=np.str_),
+    )
+    print(f" {len(examples)} examples -> {out} ({time.time() - t0:.2f}s)")
+    return out
+
+
+def _nearest(scores, n):
+    """Indices of the `n` highest finite scores, best first."""
+    n = min(n, len(scores))
+    top = np.argpartition(-scores, n - 1)[:n]
+    top = top[np.argsort(-scores[top], kind="stable")]
+    return top[np.isfinite(scores[top])]
+
+
+class FewShotIndex:
+    """Embedded training questions with their gold SQL and Spider hardness level."""
+    def __init__(self, questions, queries, db_ids, hardness, embeddings):
+        self.questions = list(questions)
+        self.queries = list(queries)
+        self.db_ids = list(db_ids)
+        self.hardness = np.asarray(hardness)
+        self.embeddings = np.asarray(embeddings, dtype=np.float32)
+        self.embeddings.flags.writeable = False
+        self._tokens = {}
+
+    @classmethod
+    def load(cls, path=FEW_SHOT_INDEX_PATH):
+        with np.load(path, allow_pickle=False) as data:
+            return cls(
+                data["questions"].tolist(), data["queries"].tolist(), data["db_ids"].tolist(),
+                data["hardness"], data["embeddings"],
+            )
+
+    def __len__(self):
+        return len(self.questions)
+
+    def example(self, i):
+        return format_example(self.questions[i], self.queries[i])
+
+    def example_tokens(self, i):
+        tokens = self._tokens.get(i)
+        if tokens is None:
+            tokens = self._tokens[i] = count_tokens(self.example(i))
+        return tokens
+
+    def predict_hardness(self, embedding, k=HARDNESS_NEIGHBOURS):
+        """Similarity-weighted vote over the hardness of the `k` nearest training questions."""
+        scores = self.embeddings @ embedding
+        top = np.argpartition(-scores, min(k, len(scores) - 1))[:k]
+        votes = {}
+        for i in top:
+            votes[self.hardness[i]] = votes.get(self.hardness[i], 0.0) + max(float(scores[i]), 0.0)
+        return max(votes, key=votes.get) if votes else None
+
+    def select(self, question, k=FEW_SHOT_K, budget=FEW_SHOT_TOKEN_BUDGET, hardness=None):
+        """
+        Return up to `k` formatted examples nearest to `question`, most similar first,
+        whose combined size stays within `budget` tokens. `hardness` restricts them to
+        one level ("auto" predicts it); the rest is filled without the filter if needed.
+        """
+        if not self.questions:
+            return []
+        embedding = encode_query(question)
+        scores = self.embeddings @ embedding
+        if hardness == "auto":
+            hardness = self.predict_hardness(embedding)
+
+        # A generous candidate pool: near-duplicate questions share the same SQL
+        pool = k * 8
+        passes = [_nearest(scores, pool)]
+        if hardness:
+            passes.insert(0, _nearest(np.where(self.hardness == hardness, scores, -np.inf), pool))
+
+        selected = []
+        seen_queries = set()
+        used = 0
+        for ordered in passes:
+            for i in ordered:
+                if len(selected) >= k:
+                    break
+                if self.queries[i] in seen_queries or self.questions[i] == question:
+                    continue
+                tokens = self.example_tokens(i)
+                if budget and used + tokens > budget:
+                    continue
+                selected.append(i)
+                seen_queries.add(self.queries[i])
+                used += tokens
+
+        selected.sort(key=lambda i: -scores[i])
+        return [self.example(i) for i in selected]
+
+
+_index = None
+_index_loaded = False
+_index_lock = threading.Lock()
+
+
+def get_few_shot_index(path=FEW_SHOT_INDEX_PATH):
+    """Return the process-wide few-shot index, or None when it has not been built."""
+    global _index, _index_loaded
+    if not _index_loaded:
+        with _index_lock:
+            if not _index_loaded:
+                if os.path.exists(path):
+                    _index = FewShotIndex.load(path)
+                else:
+                    print(f" No few-shot index at {path}, using the static examples")
+                _index_loaded = True
+    return _index
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Embed Spider training questions for few-shot selection.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    build_parser = subparsers.add_parser("build", help="embed the training questions")
+    build_parser.add_argument("--train", nargs="*", default=TRAIN_FILES)
+    build_parser.add_argument("--out", default=FEW_SHOT_INDEX_PATH)
+
+    query_parser = subparsers.add_parser("query", help="show the examples selected for a question")
+    query_parser.add_argument("question")
+    query_parser.add_argument("--k", type=int, default=FEW_SHOT_K)
+    query_parser.add_argument("--budget", type=int, default=FEW_SHOT_TOKEN_BUDGET)
+    query_parser.add_argument("--hardness", choices=["auto"] + HARDNESS_LEVELS)
+    query_parser.add_argument("--index", default=FEW_SHOT_INDEX_PATH)
+
+    args = parser.parse_args()
+    if args.command == "build":
+        build_few_shot_index(args.train, args.out)
+    else:
+        index = FewShotIndex.load(args.index)
+        print(f" Predicted hardness: {index.predict_hardness(encode_query(args.question))}")
+        for example in index.select(args.question, args.k, args.budget, args.hardness):
+            print(f"\n{example}")
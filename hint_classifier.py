@@ -0,0 +1,325 @@
+import argparse
+import json
+import os
+import re
+import threading
+import time
+
+import numpy as np
+
+HINT_MODEL_PATH = os.path.join("schema_index", "hint_classifier.npz")
+# Below this, helper_analyze_question falls back to the LLM analyzer
+HINT_CONFIDENCE_THRESHOLD = float(os.environ.get("TEXT2SQL_HINT_CONFIDENCE", "0.8"))
+MIN_FEATURE_COUNT = 2
+
+# Binary fields learned from the gold SQL of the training questions. The remaining
+# filter_hint keys are either constant or derived from these.
+FIELDS = ["like", "between", "allow_in", "allow_join", "group_by_primary", "use_count_star", "use_count_distinct"]
+
+WORD = re.compile(r"[a-z0-9]+")
+DISTINCT_WORDS = re.compile(r"\b(distinct|different|unique)\b")
+LIKE_WORDS = re.compile(r"\b(contain|contains|containing|include|includes|including|substring|starts? with|ends? with)\b")
+BETWEEN_WORDS = re.compile(r"\bbetween\b")
+COUNT_WORDS = re.compile(r"\b(how many|number of|count|counts)\b")
+
+
+def _is_id(column):
+    return re.search(r"id$", column.split(".")[-1]) is not None
+
+
+def _group_by_primary(q):
+    # The analyzer's field: true when grouping by an ID while returning other attributes,
+    # and true (its example default) when the query does not group at all
+    group = re.search(r"group by ([\w.]+)", q)
+    if group is None:
+        return True
+    if not _is_id(group.group(1)):
+        return False
+    select = re.match(r"select (?:distinct )?(.*?) from ", q)
+    columns = [column.strip() for column in select.group(1).split(",")] if select else []
+    return any("(" not in column and not _is_id(column) for column in columns)
+
+
+def gold_labels(query):
+    """Derive the FIELDS labels from a gold SQL query, with the LLM analyzer's meaning."""
+    q = " ".join(query.lower().split())
+    compact = q.replace(" ", "")
+    return {
+        "like": " like " in q,
+        "between": " between " in q,
+        "allow_in": re.search(r"(?<!not) in \(", q) is not None,
+        "allow_join": " join " in q,
+        "group_by_primary": _group_by_primary(q),
+        # true unless a specific column is counted; queries without COUNT count all rows
+        "use_count_star": re.search(r"count\((?!\*)", compact) is None,
+        "use_count_distinct": "count(distinct" in compact,
+    }
+
+
+def features(question):
+    words = WORD.findall(question.lower())
+    feats = set(words)
+    feats.update(f"{a} {b}" for a, b in zip(words, words[1:]))
+    return feats
+
+
+def rule_overrides(question):
+    """Fields decided by keywords alone; these are taken with full confidence."""
+    q = question.lower()
+    rules = {}
+    if COUNT_WORDS.search(q):
+        if DISTINCT_WORDS.search(q):
+            rules["use_count_distinct"] = True
+    else:
+        rules["use_count_distinct"] = False
+        rules["use_count_star"] = True
+    if LIKE_WORDS.search(q):
+        rules["like"] = True
+    if BETWEEN_WORDS.search(q):
+        rules["between"] = True
+    return rules
+
+
+def to_filter_hint(values):
+    """Map FIELDS values to the filter_hint dict produced by the LLM analyzer."""
+    return {
+        "filter_style": "LIKE" if values["like"] else "=",
+        "range_style": "between" if values["between"] else "comparison",
+        "allow_in": values["allow_in"],
+        "date_style": "direct",
+        "having_count": "*",
+        "allow_join": values["allow_join"],
+        "allow_aliases": values["allow_join"],
+        "group_by_primary": values["group_by_primary"],
+        "use_count_star": values["use_count_star"],
+        "use_count_distinct": values["use_count_distinct"],
+    }
+
+
+class HintClassifier:
+    """One logistic regression per field over question word uni/bigrams, scored with numpy."""
+    def __init__(self, vocab, weights, bias):
+        self.vocab = {feat: i for i, feat in enumerate(vocab)}
+        self.weights = np.asarray(weights, dtype=np.float32)
+        self.bias = np.asarray(bias, dtype=np.float32)
+
+    @classmethod
+    def load(cls, path=HINT_MODEL_PATH):
+        with np.load(path, allow_pickle=False) as data:
+            return cls(data["vocab"].tolist(), data["weights"], data["bias"])
+
+    def save(self, path=HINT_MODEL_PATH):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        vocab = sorted(self.vocab, key=self.vocab.get)
+        np.savez(path, vocab=np.array(vocab, dtype=np.str_), weights=self.weights, bias=self.bias)
+
+    def probabilities(self, question):
+        rows = [self.vocab[feat] for feat in features(question) if feat in self.vocab]
+        logits = self.bias + self.weights[rows].sum(axis=0)
+        return 1.0 / (1.0 + np.exp(-logits))
+
+    def classify(self, question):
+        """Return (filter_hint, confidence); confidence is that of the least certain model field."""
+        probs = self.probabilities(question)
+        rules = rule_overrides(question)
+        values = {}
+        confidence = 1.0
+        for field, p in zip(FIELDS, probs):
+            if field in rules:
+                values[field] = rules[field]
+            else:
+                values[field] = bool(p >= 0.5)
+                confidence = min(confidence, float(max(p, 1.0 - p)))
+        return to_filter_hint(values), confidence
+
+
+def train_hint_classifier(paths=None, out=HINT_MODEL_PATH, c=1.0):
+    from scipy.sparse import csr_matrix
+    from sklearn.linear_model import LogisticRegression
+    from few_shot_index import TRAIN_FILES, load_training_examples
+
+    t0 = time.time()
+    examples = load_training_examples(paths or TRAIN_FILES)
+    if not examples:
+        raise ValueError("No training examples found")
+    question_feats = [features(question) for question, *_ in examples]
+
+    counts = {}
+    for feats in question_feats:
+        for feat in feats:
+            counts[feat] = counts.get(feat, 0) + 1
+    vocab = sorted(feat for feat, count in counts.items() if count >= MIN_FEATURE_COUNT)
+    index = {feat: i for i, feat in enumerate(vocab)}
+
+    rows, cols = [], []
+    for row, feats in enumerate(question_feats):
+        for feat in feats:
+            if feat in index:
+                rows.append(row)
+                cols.append(index[feat])
+    x = csr_matrix((np.ones(len(rows), dtype=np.float32), (rows, cols)), shape=(len(examples), len(vocab)))
+
+    labels = [gold_labels(query) for _, query, *_ in examples]
+    weights = np.zeros((len(vocab), len(FIELDS)), dtype=np.float32)
+    bias = np.zeros(len(FIELDS), dtype=np.float32)
+    for j, field in enumerate(FIELDS):
+        y = np.array([label[field] for label in labels], dtype=np.int8)
+        if y.min() == y.max():
+            # Only one class seen: a constant prediction
+            bias[j] = 8.0 if y[0] else -8.0
+            continue
+        model = LogisticRegression(C=c, max_iter=1000)
+        model.fit(x, y)
+        weights[:, j] = model.coef_[0]
+        bias[j] = model.intercept_[0]
+        print(f" {field:20} positives {int(y.sum()):5}/{len(y)}  train acc {model.score(x, y):.3f}")
+
+    classifier = HintClassifier(vocab, weights, bias)
+    classifier.save(out)
+    print(f" {len(examples)} questions, {len(vocab)} features -> {out} ({time.time() - t0:.2f}s)")
+    return classifier
+
+
+_classifier = None
+_classifier_loaded = False
+_classifier_lock = threading.Lock()
+_stats_lock = threading.Lock()
+_local = 0
+_fallbacks = 0
+
+
+def get_hint_classifier(path=HINT_MODEL_PATH):
+    """Return the process-wide classifier, or None when it has not been trained."""
+    global _classifier, _classifier_loaded
+    if not _classifier_loaded:
+        with _classifier_lock:
+            if not _classifier_loaded:
+                if os.path.exists(path):
+                    _classifier = HintClassifier.load(path)
+                else:
+                    print(f" No hint classifier at {path}, using the LLM analyzer")
+                _classifier_loaded = True
+    return _classifier
+
+
+def local_filter_hint(question, threshold=HINT_CONFIDENCE_THRESHOLD):
+    """The locally predicted filter_hint, or None when the LLM analyzer should decide."""
+    global _local, _fallbacks
+    classifier = get_hint_classifier()
+    if classifier is None:
+        return None
+    hint, confidence = classifier.classify(question)
+    with _stats_lock:
+        if confidence >= threshold:
+            _local += 1
+        else:
+            _fallbacks += 1
+    if confidence < threshold:
+        print(f" Hint classifier unsure ({confidence:.2f}), asking the LLM")
+        return None
+    return hint
+
+
+def stats():
+    with _stats_lock:
+        total = _local + _fallbacks
+        return {
+            "local": _local,
+            "llm_fallbacks": _fallbacks,
+            "local_rate": _local / total if total else 0.0,
+        }
+
+
+def _llm_filter_hint(question):
+    from langgraph_workflow import _analyzer_prompt
+    from model_runner import run_gpt4_structured
+    from structured_outputs import FilterHint
+    parsed, _ = run_gpt4_structured(_analyzer_prompt(question), FilterHint)
+    if parsed is None:
+        raise ValueError("analyzer output did not match FilterHint")
+    return parsed.model_dump()
+
+
+def benchmark(questions_path, limit=None, use_llm=False, threshold=HINT_CONFIDENCE_THRESHOLD, path=HINT_MODEL_PATH):
+    """
+    Per-field accuracy against labels derived from the gold SQL, fallback rate and
+    latency of the local classifier; with `use_llm`, the same for the LLM analyzer
+    plus field agreement between the two.
+    """
+    from batch_runner import percentile
+
+    with open(questions_path, "r") as f:
+        items = json.load(f)[:limit]
+    if not items:
+        print(f" No questions to benchmark in {questions_path}" + (f" (limit {limit})" if limit is not None else ""))
+        return
+    classifier = HintClassifier.load(path)
+
+    keys = list(to_filter_hint({field: False for field in FIELDS}))
+    local_correct = {key: 0 for key in keys}
+    llm_correct = {key: 0 for key in keys}
+    agreement = {key: 0 for key in keys}
+    local_latencies, llm_latencies = [], []
+    confident = 0
+    llm_failures = 0
+
+    for item in items:
+        gold = to_filter_hint(gold_labels(item["query"]))
+
+        t0 = time.perf_counter()
+        hint, confidence = classifier.classify(item["question"])
+        local_latencies.append(time.perf_counter() - t0)
+        confident += confidence >= threshold
+        for key in keys:
+            local_correct[key] += hint[key] == gold[key]
+
+        if use_llm:
+            t0 = time.perf_counter()
+            try:
+                llm_hint = _llm_filter_hint(item["question"])
+            except Exception as e:
+                print(f" LLM analyzer failed: {e}")
+                llm_failures += 1
+                continue
+            llm_latencies.append(time.perf_counter() - t0)
+            for key in keys:
+                llm_correct[key] += llm_hint.get(key) == gold[key]
+                agreement[key] += llm_hint.get(key) == hint[key]
+
+    n = len(items)
+    print(f"\n {n} questions, {confident / n:.1%} above confidence {threshold} (answered locally)")
+    print(f" local latency   p50 {percentile(local_latencies, 50) * 1000:.3f}ms   "
+          f"p95 {percentile(local_latencies, 95) * 1000:.3f}ms")
+    if use_llm:
+        print(f" LLM latency     p50 {percentile(llm_latencies, 50) * 1000:.1f}ms   "
+              f"p95 {percentile(llm_latencies, 95) * 1000:.1f}ms   ({llm_failures} failed)")
+    print(f"\n {'field':20} {'local/gold':>10}" + (f" {'llm/gold':>10} {'agreement':>10}" if use_llm else ""))
+    answered = max(len(llm_latencies), 1)
+    for key in keys:
+        line = f" {key:20} {local_correct[key] / n:10.1%}"
+        if use_llm:
+            line += f" {llm_correct[key] / answered:10.1%} {agreement[key] / answered:10.1%}"
+        print(line)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local replacement for the LLM question analyzer.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    train_parser = subparsers.add_parser("train", help="fit the classifier on Spider training questions")
+    train_parser.add_argument("--train", nargs="*")
+    train_parser.add_argument("--out", default=HINT_MODEL_PATH)
+    train_parser.add_argument("--c", type=float, default=1.0, help="inverse regularization strength")
+
+    bench_parser = subparsers.add_parser("benchmark", help="compare against gold SQL and the LLM analyzer")
+    bench_parser.add_argument("--questions", default="spider/dev.json")
+    bench_parser.add_argument("--limit", type=int)
+    bench_parser.add_argument("--llm", action="store_true", help="also call the LLM analyzer")
+    bench_parser.add_argument("--threshold", type=float, default=HINT_CONFIDENCE_THRESHOLD)
+    bench_parser.add_argument("--model", default=HINT_MODEL_PATH)
+
+    args = parser.parse_args()
+    if args.command == "train":
+        train_hint_classifier(args.train, args.out, args.c)
+    else:
+        benchmark(args.questions, args.limit, args.llm, args.threshold, args.model)
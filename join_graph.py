@@ -0,0 +1,186 @@
+import threading
+from collections import deque
+
+from schema_catalog import get_catalog
+
+
+class KeyClasses:
+    """Union-find over (table, column) keys; columns linked by foreign keys share a class."""
+    def __init__(self):
+        self.parent = {}
+
+    def find(self, key):
+        parent = self.parent.setdefault(key, key)
+        while parent != key:
+            grandparent = self.parent[parent]
+            self.parent[key] = grandparent
+            key, parent = parent, grandparent
+        return key
+
+    def union(self, a, b):
+        root_a, root_b = self.find(a), self.find(b)
+        if root_a != root_b:
+            self.parent[root_b] = root_a
+
+    def classes(self):
+        groups = {}
+        for key in self.parent:
+            groups.setdefault(self.find(key), []).append(key)
+        return list(groups.values())
+
+
+class JoinGraph:
+    """
+    Tables of one database as nodes, linked by the column pairs they can be joined on:
+    their foreign keys, plus columns referencing the same key (two tables pointing at
+    one parent key join directly, without the parent).
+    """
+    def __init__(self, entry):
+        tables = entry["table_names_original"]
+        columns = entry["column_names_original"]
+        self.db_id = entry.get("db_id")
+        self.tables = list(tables)
+        self._by_name = {table.lower(): table for table in tables}
+        # table -> {other table: [(column, other column), ...]}, in foreign key order
+        self.links = {table: {} for table in tables}
+        self.keys = KeyClasses()
+
+        for column_a, column_b in entry.get("foreign_keys", []):
+            key_a = (tables[columns[column_a][0]], columns[column_a][1])
+            key_b = (tables[columns[column_b][0]], columns[column_b][1])
+            self.keys.union(key_a, key_b)
+            self._link(key_a, key_b)
+
+        foreign_key_links = {table: set(others) for table, others in self.links.items()}
+        for members in self.keys.classes():
+            for i, key_a in enumerate(members):
+                for key_b in members[i + 1:]:
+                    if key_b[0] not in foreign_key_links[key_a[0]]:
+                        self._link(key_a, key_b)
+
+    def _link(self, key_a, key_b):
+        (table_a, column_a), (table_b, column_b) = key_a, key_b
+        # self-references (employee.manager_id -> employee.id) need no join between tables
+        if table_a == table_b:
+            return
+        pairs_ab = self.links[table_a].setdefault(table_b, [])
+        if (column_a, column_b) not in pairs_ab:
+            pairs_ab.append((column_a, column_b))
+            self.links[table_b].setdefault(table_a, []).append((column_b, column_a))
+
+    def table(self, name):
+        """The original-case name of table `name` (any case); None when unknown."""
+        return self._by_name.get(name.lower())
+
+    def key_class(self, table, column):
+        """Every (table, column) holding the same key as `table`.`column`."""
+        root = self.keys.find((table, column))
+        return sorted(key for key in self.keys.parent if self.keys.find(key) == root)
+
+    def _nearest(self, sources, targets):
+        # Breadth-first from every source at once; path to the closest target
+        previous = {table: None for table in sources}
+        queue = deque(sources)
+        while queue:
+            table = queue.popleft()
+            if table in targets:
+                path = []
+                while table is not None:
+                    path.append(table)
+                    table = previous[table]
+                return path[::-1]
+            for other in self.links[table]:
+                if other not in previous:
+                    previous[other] = table
+                    queue.append(other)
+        return None
+
+    def _hops(self, path):
+        return [(a, b, self.links[a][b]) for a, b in zip(path, path[1:])]
+
+    def shortest_join_path(self, table_a, table_b):
+        """
+        Fewest joins from `table_a` to `table_b` as [(table, next table, column pairs)];
+        None when they are not connected.
+        """
+        a, b = self.table(table_a), self.table(table_b)
+        if a is None or b is None:
+            return None
+        path = self._nearest([a], {b})
+        return None if path is None else self._hops(path)
+
+    def connect(self, tables):
+        """
+        Hops joining `tables` (most relevant first): each table not yet connected is
+        attached to the joined ones by its shortest path, which may pass through tables
+        not in `tables`. Tables no foreign key reaches start a group of their own.
+        """
+        wanted = list(dict.fromkeys(table for table in map(self.table, tables) if table))
+        if len(wanted) < 2:
+            return []
+        joined = dict.fromkeys(wanted[:1])
+        remaining = wanted[1:]
+        hops = []
+        while remaining:
+            path = self._nearest(list(joined), set(remaining))
+            if path is None:
+                joined[remaining.pop(0)] = None
+                continue
+            hops.extend(self._hops(path))
+            joined.update(dict.fromkeys(path))
+            remaining = [table for table in remaining if table not in joined]
+        return hops
+
+
+def format_join_keys(hops):
+    """Prompt lines for `hops`; alternatives between the same two tables share a line."""
+    lines = []
+    for table_a, table_b, pairs in hops:
+        conditions = [f"{table_a}.{column_a} = {table_b}.{column_b}" for column_a, column_b in pairs]
+        line = f"  - {conditions[0]}"
+        if len(conditions) > 1:
+            line += " (or " + ", or ".join(conditions[1:]) + ")"
+        lines.append(line)
+    return "Join keys:\n" + "\n".join(lines) if lines else ""
+
+
+_graphs = {}
+_graphs_lock = threading.Lock()
+_stats_lock = threading.Lock()
+_counters = {"builds": 0, "hits": 0}
+
+
+def _count(name):
+    with _stats_lock:
+        _counters[name] += 1
+
+
+def get_join_graph(db_id):
+    """The JoinGraph of `db_id`, built once per tables.json load of the schema catalog."""
+    entry = get_catalog().get_schema(db_id)
+    cached = _graphs.get(db_id)
+    if cached is not None and cached[0] is entry:
+        _count("hits")
+        return cached[1]
+    with _graphs_lock:
+        cached = _graphs.get(db_id)
+        if cached is None or cached[0] is not entry:
+            _count("builds")
+            cached = (entry, JoinGraph(entry))
+            _graphs[db_id] = cached
+    return cached[1]
+
+
+def join_hint(db_id, tables):
+    """The "Join keys:" block connecting `tables` of `db_id`; empty when nothing joins."""
+    try:
+        graph = get_join_graph(db_id)
+    except ValueError:
+        return ""
+    return format_join_keys(graph.connect(tables))
+
+
+def stats():
+    with _stats_lock:
+        counters = dict(_counters)
+    return {**counters, "databases": len(_graphs)}
@@ -1,23 +1,36 @@
-from langgraph.graph import StateGraph
-from typing import TypedDict
-from model_runner import run_gpt4
-from main import run_query
-import json
+from langgraph.graph import StateGraph, START
+from langchain_core.runnables import RunnableLambda
+from typing import Annotated, TypedDict
+from model_runner import run_gpt4, run_gpt4_async, run_gpt4_structured, run_gpt4_structured_async
+from structured_outputs import FilterHint
+from main import run_query, run_query_async, retrieve_schema_chunks
+from sql_rules import apply_local_rewrites
+from sql_validator import validate_sql
+from hint_classifier import local_filter_hint
+import self_correction
+import asyncio
+import operator
+import re
+import time
 class QueryState(TypedDict):
     question: str
     dbs: list[str]
     output: str
     attempt: int
     filter_hint: dict | None
+    schema_chunks: list | None
     final_db: str | None
     final_sql: str | None
+    rule_violations: list | None
+    generation_started: float | None
+    retry_reason: str | None
+    last_failed_sql: str | None
+    best_attempt: dict | None
+    timings: Annotated[dict, operator.or_]
 
 
-def helper_analyze_question(state: QueryState) -> QueryState:
-    print("helper_analyze_question agent started -->>")
-    question = state["question"]
-
-    prompt = f"""
+def _analyzer_prompt(question):
+    return f"""
 You are a JSON-only assistant.
 
 Your task is to analyze the user's question and return SQL generation preferences.
@@ -57,14 +70,61 @@ Question:
 \"\"\"{question}\"\"\"
 """.strip()
 
+
+def helper_analyze_question(state: QueryState) -> QueryState:
+    print("helper_analyze_question agent started -->>")
+    hint = local_filter_hint(state["question"])
+    if hint is not None:
+        print(f" Filter hint classified locally: {hint}")
+        return {"filter_hint": hint}
+    prompt = _analyzer_prompt(state["question"])
+
+    try:
+        parsed, _ = run_gpt4_structured(prompt, FilterHint)
+        if parsed is None:
+            return {"filter_hint": {}}
+        print(f" Filter hint extracted: {parsed}")
+        return {"filter_hint": parsed.model_dump()}
+    except Exception as e:
+        print(f" Failed to extract hints: {e}")
+        return {"filter_hint": {}}
+
+
+async def helper_analyze_question_async(state: QueryState) -> QueryState:
+    print("helper_analyze_question agent started -->>")
+    hint = local_filter_hint(state["question"])
+    if hint is not None:
+        print(f" Filter hint classified locally: {hint}")
+        return {"filter_hint": hint}
+    prompt = _analyzer_prompt(state["question"])
+
     try:
-        response, _ = run_gpt4(prompt)
-        parsed = json.loads(response)
+        parsed, _ = await run_gpt4_structured_async(prompt, FilterHint)
+        if parsed is None:
+            return {"filter_hint": {}}
         print(f" Filter hint extracted: {parsed}")
-        return {**state, "filter_hint": parsed}
+        return {"filter_hint": parsed.model_dump()}
     except Exception as e:
         print(f" Failed to extract hints: {e}")
-        return {**state, "filter_hint": {}}
+        return {"filter_hint": {}}
+
+
+# helper_analyze_question and retrieve_schema run in the same superstep, so both
+# return only the keys they own instead of the whole state.
+def retrieve_schema(state: QueryState) -> QueryState:
+    print(" retrieve_schema -->>")
+    if not state.get("dbs"):
+        return {"schema_chunks": None}
+
+    try:
+        return {"schema_chunks": retrieve_schema_chunks(state["dbs"][0], state["question"])}
+    except Exception as e:
+        print(f" Failed to retrieve schema: {e}")
+        return {"schema_chunks": None}
+
+
+async def retrieve_schema_async(state: QueryState) -> QueryState:
+    return await asyncio.to_thread(retrieve_schema, state)
 
 
 def generate_sql_single(state: QueryState) -> QueryState:
@@ -74,7 +134,24 @@ def generate_sql_single(state: QueryState) -> QueryState:
     db_id = state["dbs"][0]
     filter_hint = state.get("filter_hint")
 
-    sql, result = run_query(db_id, question, filter_hint=filter_hint)
+    started = time.monotonic()
+    sql, result = run_query(db_id, question, filter_hint=filter_hint, schema_chunks=state.get("schema_chunks"))
+    return {**_generation_update(state, db_id, sql, result), "generation_started": started}
+
+
+async def generate_sql_single_async(state: QueryState) -> QueryState:
+    print(" generate_sql_single -->>")
+
+    question = state["question"]
+    db_id = state["dbs"][0]
+    filter_hint = state.get("filter_hint")
+
+    started = time.monotonic()
+    sql, result = await run_query_async(db_id, question, filter_hint=filter_hint, schema_chunks=state.get("schema_chunks"))
+    return {**_generation_update(state, db_id, sql, result), "generation_started": started}
+
+
+def _generation_update(state, db_id, sql, result):
     result_str = str(result) if result is not None else "(No result returned)"
     sql_str = str(sql) if sql is not None else "SQL generation failed"
 
@@ -87,17 +164,77 @@ def generate_sql_single(state: QueryState) -> QueryState:
     }
 
 
-def sql_rewriter_agent(state: QueryState) -> QueryState:
-    print(" sql_rewriter_agent -->>")
+def check_execution(state: QueryState) -> QueryState:
+    """Decide whether the last generated query gets another, error-informed attempt."""
+    attempt = state.get("attempt") or 0
+    reason = self_correction.retry_reason(state.get("output", ""))
+    if reason is None:
+        self_correction.record_outcome(attempt, None)
+        return {**state, "retry_reason": None}
+
+    stop = None
+    if reason == self_correction.TRANSIENT_ERROR:
+        stop = "transient"
+    elif attempt >= self_correction.MAX_CORRECTIONS:
+        stop = "attempts"
+    elif not self_correction.within_budget(attempt, state.get("generation_started")):
+        stop = "budget"
+    elif state.get("final_sql") == state.get("last_failed_sql"):
+        stop = "no_progress"
+    # Ties go to the later attempt, which had the earlier problems as feedback
+    best = state.get("best_attempt")
+    rank = self_correction.outcome_rank(reason)
+    if best is None or rank >= best["rank"]:
+        best = {"rank": rank, "reason": reason, "output": state.get("output"),
+                "final_sql": state.get("final_sql"), "final_db": state.get("final_db")}
+
+    if stop:
+        print(f" Not retrying {reason} after {attempt} corrections ({stop})")
+        if best["rank"] > rank:
+            print(f" Keeping an earlier attempt ({best['reason']}) over the last one ({reason})")
+        self_correction.record_outcome(attempt, best["reason"], stop)
+        return {**state, "output": best["output"], "final_sql": best["final_sql"], "final_db": best["final_db"],
+                "retry_reason": None, "best_attempt": best}
+
+    return {**state, "retry_reason": reason, "last_failed_sql": state.get("final_sql"), "best_attempt": best}
+
+
+def route_after_check(state: QueryState) -> str:
+    return "repair_sql" if state.get("retry_reason") else "sql_rule_check"
 
-    import re
-    output = state.get("output", "")
-    db_id = state["final_db"]
-    
+
+def _repair_args(state):
+    attempt = (state.get("attempt") or 0) + 1
+    reason = state["retry_reason"]
+    print(f" repair_sql -->> attempt {attempt} ({reason})")
+    self_correction.record_retry(reason)
+    feedback = self_correction.correction_feedback(state.get("output", ""), reason)
+    return attempt, feedback
+
+
+def repair_sql(state: QueryState) -> QueryState:
+    attempt, feedback = _repair_args(state)
+    db_id = state["dbs"][0]
+    sql, result = run_query(db_id, state["question"], filter_hint=state.get("filter_hint"),
+                            schema_chunks=state.get("schema_chunks"), feedback=feedback)
+    return {**_generation_update(state, db_id, sql, result), "attempt": attempt}
+
+
+async def repair_sql_async(state: QueryState) -> QueryState:
+    attempt, feedback = _repair_args(state)
+    db_id = state["dbs"][0]
+    sql, result = await run_query_async(db_id, state["question"], filter_hint=state.get("filter_hint"),
+                                        schema_chunks=state.get("schema_chunks"), feedback=feedback)
+    return {**_generation_update(state, db_id, sql, result), "attempt": attempt}
+
+
+def _used_sql(output):
     sql_match = re.search(r" SQL used:\n(.+)", output, re.DOTALL)
-    raw_sql = sql_match.group(1).strip() if sql_match else ""
+    return sql_match.group(1).strip() if sql_match else ""
+
 
-    prompt = f"""
+def _rewriter_prompt(raw_sql):
+    return f"""
 You are a SQL formatting corrector.
 
 Revise the SQL query below ONLY IF it violates any of the following rules. Do not change the logic, only fix formatting.
@@ -117,20 +254,71 @@ SQL:
 {raw_sql}
 """
 
+
+def _apply_rewrite(state, raw_sql, corrected_sql):
+    corrected_sql = corrected_sql.strip()
+    if not corrected_sql.lower().startswith("select"):
+        print(" Rewriter output was not valid SQL — falling back to original")
+        corrected_sql = raw_sql
+
+    rewritten_output = re.sub(
+        r" SQL used:\n(.+)",
+        f" SQL used:\n{corrected_sql}",
+        state.get("output", ""),
+        flags=re.DOTALL
+    )
+    return {**state, "output": rewritten_output, "final_sql": corrected_sql}
+
+
+def sql_rule_check(state: QueryState) -> QueryState:
+    """Apply the mechanical rewriter rules locally and record which ones still need the LLM."""
+    print(" sql_rule_check -->>")
+
+    raw_sql = _used_sql(state.get("output", ""))
+    if not raw_sql.lower().startswith("select"):
+        return {**state, "rule_violations": []}
+
+    # A query that already ran is only replaced by a rewrite that still validates
+    db_id = state.get("final_db")
+    validate = (lambda sql: validate_sql(db_id, sql)) if db_id else None
+    sql, fixed, remaining = apply_local_rewrites(raw_sql, validate)
+    if fixed:
+        print(f" Fixed locally: {', '.join(fixed)}")
+        state = _apply_rewrite(state, raw_sql, sql)
+    if remaining:
+        print(f" Rewriter needed for: {', '.join(remaining)}")
+    return {**state, "rule_violations": remaining}
+
+
+async def sql_rule_check_async(state: QueryState) -> QueryState:
+    return await asyncio.to_thread(sql_rule_check, state)
+
+
+def route_after_rule_check(state: QueryState) -> str:
+    return "sql_rewriter_agent" if state.get("rule_violations") else "final_output"
+
+
+def sql_rewriter_agent(state: QueryState) -> QueryState:
+    print(" sql_rewriter_agent -->>")
+
+    raw_sql = _used_sql(state.get("output", ""))
+
+    try:
+        corrected_sql, _ = run_gpt4(_rewriter_prompt(raw_sql))
+        return _apply_rewrite(state, raw_sql, corrected_sql)
+    except Exception as e:
+        print(f" Failed to rewrite SQL: {e}")
+        return state
+
+
+async def sql_rewriter_agent_async(state: QueryState) -> QueryState:
+    print(" sql_rewriter_agent -->>")
+
+    raw_sql = _used_sql(state.get("output", ""))
+
     try:
-        corrected_sql, _ = run_gpt4(prompt)
-        corrected_sql = corrected_sql.strip()
-        if not corrected_sql.lower().startswith("select"):
-            print(" Rewriter output was not valid SQL — falling back to original")
-            corrected_sql = raw_sql
-
-        rewritten_output = re.sub(
-            r" SQL used:\n(.+)",
-            f" SQL used:\n{corrected_sql}",
-            output,
-            flags=re.DOTALL
-        )
-        return {**state, "output": rewritten_output, "final_sql": corrected_sql}
+        corrected_sql, _ = await run_gpt4_async(_rewriter_prompt(raw_sql))
+        return _apply_rewrite(state, raw_sql, corrected_sql)
     except Exception as e:
         print(f" Failed to rewrite SQL: {e}")
         return state
@@ -143,18 +331,50 @@ def final_output(state: QueryState) -> QueryState:
     return state
 
 
+def _node(name, func, afunc=None):
+    """
+    Wrap a node so graph.invoke runs `func` and graph.ainvoke runs `afunc`, recording
+    the node's wall time under state["timings"][name].
+    """
+    def timed(state):
+        t0 = time.perf_counter()
+        update = func(state)
+        return {**update, "timings": {name: time.perf_counter() - t0}}
+
+    async def atimed(state):
+        t0 = time.perf_counter()
+        update = await afunc(state) if afunc else func(state)
+        return {**update, "timings": {name: time.perf_counter() - t0}}
+
+    return RunnableLambda(timed, afunc=atimed, name=name)
+
+
 def build_graph():
     graph = StateGraph(QueryState)
-    graph.add_node("helper_analyze_question", helper_analyze_question)
-    graph.add_node("generate_sql_single", generate_sql_single)
-    graph.add_node("sql_rewriter_agent", sql_rewriter_agent)
-    graph.add_node("final_output", final_output)
-
-    graph.set_entry_point("helper_analyze_question")
-    graph.add_edge("helper_analyze_question", "generate_sql_single")
-    graph.add_edge("generate_sql_single", "sql_rewriter_agent")
+    graph.add_node("helper_analyze_question", _node("helper_analyze_question", helper_analyze_question, helper_analyze_question_async))
+    graph.add_node("retrieve_schema", _node("retrieve_schema", retrieve_schema, retrieve_schema_async))
+    graph.add_node("generate_sql_single", _node("generate_sql_single", generate_sql_single, generate_sql_single_async))
+    graph.add_node("check_execution", _node("check_execution", check_execution))
+    graph.add_node("repair_sql", _node("repair_sql", repair_sql, repair_sql_async))
+    graph.add_node("sql_rule_check", _node("sql_rule_check", sql_rule_check, sql_rule_check_async))
+    graph.add_node("sql_rewriter_agent", _node("sql_rewriter_agent", sql_rewriter_agent, sql_rewriter_agent_async))
+    graph.add_node("final_output", _node("final_output", final_output))
+
+    # Hint extraction (LLM) and schema retrieval are independent: fan out from START
+    # and join before prompt assembly in generate_sql_single.
+    graph.add_edge(START, "helper_analyze_question")
+    graph.add_edge(START, "retrieve_schema")
+    graph.add_edge(["helper_analyze_question", "retrieve_schema"], "generate_sql_single")
+    # The rewriter LLM call is only made when the SQL breaks a rule that cannot be fixed locally.
+    # Failed or empty executions loop back through repair_sql with the error as feedback,
+    # bounded by self_correction.MAX_CORRECTIONS and CORRECTION_LATENCY_BUDGET.
+    graph.add_edge("generate_sql_single", "check_execution")
+    graph.add_conditional_edges("check_execution", route_after_check, ["repair_sql", "sql_rule_check"])
+    graph.add_edge("repair_sql", "check_execution")
+    graph.add_conditional_edges("sql_rule_check", route_after_rule_check, ["sql_rewriter_agent", "final_output"])
     graph.add_edge("sql_rewriter_agent", "final_output")
 
     graph.set_finish_point("final_output")
 
-    return graph.compile()
+    # LangGraph's default recursion limit (25) would cut off long correction loops
+    return graph.compile().with_config(recursion_limit=max(25, self_correction.GRAPH_STEPS))
@@ -1,43 +1,37 @@
+import asyncio
 import sys
 import os
-import sqlite3
-import re
 import time
-import torch
-from schema_utils import load_schema_chunks, list_databases
-from vector_store import RAGRetriever
-from model_runner import convert_sql_to_answer, run_gpt4
+import db_pool
+from vector_store import get_schema_index
+from model_runner import (
+    MAX_ANSWER_ROWS, convert_sql_to_answer, run_gpt4_candidates, run_gpt4_candidates_async, run_gpt4_structured,
+    run_gpt4_structured_async,
+)
+import self_consistency
+from structured_outputs import GeneratedSQL
+from sql_validator import format_error as format_validation_error, validate_sql
 from sqlparse import format as format_sql
-from description_utils import load_descriptions, enrich_schema_with_descriptions
-from sentence_transformers import SentenceTransformer, util
+from embedding_service import encode_query
+from routing_index import get_routing_index
+from prompt_builder import PROMPT_TOKEN_BUDGET, build_prompt
+from few_shot_index import FEW_SHOT_HARDNESS, get_few_shot_index
+from join_graph import join_hint
 os.environ["TOKENIZERS_PARALLELISM"] = "false"
 
 SPIDER_PATH = "spider/database"
-EMBEDDING_DIR = "schema_embeddings"
-model = SentenceTransformer("all-MiniLM-L6-v2")
-
-def extract_sql(gpt_output: str) -> str | None:
-    # Remove Markdown code block wrappers if present
-    if "```sql" in gpt_output.lower():
-        gpt_output = gpt_output.lower().split("```sql", 1)[1]
-        gpt_output = gpt_output.split("```", 1)[0]
-    gpt_output = gpt_output.strip("`").strip()
-    match = re.search(r"(select\s.+?)(;|\Z)", gpt_output, re.IGNORECASE | re.DOTALL)
-    if match:
-        return match.group(1).strip()
 
-    return None
+def clean_sql(sql: str | None) -> str | None:
+    """Normalize the SQL of a structured response; None unless it is a SELECT."""
+    sql = (sql or "").strip().rstrip(";").strip()
+    return sql if sql.lower().startswith("select") else None
 
 
 
-def execute_sql_query(db_path, query):
+def execute_sql_query(db_id, query):
+    # Only the rows convert_sql_to_answer shows are fetched
     try:
-        conn = sqlite3.connect(db_path)
-        cursor = conn.cursor()
-        cursor.execute(query)
-        rows = cursor.fetchall()
-        conn.close()
-        return rows
+        return db_pool.execute(db_id, query, max_rows=MAX_ANSWER_ROWS)
     except Exception as e:
         return f"[Execution Error] {e}"
 
@@ -97,52 +91,22 @@ def format_schema_for_prompt(chunks: list[str]) -> str:
                     formatted.append(f"  - {col}")
     return "\n".join(formatted)
 
-def run_query(db_id, user_question, filter_hint=None):
-    db_path = f"{SPIDER_PATH}/{db_id}/{db_id}.sqlite"
 
-    try:
-        descriptions = load_descriptions()
-        schema_chunks = load_schema_chunks(db_id, db_path)
-        enriched_chunks = enrich_schema_with_descriptions(schema_chunks, db_id, descriptions)
+def chunk_table(chunk):
+    """Table name of a "Table:" chunk, None for other chunks."""
+    lines = chunk.strip().splitlines()
+    if "Table:" in chunk and lines:
+        return lines[0].replace("Table:", "").strip()
+    return None
 
-        retriever = RAGRetriever(collection_name=f"schema_chunks_{db_id}")
-        retriever.add_chunks(enriched_chunks)
-        retrieved_chunks = retriever.retrieve(user_question, k=8)
 
-        schema_text = format_schema_for_prompt(retrieved_chunks)
-        
+def format_join_keys(db_id, chunks):
+    """Join conditions connecting the tables of `chunks`, from the foreign-key graph."""
+    return join_hint(db_id, [table for table in map(chunk_table, chunks) if table])
+
+SCHEMA_TOP_K = 8
 
-        hints = []
-        if filter_hint:
-            if filter_hint.get("filter_style") == "=":
-                hints.append("- Use `=` for filtering text unless partial match is asked.")
-            elif filter_hint.get("filter_style") == "LIKE":
-                hints.append("- Use `LIKE '%value%'` only if partial match is intended.")
-            if filter_hint.get("range_style") == "between":
-                hints.append("- Use BETWEEN A AND B for numeric range filters.")
-            if filter_hint.get("range_style") == "comparison":
-                hints.append("- Use between A and B for numeric ranges instead of WHERE x > A AND x < B.")
-            if filter_hint.get("allow_in") is False:
-                hints.append("- Do NOT use IN (...) unless it is a subquery or exclusion (like NOT IN (SELECT ...)).")
-                hints.append("- Use OR clauses for multiple values instead.")
-            if filter_hint.get("date_style") == "direct":
-                hints.append("- Avoid using date functions like strftime; use WHERE year = 2020.")
-            if filter_hint.get("having_count") == "*":
-                hints.append("- Use COUNT(*) in HAVING unless a specific column is requested.")
-            if filter_hint.get("group_by_primary"):
-                hints.append("- When grouping, use the primary field (e.g., name) not ID fields.")
-            if filter_hint.get("use_count_star"):
-                hints.append("- Use COUNT(*) unless the question refers to getting unique values by saying distinct, different and unique for example.")
-            if filter_hint.get("use_count_distinct"):
-                hints.append("- Use COUNT(DISTINCT column) because the question asks for different or unique values.")
-            if not filter_hint.get("allow_aliases"):
-                hints.append("- Do NOT use table/column aliases like AS or T1 unless absolutely needed.")
-            if not filter_hint.get("allow_join"):
-                hints.append("- Avoid JOIN unless values from multiple tables are needed.")
-
-        hint_block = "\n".join(hints)
-
-        rag_prompt = f"""
+SQL_RULES = """
 You are an expert in writing SQLite-compatible SQL queries for natural language questions.
 
   General SQL Rules:
@@ -177,42 +141,164 @@ You are an expert in writing SQLite-compatible SQL queries for natural language
   - Example (Wrong): SELECT MAX(horsepower) FROM cars_data
 
 - if the question is as simple as "What is the age of the oldest dog?",use max(age).
+""".strip()
+
+PROMPT_TEMPLATE = """
+{rules}
 
  Dynamic Constraints Based on Question:
-{hint_block}
+{hints}
 
  Example Questions from different difficulites and their SQL:
 
-{FEW_SHOT_EXAMPLES}
+{few_shot}
 
  Schema:
-{schema_text}
+{schema}
 
  Question:
-{user_question}
+{question}{feedback}
 
 SQL:
-""".strip()
+"""
 
-        gpt_output, token_usage = run_gpt4(rag_prompt)
-        print("\n GPT Output:\n", gpt_output)
-        print(f"\n Token usage: {token_usage}")
 
-        sql_query = extract_sql(gpt_output)        
+def render_prompt(sections):
+    return PROMPT_TEMPLATE.format(**sections).strip()
 
-        if not sql_query:
-            print(" No SQL generated")
-            return "SQL generation failed", "( GPT failed to generate a valid SELECT query.)"
 
-        rows = execute_sql_query(db_path, sql_query)
-        answer = convert_sql_to_answer(rows, sql_query)
-        print(f"\n Raw answer type: {type(answer)} — value: {answer}")
+def retrieve_schema_chunks(db_id, user_question, k=SCHEMA_TOP_K):
+    """Top `k` schema chunks of `db_id` for the question, as (chunk, score) pairs."""
+    db_path = f"{SPIDER_PATH}/{db_id}/{db_id}.sqlite"
+    return get_schema_index(db_id, db_path).retrieve_scored(user_question, k=k)
+
+
+def build_hint_block(filter_hint):
+    if not filter_hint:
+        return ""
+    hints = []
+    if filter_hint.get("filter_style") == "=":
+        hints.append("- Use `=` for filtering text unless partial match is asked.")
+    elif filter_hint.get("filter_style") == "LIKE":
+        hints.append("- Use `LIKE '%value%'` only if partial match is intended.")
+    if filter_hint.get("range_style") == "between":
+        hints.append("- Use BETWEEN A AND B for numeric range filters.")
+    if filter_hint.get("range_style") == "comparison":
+        hints.append("- Use between A and B for numeric ranges instead of WHERE x > A AND x < B.")
+    if filter_hint.get("allow_in") is False:
+        hints.append("- Do NOT use IN (...) unless it is a subquery or exclusion (like NOT IN (SELECT ...)).")
+        hints.append("- Use OR clauses for multiple values instead.")
+    if filter_hint.get("date_style") == "direct":
+        hints.append("- Avoid using date functions like strftime; use WHERE year = 2020.")
+    if filter_hint.get("having_count") == "*":
+        hints.append("- Use COUNT(*) in HAVING unless a specific column is requested.")
+    if filter_hint.get("group_by_primary"):
+        hints.append("- When grouping, use the primary field (e.g., name) not ID fields.")
+    if filter_hint.get("use_count_star"):
+        hints.append("- Use COUNT(*) unless the question refers to getting unique values by saying distinct, different and unique for example.")
+    if filter_hint.get("use_count_distinct"):
+        hints.append("- Use COUNT(DISTINCT column) because the question asks for different or unique values.")
+    if not filter_hint.get("allow_aliases"):
+        hints.append("- Do NOT use table/column aliases like AS or T1 unless absolutely needed.")
+    if not filter_hint.get("allow_join"):
+        hints.append("- Avoid JOIN unless values from multiple tables are needed.")
+
+    return "\n".join(hints)
+
+
+def select_few_shot_examples(user_question):
+    """Nearest training examples when the few-shot index is built, else the static list."""
+    index = get_few_shot_index()
+    if index is None:
+        return FEW_SHOT_EXAMPLES.split("\n\n")
+    return index.select(user_question, hardness=FEW_SHOT_HARDNESS)
+
+
+def build_rag_prompt(db_id, user_question, filter_hint=None, schema_chunks=None, budget=PROMPT_TOKEN_BUDGET,
+                     feedback=""):
+    """
+    Return the generation prompt as a BudgetedPrompt (text plus per-section token counts).
+    `feedback` describes what was wrong with a previous attempt (see self_correction).
+    """
+    if schema_chunks is None:
+        schema_chunks = retrieve_schema_chunks(db_id, user_question)
+
+    fixed = {
+        "rules": SQL_RULES,
+        "hints": build_hint_block(filter_hint),
+        "question": user_question,
+        "feedback": feedback,
+    }
+    return build_prompt(
+        render_prompt, fixed, schema_chunks, select_few_shot_examples(user_question),
+        format_schema_for_prompt, budget, format_joins=lambda chunks: format_join_keys(db_id, chunks),
+    )
+
+
+def answer_sql(db_id, sql_query):
+    """Validate and execute the generated SQL and format the answer."""
+    if not sql_query:
+        print(" No SQL generated")
+        return "SQL generation failed", "( GPT failed to generate a valid SELECT query.)"
+
+    try:
+        error = validate_sql(db_id, sql_query)
+    except Exception as e:
+        print(f" Skipping validation: {e}")
+        error = None
+    if error is not None:
+        print(f" Rejected before execution: {error}")
+        return sql_query, f"[Validation Error] {format_validation_error(error)}"
+
+    return sql_query, format_answer(execute_sql_query(db_id, sql_query), sql_query)
+
+
+def format_answer(rows, sql_query):
+    answer = convert_sql_to_answer(rows, sql_query)
+    print(f"\n Raw answer type: {type(answer)} — value: {answer}")
+
+    if not answer:
+        answer = "(No result returned)"
+    elif not isinstance(answer, str):
+        answer = str(answer)
+    return answer
+
+
+def answer_by_vote(db_id, candidates, prompt_tokens, completion_tokens, generation_seconds):
+    """Answer with the candidate SQL whose result most candidates agree on."""
+    sqls = [sql for sql in (clean_sql(candidate.sql) for candidate in candidates) if sql]
+    t0 = time.perf_counter()
+    sql_query, result, votes, valid, clusters = self_consistency.vote(db_id, sqls)
+    self_consistency.record(
+        len(candidates), valid, votes, clusters, prompt_tokens, completion_tokens,
+        generation_seconds, time.perf_counter() - t0,
+    )
+    if sql_query is None:
+        # Every candidate failed: report the first one's error for the correction loop
+        return answer_sql(db_id, sqls[0] if sqls else None)
+    return sql_query, format_answer(result, sql_query)
+
+
+def run_query(db_id, user_question, filter_hint=None, schema_chunks=None, feedback=""):
+    try:
+        prompt = build_rag_prompt(db_id, user_question, filter_hint, schema_chunks, feedback=feedback)
+        print(f"\n Prompt: {prompt.summary()}")
+
+        # Corrections already carry feedback about one query; only vote on first attempts
+        if not feedback and self_consistency.enabled_for(user_question, filter_hint):
+            t0 = time.perf_counter()
+            candidates, prompt_tokens, completion_tokens = run_gpt4_candidates(
+                prompt.text, GeneratedSQL, self_consistency.N_CANDIDATES
+            )
+            return answer_by_vote(
+                db_id, candidates, prompt_tokens, completion_tokens, time.perf_counter() - t0
+            )
+
+        generated, token_usage = run_gpt4_structured(prompt.text, GeneratedSQL)
+        print("\n GPT Output:\n", generated)
+        print(f"\n Token usage: {token_usage}")
 
-        if not answer:
-            answer = "(No result returned)"
-        elif not isinstance(answer, str):
-            answer = str(answer)
-        return sql_query, answer
+        return answer_sql(db_id, clean_sql(generated.sql) if generated else None)
 
     except Exception as e:
         print(f"[ERROR] Exception in run_query: {e}")
@@ -220,30 +306,49 @@ SQL:
         return "SQL generation failed", f"[Error] {str(e)}"
 
 
+async def run_query_async(db_id, user_question, filter_hint=None, schema_chunks=None, feedback=""):
+    """Same as run_query, with retrieval and SQLite work moved off the event loop."""
+    try:
+        prompt = await asyncio.to_thread(
+            build_rag_prompt, db_id, user_question, filter_hint, schema_chunks, feedback=feedback
+        )
+        print(f"\n Prompt: {prompt.summary()}")
+
+        use_vote = not feedback and await asyncio.to_thread(
+            self_consistency.enabled_for, user_question, filter_hint
+        )
+        if use_vote:
+            t0 = time.perf_counter()
+            candidates, prompt_tokens, completion_tokens = await run_gpt4_candidates_async(
+                prompt.text, GeneratedSQL, self_consistency.N_CANDIDATES
+            )
+            return await asyncio.to_thread(
+                answer_by_vote, db_id, candidates, prompt_tokens, completion_tokens, time.perf_counter() - t0
+            )
+
+        generated, token_usage = await run_gpt4_structured_async(prompt.text, GeneratedSQL)
+        print("\n GPT Output:\n", generated)
+        print(f"\n Token usage: {token_usage}")
+
+        return await asyncio.to_thread(answer_sql, db_id, clean_sql(generated.sql) if generated else None)
+
+    except Exception as e:
+        print(f"[ERROR] Exception in run_query_async: {e}")
+
+        return "SQL generation failed", f"[Error] {str(e)}"
+
+
 if __name__ == "__main__":
     try:
         user_question = input("Enter your question: ")
         t0 = time.time()
-        question_embedding = model.encode(user_question, convert_to_tensor=True)
 
         if len(sys.argv) == 1:
-            relevance_scores = []
-
-            for db_id in list_databases():
-                embedding_path = os.path.join(EMBEDDING_DIR, f"{db_id}.pt")
-                if not os.path.exists(embedding_path):
-                    continue
-                try:
-                    schema_embedding = torch.load(embedding_path)
-                    score = util.pytorch_cos_sim(question_embedding, schema_embedding).item()
-                    relevance_scores.append((score, db_id))
-                except Exception as e:
-                    print(f" Skipping {db_id}: {e}")
-
-            top_dbs = sorted(relevance_scores, reverse=True)[:3]
-            
-
-            for _, db_id in top_dbs:
+            question_embedding = encode_query(user_question)
+            top_dbs = get_routing_index().top_k(question_embedding, k=3)
+            print(f" Routed to: {top_dbs}")
+
+            for db_id, _ in top_dbs:
                 run_query(db_id, user_question)
 
         else:
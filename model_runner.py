@@ -1,28 +1,282 @@
-from openai import OpenAI
+import asyncio
+import json
+import threading
+from openai import OpenAI, AsyncOpenAI, ContentFilterFinishReasonError, LengthFinishReasonError
+from pydantic import ValidationError
 from config import OPENAI_API_KEY
+from response_cache import get_response_cache, FORCE_REFRESH
 
-client = OpenAI(api_key=OPENAI_API_KEY)
+MODEL = "gpt-4o-mini"
+TEMPERATURE = 0.3
+# Sampling temperature for multi-candidate generation; candidates need some diversity
+CANDIDATE_TEMPERATURE = 0.7
+# The SDK retries 429/5xx responses with exponential backoff and honours Retry-After.
+MAX_RETRIES = 5
+
+client = OpenAI(api_key=OPENAI_API_KEY, max_retries=MAX_RETRIES)
+async_client = AsyncOpenAI(api_key=OPENAI_API_KEY, max_retries=MAX_RETRIES)
+
+
+def _cached_response(prompt, refresh):
+    cache = get_response_cache()
+    if cache is None or refresh or FORCE_REFRESH:
+        return None
+    return cache.get(MODEL, TEMPERATURE, prompt)
+
+
+def _store_response(prompt, content, total_tokens):
+    cache = get_response_cache()
+    if cache is not None:
+        cache.put(MODEL, TEMPERATURE, prompt, content, total_tokens)
+
+
+def run_gpt4(prompt, refresh=False):
+    """
+    Run one chat completion. Identical prompts are served from the response cache
+    (reported as 0 tokens) unless `refresh` or TEXT2SQL_REFRESH_CACHE=1 is set.
+    """
+    cached = _cached_response(prompt, refresh)
+    if cached is not None:
+        return cached[0], 0
 
-def run_gpt4(prompt):
     response = client.chat.completions.create(
-        model="gpt-4o-mini"
-,
+        model=MODEL,
         messages=[{"role": "user", "content": prompt}],
-        temperature=0.3
+        temperature=TEMPERATURE
     )
     content = response.choices[0].message.content.strip()
     usage = response.usage
     total_tokens = usage.prompt_tokens + usage.completion_tokens
+    _store_response(prompt, content, total_tokens)
     return content, total_tokens
 
 
-def convert_sql_to_answer(rows, query):
+# The async variants run response-cache reads and writes (SQLite) in a worker thread,
+# so a cache lookup never blocks the event loop serving other requests.
+
+async def run_gpt4_async(prompt, refresh=False):
+    cached = await asyncio.to_thread(_cached_response, prompt, refresh)
+    if cached is not None:
+        return cached[0], 0
+
+    response = await async_client.chat.completions.create(
+        model=MODEL,
+        messages=[{"role": "user", "content": prompt}],
+        temperature=TEMPERATURE
+    )
+    content = response.choices[0].message.content.strip()
+    usage = response.usage
+    total_tokens = usage.prompt_tokens + usage.completion_tokens
+    await asyncio.to_thread(_store_response, prompt, content, total_tokens)
+    return content, total_tokens
+
+
+_structured_lock = threading.Lock()
+_structured_stats = {}
+
+
+def _count(schema, event):
+    with _structured_lock:
+        counters = _structured_stats.setdefault(
+            schema.__name__, {"calls": 0, "cache_hits": 0, "parse_failures": 0, "refusals": 0}
+        )
+        counters[event] += 1
+
+
+def _structured_key(prompt, schema):
+    # Cached under a distinct key so a free-form response is never validated as JSON
+    return f"{prompt}\x00response_format={schema.__name__}"
+
+
+def _cached_structured(prompt, schema, refresh):
+    cached = _cached_response(_structured_key(prompt, schema), refresh)
+    if cached is None:
+        return None
+    try:
+        return schema.model_validate_json(cached[0])
+    except ValidationError:
+        _count(schema, "parse_failures")
+        return None
+
+
+def _parsed_result(prompt, schema, response):
+    message = response.choices[0].message
+    usage = response.usage
+    total_tokens = usage.prompt_tokens + usage.completion_tokens
+    if message.refusal:
+        print(f" Model refused to answer: {message.refusal}")
+        _count(schema, "refusals")
+        return None, total_tokens
+    if message.parsed is None:
+        _count(schema, "parse_failures")
+        return None, total_tokens
+    _store_response(_structured_key(prompt, schema), message.content, total_tokens)
+    return message.parsed, total_tokens
+
+
+def run_gpt4_structured(prompt, schema, refresh=False):
+    """
+    Run one chat completion constrained to the JSON schema of `schema` (a pydantic
+    model) and return (instance of `schema`, total tokens). The instance is None when
+    the model refused or its output did not validate; both are counted in stats().
+    """
+    _count(schema, "calls")
+    cached = _cached_structured(prompt, schema, refresh)
+    if cached is not None:
+        _count(schema, "cache_hits")
+        return cached, 0
+
+    try:
+        response = client.beta.chat.completions.parse(
+            model=MODEL,
+            messages=[{"role": "user", "content": prompt}],
+            temperature=TEMPERATURE,
+            response_format=schema,
+        )
+    except (LengthFinishReasonError, ContentFilterFinishReasonError, ValidationError) as e:
+        print(f" Structured output for {schema.__name__} could not be parsed: {e}")
+        _count(schema, "parse_failures")
+        return None, 0
+    return _parsed_result(prompt, schema, response)
+
+
+async def run_gpt4_structured_async(prompt, schema, refresh=False):
+    _count(schema, "calls")
+    cached = await asyncio.to_thread(_cached_structured, prompt, schema, refresh)
+    if cached is not None:
+        _count(schema, "cache_hits")
+        return cached, 0
+
+    try:
+        response = await async_client.beta.chat.completions.parse(
+            model=MODEL,
+            messages=[{"role": "user", "content": prompt}],
+            temperature=TEMPERATURE,
+            response_format=schema,
+        )
+    except (LengthFinishReasonError, ContentFilterFinishReasonError, ValidationError) as e:
+        print(f" Structured output for {schema.__name__} could not be parsed: {e}")
+        _count(schema, "parse_failures")
+        return None, 0
+    return await asyncio.to_thread(_parsed_result, prompt, schema, response)
+
+
+def _cached_candidates(prompt, schema, n, temperature, refresh):
+    cache = get_response_cache()
+    if cache is None or refresh or FORCE_REFRESH:
+        return None
+    cached = cache.get(MODEL, temperature, f"{_structured_key(prompt, schema)}\x00n={n}")
+    if cached is None:
+        return None
+    try:
+        return [schema.model_validate_json(content) for content in json.loads(cached[0])]
+    except (ValidationError, ValueError):
+        _count(schema, "parse_failures")
+        return None
+
+
+def _parsed_candidates(prompt, schema, n, temperature, response):
+    usage = response.usage
+    parsed = []
+    contents = []
+    for choice in response.choices:
+        if choice.message.refusal:
+            _count(schema, "refusals")
+        elif choice.message.parsed is None:
+            _count(schema, "parse_failures")
+        else:
+            parsed.append(choice.message.parsed)
+            contents.append(choice.message.content)
+    cache = get_response_cache()
+    if cache is not None and contents:
+        cache.put(MODEL, temperature, f"{_structured_key(prompt, schema)}\x00n={n}", json.dumps(contents),
+                  usage.prompt_tokens + usage.completion_tokens)
+    return parsed, usage.prompt_tokens, usage.completion_tokens
+
+
+def run_gpt4_candidates(prompt, schema, n, temperature=CANDIDATE_TEMPERATURE, refresh=False):
+    """
+    Sample `n` structured completions of one prompt in a single request (the `n`
+    parameter: the prompt is billed once). Returns (parsed candidates, prompt tokens,
+    completion tokens); cached responses report 0 tokens.
+    """
+    _count(schema, "calls")
+    cached = _cached_candidates(prompt, schema, n, temperature, refresh)
+    if cached is not None:
+        _count(schema, "cache_hits")
+        return cached, 0, 0
+
+    try:
+        response = client.beta.chat.completions.parse(
+            model=MODEL,
+            messages=[{"role": "user", "content": prompt}],
+            temperature=temperature,
+            n=n,
+            response_format=schema,
+        )
+    except (LengthFinishReasonError, ContentFilterFinishReasonError, ValidationError) as e:
+        print(f" Structured output for {schema.__name__} could not be parsed: {e}")
+        _count(schema, "parse_failures")
+        return [], 0, 0
+    return _parsed_candidates(prompt, schema, n, temperature, response)
+
+
+async def run_gpt4_candidates_async(prompt, schema, n, temperature=CANDIDATE_TEMPERATURE, refresh=False):
+    _count(schema, "calls")
+    cached = await asyncio.to_thread(_cached_candidates, prompt, schema, n, temperature, refresh)
+    if cached is not None:
+        _count(schema, "cache_hits")
+        return cached, 0, 0
+
+    try:
+        response = await async_client.beta.chat.completions.parse(
+            model=MODEL,
+            messages=[{"role": "user", "content": prompt}],
+            temperature=temperature,
+            n=n,
+            response_format=schema,
+        )
+    except (LengthFinishReasonError, ContentFilterFinishReasonError, ValidationError) as e:
+        print(f" Structured output for {schema.__name__} could not be parsed: {e}")
+        _count(schema, "parse_failures")
+        return [], 0, 0
+    return await asyncio.to_thread(_parsed_candidates, prompt, schema, n, temperature, response)
+
+
+def stats():
+    with _structured_lock:
+        return {name: dict(counters) for name, counters in _structured_stats.items()}
+
+
+MAX_ANSWER_ROWS = 100
+
+
+def convert_sql_to_answer(rows, query, max_rows=MAX_ANSWER_ROWS):
     if isinstance(rows, str):  
         return rows
 
+    # db_pool.ResultSet: the rows kept in memory plus the total the query produced
+    total_count = getattr(rows, "total_count", None)
+    truncated = getattr(rows, "truncated", False)
+    rows = getattr(rows, "rows", rows)
+    if total_count is None and not truncated:
+        total_count = len(rows)
+
     if not rows:
         return "The result is empty."
 
+    if len(rows) > max_rows:
+        rows = rows[:max_rows]
+        truncated = True
+
+    answer = _format_rows(rows)
+    if truncated:
+        total = total_count if total_count is not None else f"more than {len(rows)}"
+        answer += f"\n... (truncated: showing {len(rows)} of {total} rows)"
+    return answer
+
+
+def _format_rows(rows):
     # Single row, single column
     if len(rows) == 1 and len(rows[0]) == 1:
         return f"The result is: {rows[0][0]}."
@@ -0,0 +1,180 @@
+import os
+import threading
+
+# Encoding of the gpt-4o model family; counts are only used for budgeting, so a
+# rough estimate is acceptable when tiktoken or its encoding file is unavailable.
+ENCODING_NAME = "o200k_base"
+CHARS_PER_TOKEN = 4
+PROMPT_TOKEN_BUDGET = int(os.environ.get("TEXT2SQL_PROMPT_BUDGET", "3000"))
+# Trimming never goes below these
+MIN_SCHEMA_CHUNKS = 2
+MIN_FEW_SHOT_EXAMPLES = 2
+SAMPLE_ROWS_MARKER = "\nSample rows:"
+
+_encoding = None
+_encoding_lock = threading.Lock()
+
+
+def _get_encoding():
+    global _encoding
+    if _encoding is None:
+        with _encoding_lock:
+            if _encoding is None:
+                try:
+                    import tiktoken
+                    _encoding = tiktoken.get_encoding(ENCODING_NAME)
+                except Exception as e:
+                    print(f" tiktoken unavailable ({type(e).__name__}), estimating tokens from length")
+                    _encoding = False
+    return _encoding
+
+
+def count_tokens(text):
+    if not text:
+        return 0
+    encoding = _get_encoding()
+    if encoding:
+        return len(encoding.encode(text, disallowed_special=()))
+    return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+
+def strip_sample_rows(chunk):
+    """The chunk without its "Sample rows:" line and the "- " rows under it; later lines (e.g. Description) stay."""
+    if SAMPLE_ROWS_MARKER not in chunk:
+        return chunk
+    head, block = chunk.split(SAMPLE_ROWS_MARKER, 1)
+    # block starts with the rest of the marker line, then one "- " line per row
+    lines = block.split("\n")[1:]
+    while lines and lines[0].startswith("- "):
+        lines.pop(0)
+    return "\n".join([head] + lines)
+
+
+class BudgetedPrompt:
+    def __init__(self, text, sections, budget, dropped_samples, dropped_chunks, dropped_examples):
+        self.text = text
+        self.sections = sections
+        self.total = count_tokens(text)
+        self.budget = budget
+        self.dropped_samples = dropped_samples
+        self.dropped_chunks = dropped_chunks
+        self.dropped_examples = dropped_examples
+
+    @property
+    def trimmed(self):
+        return bool(self.dropped_samples or self.dropped_chunks or self.dropped_examples)
+
+    def summary(self):
+        sections = ", ".join(f"{name}={tokens}" for name, tokens in self.sections.items())
+        line = f"{self.total}/{self.budget} tokens ({sections})"
+        if self.trimmed:
+            line += (f", dropped {self.dropped_samples} sample blocks, {self.dropped_chunks} chunks, "
+                     f"{self.dropped_examples} examples")
+        return line
+
+
+def build_prompt(render, fixed, scored_chunks, examples, format_schema, budget=PROMPT_TOKEN_BUDGET,
+                 format_joins=None):
+    """
+    Assemble a prompt that fits in `budget` tokens.
+
+    `render(sections)` produces the prompt text from a dict holding the `fixed` sections
+    plus "few_shot" and "schema". `scored_chunks` are (chunk, retrieval score) pairs and
+    `examples` are few-shot examples, most useful first. When over budget, sample rows
+    go first, then whole chunks (both lowest score first), then trailing examples.
+    `format_joins(chunks)`, if given, returns the join keys connecting the tables of the
+    kept chunks; they are appended to the schema and counted as "join_keys".
+    """
+    fixed_tokens = {name: count_tokens(text) for name, text in fixed.items()}
+    # Template text around the sections (headers, blank lines)
+    overhead = count_tokens(render({**fixed, "few_shot": "", "schema": ""})) - sum(fixed_tokens.values())
+
+    # Retrieval returns chunks best first; trimming walks that order backwards.
+    chunks = [chunk for chunk, _ in sorted(scored_chunks, key=lambda pair: -pair[1])]
+    with_samples = [True] * len(chunks)
+    chunk_tokens = [count_tokens(format_schema([chunk])) for chunk in chunks]
+    stripped_tokens = [count_tokens(format_schema([strip_sample_rows(chunk)])) for chunk in chunks]
+    example_tokens = [count_tokens(example) for example in examples]
+    kept_chunks = len(chunks)
+    kept_examples = len(examples)
+    join_texts = {}
+
+    def joins(count):
+        if format_joins is None:
+            return ""
+        if count not in join_texts:
+            join_texts[count] = format_joins(chunks[:count])
+        return join_texts[count]
+
+    def estimate():
+        schema = sum(
+            (chunk_tokens[i] if with_samples[i] else stripped_tokens[i]) + 1 for i in range(kept_chunks)
+        )
+        few_shot = sum(example_tokens[:kept_examples]) + 2 * kept_examples
+        return overhead + sum(fixed_tokens.values()) + schema + count_tokens(joins(kept_chunks)) + few_shot
+
+    dropped_samples = 0
+    for i in reversed(range(len(chunks))):
+        if estimate() <= budget:
+            break
+        if stripped_tokens[i] < chunk_tokens[i]:
+            with_samples[i] = False
+            dropped_samples += 1
+
+    while kept_chunks > MIN_SCHEMA_CHUNKS and estimate() > budget:
+        kept_chunks -= 1
+
+    while kept_examples > MIN_FEW_SHOT_EXAMPLES and estimate() > budget:
+        kept_examples -= 1
+
+    schema_text = format_schema([
+        chunk if with_samples[i] else strip_sample_rows(chunk) for i, chunk in enumerate(chunks[:kept_chunks])
+    ])
+    join_keys = joins(kept_chunks)
+    few_shot = "\n\n".join(examples[:kept_examples])
+    sections = {**fixed, "few_shot": few_shot, "schema": "\n".join(filter(None, [schema_text, join_keys]))}
+    text = render(sections)
+
+    section_tokens = {**fixed_tokens, "few_shot": count_tokens(few_shot), "schema": count_tokens(schema_text)}
+    if format_joins is not None:
+        section_tokens["join_keys"] = count_tokens(join_keys)
+    prompt = BudgetedPrompt(
+        text, section_tokens, budget,
+        dropped_samples, len(chunks) - kept_chunks, len(examples) - kept_examples,
+    )
+    _record(prompt)
+    return prompt
+
+
+_stats_lock = threading.Lock()
+_prompts = 0
+_over_budget = 0
+_trimmed = 0
+_total_tokens = 0
+_section_tokens = {}
+
+
+def _record(prompt):
+    global _prompts, _over_budget, _trimmed, _total_tokens
+    with _stats_lock:
+        _prompts += 1
+        _total_tokens += prompt.total
+        if prompt.trimmed:
+            _trimmed += 1
+        if prompt.total > prompt.budget:
+            _over_budget += 1
+        for name, tokens in prompt.sections.items():
+            _section_tokens[name] = _section_tokens.get(name, 0) + tokens
+
+
+def stats():
+    with _stats_lock:
+        return {
+            "prompts": _prompts,
+            "trimmed": _trimmed,
+            "over_budget": _over_budget,
+            "avg_tokens": _total_tokens / _prompts if _prompts else 0.0,
+            "avg_section_tokens": {
+                name: tokens / _prompts for name, tokens in sorted(_section_tokens.items())
+            },
+        }
@@ -0,0 +1,162 @@
+import atexit
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+# Environment overrides:
+#   TEXT2SQL_RESPONSE_CACHE=0        disable the cache entirely
+#   TEXT2SQL_REFRESH_CACHE=1         ignore stored responses and overwrite them with fresh ones
+#   TEXT2SQL_RESPONSE_CACHE_PATH     location of the SQLite store
+CACHE_PATH = os.environ.get("TEXT2SQL_RESPONSE_CACHE_PATH", "response_cache.sqlite")
+CACHE_ENABLED = os.environ.get("TEXT2SQL_RESPONSE_CACHE", "1") != "0"
+FORCE_REFRESH = os.environ.get("TEXT2SQL_REFRESH_CACHE", "0") == "1"
+DEFAULT_TTL = 7 * 24 * 3600
+DEFAULT_MAX_ENTRIES = 50000
+# last_used updates of hits are written in batches, and expired rows swept, this often (s)
+TOUCH_FLUSH_INTERVAL = 5.0
+EXPIRE_INTERVAL = 60.0
+
+
+def prompt_key(model, temperature, prompt):
+    payload = f"{model}\x00{temperature!r}\x00{prompt}".encode("utf-8")
+    return hashlib.sha256(payload).hexdigest()
+
+
+class ResponseCache:
+    """
+    Content-addressed store of chat completions keyed on (model, temperature, prompt),
+    with TTL expiry and least-recently-used eviction beyond `max_entries`. Hits only
+    read: their last_used times are buffered and written in batches, and the entry
+    count is tracked as rows are added and removed instead of counted per store.
+    """
+    def __init__(self, path=CACHE_PATH, ttl=DEFAULT_TTL, max_entries=DEFAULT_MAX_ENTRIES):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            " key TEXT PRIMARY KEY, model TEXT, temperature REAL, content TEXT,"
+            " tokens INTEGER, created_at REAL, last_used REAL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS responses_last_used ON responses(last_used)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS responses_created_at ON responses(created_at)")
+        self._conn.commit()
+        self._entries = self._conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        self._touched = {}
+        self._last_flush = time.monotonic()
+        self._last_expiry = 0.0
+
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+
+    def get(self, model, temperature, prompt):
+        """Return (content, tokens) for a fresh stored response, else None."""
+        key = prompt_key(model, temperature, prompt)
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT content, tokens, created_at FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None or (self.ttl and now - row[2] > self.ttl):
+                self.misses += 1
+                return None
+            self._touched[key] = now
+            if time.monotonic() - self._last_flush >= TOUCH_FLUSH_INTERVAL:
+                self._flush_touched()
+                self._conn.commit()
+            self.hits += 1
+            return row[0], row[1]
+
+    def _flush_touched(self):
+        if self._touched:
+            self._conn.executemany(
+                "UPDATE responses SET last_used = ? WHERE key = ?",
+                [(used, key) for key, used in self._touched.items()],
+            )
+            self._touched.clear()
+        self._last_flush = time.monotonic()
+
+    def put(self, model, temperature, prompt, content, tokens):
+        key = prompt_key(model, temperature, prompt)
+        now = time.time()
+        with self._lock:
+            exists = self._conn.execute("SELECT 1 FROM responses WHERE key = ?", (key,)).fetchone()
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (key, model, temperature, content, tokens, now, now),
+            )
+            self._touched.pop(key, None)
+            if exists is None:
+                self._entries += 1
+            self.stores += 1
+            self._evict(now)
+            self._conn.commit()
+
+    def _evict(self, now):
+        if self.ttl and time.monotonic() - self._last_expiry >= EXPIRE_INTERVAL:
+            self._last_expiry = time.monotonic()
+            removed = self._conn.execute(
+                "DELETE FROM responses WHERE created_at < ?", (now - self.ttl,)
+            ).rowcount
+            self._entries -= removed
+            self.evictions += removed
+        if self.max_entries and self._entries > self.max_entries:
+            # least recently used must include the buffered hits
+            self._flush_touched()
+            removed = self._conn.execute(
+                "DELETE FROM responses WHERE key IN ("
+                " SELECT key FROM responses ORDER BY last_used ASC LIMIT ?)",
+                (self._entries - self.max_entries,),
+            ).rowcount
+            self._entries -= removed
+            self.evictions += removed
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM responses")
+            self._conn.commit()
+            self._touched.clear()
+            self._entries = 0
+
+    def flush(self):
+        """Write the buffered last_used times of recent hits."""
+        with self._lock:
+            self._flush_touched()
+            self._conn.commit()
+
+    def stats(self):
+        with self._lock:
+            entries = self._entries
+        lookups = self.hits + self.misses
+        return {
+            "entries": entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "stores": self.stores,
+            "evictions": self.evictions,
+        }
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_response_cache():
+    """Return the process-wide cache, or None when disabled via TEXT2SQL_RESPONSE_CACHE=0."""
+    global _cache
+    if not CACHE_ENABLED:
+        return None
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = ResponseCache()
+                atexit.register(_cache.flush)
+    return _cache
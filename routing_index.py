@@ -0,0 +1,203 @@
+import argparse
+import json
+import os
+import threading
+import time
+
+import numpy as np
+
+from embedding_service import encode, get_model
+from schema_utils import list_databases, SPIDER_PATH
+
+EMBEDDING_DIR = "schema_embeddings"
+ROUTING_INDEX_DIR = "schema_index"
+ROUTING_MATRIX = "routing.npy"
+ROUTING_IDS = "routing_ids.json"
+
+
+class RoutingIndex:
+    """
+    All database schema embeddings stacked into one L2-normalised (n_dbs, dim) matrix,
+    so a question is scored against every database with a single matrix-vector product.
+    """
+    def __init__(self, db_ids, matrix):
+        self.db_ids = list(db_ids)
+        self.matrix = matrix
+
+    @classmethod
+    def load(cls, index_dir=ROUTING_INDEX_DIR):
+        with open(os.path.join(index_dir, ROUTING_IDS), "r") as f:
+            db_ids = json.load(f)
+        matrix = np.load(os.path.join(index_dir, ROUTING_MATRIX), mmap_mode="r")
+        return cls(db_ids, matrix)
+
+    def save(self, index_dir=ROUTING_INDEX_DIR):
+        os.makedirs(index_dir, exist_ok=True)
+        np.save(os.path.join(index_dir, ROUTING_MATRIX), np.ascontiguousarray(self.matrix, dtype=np.float32))
+        with open(os.path.join(index_dir, ROUTING_IDS), "w") as f:
+            json.dump(self.db_ids, f)
+
+    def scores(self, question_embedding):
+        question_embedding = np.asarray(question_embedding, dtype=np.float32)
+        norm = np.linalg.norm(question_embedding)
+        if norm > 0:
+            question_embedding = question_embedding / norm
+        return self.matrix @ question_embedding
+
+    def top_k(self, question_embedding, k=3):
+        """Return [(db_id, cosine score), ...] for the k best-matching databases."""
+        scores = self.scores(question_embedding)
+        k = min(k, len(self.db_ids))
+        if k <= 0:
+            return []
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top], kind="stable")]
+        return [(self.db_ids[i], float(scores[i])) for i in top]
+
+    def top_k_batch(self, question_embeddings, k=3):
+        """Score a (n_questions, dim) block against all databases in one matrix product."""
+        question_embeddings = np.asarray(question_embeddings, dtype=np.float32)
+        norms = np.linalg.norm(question_embeddings, axis=1, keepdims=True)
+        question_embeddings = question_embeddings / np.where(norms > 0, norms, 1.0)
+        scores = question_embeddings @ self.matrix.T
+
+        k = min(k, len(self.db_ids))
+        if k <= 0:
+            return [[] for _ in range(len(scores))]
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        top_scores = np.take_along_axis(scores, top, axis=1)
+        order = np.argsort(-top_scores, axis=1, kind="stable")
+        top = np.take_along_axis(top, order, axis=1)
+        top_scores = np.take_along_axis(top_scores, order, axis=1)
+        return [
+            [(self.db_ids[i], float(score)) for i, score in zip(row, row_scores)]
+            for row, row_scores in zip(top, top_scores)
+        ]
+
+
+def build_routing_index(embedding_dir=EMBEDDING_DIR, spider_path=SPIDER_PATH):
+    """Stack schema_embeddings/*.pt into a RoutingIndex (requires torch)."""
+    import torch
+
+    available = sorted(name[:-3] for name in os.listdir(embedding_dir) if name.endswith(".pt"))
+    if os.path.isdir(spider_path):
+        installed = set(list_databases(spider_path))
+        available = [db_id for db_id in available if db_id in installed]
+
+    db_ids = []
+    rows = []
+    for db_id in available:
+        try:
+            embedding = torch.load(os.path.join(embedding_dir, f"{db_id}.pt"), map_location="cpu")
+            rows.append(np.asarray(embedding, dtype=np.float32).reshape(-1))
+            db_ids.append(db_id)
+        except Exception as e:
+            print(f" Skipping {db_id}: {e}")
+
+    matrix = np.vstack(rows)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    matrix /= np.where(norms > 0, norms, 1.0)
+    return RoutingIndex(db_ids, matrix)
+
+
+def _is_stale(index_dir, embedding_dir):
+    matrix_path = os.path.join(index_dir, ROUTING_MATRIX)
+    if not os.path.exists(matrix_path) or not os.path.exists(os.path.join(index_dir, ROUTING_IDS)):
+        return True
+    built_at = os.path.getmtime(matrix_path)
+    return any(
+        os.path.getmtime(os.path.join(embedding_dir, name)) > built_at
+        for name in os.listdir(embedding_dir) if name.endswith(".pt")
+    )
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def get_routing_index(index_dir=ROUTING_INDEX_DIR, embedding_dir=EMBEDDING_DIR):
+    """Load the persisted routing matrix once per process, rebuilding it if the .pt files changed."""
+    global _index
+    if _index is None:
+        with _index_lock:
+            if _index is None:
+                if _is_stale(index_dir, embedding_dir):
+                    print(" Building routing index from schema embeddings...")
+                    build_routing_index(embedding_dir).save(index_dir)
+                _index = RoutingIndex.load(index_dir)
+    return _index
+
+
+def route_questions(questions, k=3, batch_size=256, index=None):
+    """Route many questions at once; returns one [(db_id, score), ...] list per question."""
+    index = index or get_routing_index()
+    routes = []
+    for start in range(0, len(questions), batch_size):
+        batch = questions[start:start + batch_size]
+        routes.extend(index.top_k_batch(encode(batch, batch_size=batch_size), k=k))
+    return routes
+
+
+def routing_report(routes, gold_db_ids):
+    """Top-1 / top-k accuracy and mean reciprocal rank of the routes against gold db_ids."""
+    total = len(gold_db_ids)
+    top1 = topk = 0
+    reciprocal_ranks = 0.0
+    for route, gold in zip(routes, gold_db_ids):
+        ranked = [db_id for db_id, _ in route]
+        if ranked and ranked[0] == gold:
+            top1 += 1
+        if gold in ranked:
+            topk += 1
+            reciprocal_ranks += 1.0 / (ranked.index(gold) + 1)
+    return {
+        "count": total,
+        "top1_accuracy": top1 / total if total else 0.0,
+        "topk_accuracy": topk / total if total else 0.0,
+        "mrr": reciprocal_ranks / total if total else 0.0,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build the routing index or route a question file in batch.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("build", help="stack schema_embeddings/*.pt into the routing matrix")
+    route_parser = subparsers.add_parser("route", help="route every question of a Spider-style json file")
+    route_parser.add_argument("--questions", default=os.path.join("spider", "dev.json"))
+    route_parser.add_argument("--k", type=int, default=3)
+    route_parser.add_argument("--batch-size", type=int, default=256)
+    route_parser.add_argument("--out", default=None, help="optional jsonl file for per-question routes")
+    args = parser.parse_args()
+
+    if args.command == "build":
+        index = build_routing_index()
+        index.save()
+        print(f" Routing index: {len(index.db_ids)} databases -> {os.path.join(ROUTING_INDEX_DIR, ROUTING_MATRIX)}")
+    else:
+        with open(args.questions, "r", encoding="utf-8") as f:
+            items = json.load(f)
+        questions = [item["question"] for item in items]
+
+        t0 = time.time()
+        index = get_routing_index()
+        get_model()
+        t1 = time.time()
+        routes = route_questions(questions, k=args.k, batch_size=args.batch_size, index=index)
+        elapsed = time.time() - t1
+
+        if args.out:
+            with open(args.out, "w", encoding="utf-8") as f:
+                for item, route in zip(items, routes):
+                    f.write(json.dumps({
+                        "question": item["question"],
+                        "db_id": item.get("db_id"),
+                        "routes": [{"db_id": db_id, "score": score} for db_id, score in route],
+                    }) + "\n")
+
+        print(f" Routed {len(questions)} questions in {elapsed:.2f}s "
+              f"({len(questions) / elapsed if elapsed else float('inf'):.1f} questions/sec, setup {t1 - t0:.2f}s)")
+        if all("db_id" in item for item in items):
+            report = routing_report(routes, [item["db_id"] for item in items])
+            print(f" top-1 accuracy: {report['top1_accuracy']:.3f}")
+            print(f" top-{args.k} accuracy: {report['topk_accuracy']:.3f}")
+            print(f" MRR@{args.k}: {report['mrr']:.3f}")
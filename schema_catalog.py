@@ -0,0 +1,133 @@
+import json
+import os
+import threading
+import time
+
+from schema_utils import build_schema_chunks
+from description_utils import enrich_schema_with_descriptions
+
+TABLES_PATH = os.path.join("spider", "tables.json")
+DESCRIPTIONS_PATH = "descriptions.json"
+
+# Source files are only re-stat'ed this often, so warm requests do no file I/O at all.
+RECHECK_INTERVAL = 2.0
+
+
+def _mtime(path):
+    try:
+        return os.path.getmtime(path)
+    except OSError:
+        return None
+
+
+class SchemaCatalog:
+    """
+    Process-wide cache of tables.json, descriptions.json and the enriched
+    schema chunks of every database, invalidated when a source file's mtime changes.
+    """
+    def __init__(self, tables_path=TABLES_PATH, descriptions_path=DESCRIPTIONS_PATH,
+                 recheck_interval=RECHECK_INTERVAL):
+        self.tables_path = tables_path
+        self.descriptions_path = descriptions_path
+        self.recheck_interval = recheck_interval
+
+        self._lock = threading.RLock()
+        self._schemas = {}
+        self._descriptions = {}
+        self._source_mtimes = (None, None)
+        self._chunks = {}
+        self._last_check = 0.0
+
+        self.hits = 0
+        self.misses = 0
+        self.reloads = 0
+
+    def _refresh_sources(self):
+        now = time.monotonic()
+        if self._schemas and now - self._last_check < self.recheck_interval:
+            return
+        self._last_check = now
+
+        mtimes = (_mtime(self.tables_path), _mtime(self.descriptions_path))
+        if self._schemas and mtimes == self._source_mtimes:
+            return
+
+        with open(self.tables_path, "r") as f:
+            self._schemas = {entry["db_id"]: entry for entry in json.load(f)}
+        if mtimes[1] is not None:
+            with open(self.descriptions_path, "r") as f:
+                self._descriptions = json.load(f)
+        else:
+            self._descriptions = {}
+
+        self._source_mtimes = mtimes
+        self._chunks.clear()
+        self.reloads += 1
+
+    def db_ids(self):
+        with self._lock:
+            self._refresh_sources()
+            return sorted(self._schemas)
+
+    def get_schema(self, db_id):
+        """Return the raw tables.json entry for `db_id`."""
+        with self._lock:
+            self._refresh_sources()
+            db_schema = self._schemas.get(db_id)
+        if not db_schema:
+            raise ValueError(f"Database schema '{db_id}' not found.")
+        return db_schema
+
+    def get_descriptions(self):
+        with self._lock:
+            self._refresh_sources()
+            return self._descriptions
+
+    def get_chunks(self, db_id, db_path):
+        """
+        Return the description-enriched schema chunks of `db_id`, building them once.
+        The database itself is not watched: like the pooled connections, it is treated as
+        immutable while the service runs, so replacing one needs a restart.
+        """
+        with self._lock:
+            self._refresh_sources()
+            cached = self._chunks.get(db_id)
+            if cached is not None:
+                self.hits += 1
+                return list(cached)
+
+            self.misses += 1
+            db_schema = self.get_schema(db_id)
+            chunks = build_schema_chunks(db_schema, db_path)
+            enriched = enrich_schema_with_descriptions(chunks, db_id, self._descriptions)
+            self._chunks[db_id] = enriched
+            return list(enriched)
+
+    def invalidate(self, db_id=None):
+        with self._lock:
+            if db_id is None:
+                self._chunks.clear()
+            else:
+                self._chunks.pop(db_id, None)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "reloads": self.reloads,
+                "cached_databases": len(self._chunks),
+            }
+
+
+_catalog = None
+_catalog_lock = threading.Lock()
+
+
+def get_catalog():
+    global _catalog
+    if _catalog is None:
+        with _catalog_lock:
+            if _catalog is None:
+                _catalog = SchemaCatalog()
+    return _catalog
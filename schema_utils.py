@@ -1,6 +1,6 @@
 import json
 import os
-import sqlite3
+import db_pool
 
 SPIDER_PATH = "spider/database"
 
@@ -13,9 +13,13 @@ def load_schema_chunks(db_id, db_path):
     if not db_schema:
         raise ValueError(f"Database schema '{db_id}' not found.")
 
+    return build_schema_chunks(db_schema, db_path)
+
+def build_schema_chunks(db_schema, db_path):
+    """Build the table and foreign key chunks for one tables.json entry."""
     chunks = []
     table_map = {i: name for i, name in enumerate(db_schema["table_names_original"])}
-    conn = sqlite3.connect(db_path)
+    conn = db_pool.get_connection(db_schema["db_id"], db_path)
     cursor = conn.cursor()
 
     for table_idx, table_name in table_map.items():
@@ -34,7 +38,7 @@ def load_schema_chunks(db_id, db_path):
 
         chunks.append(chunk)
 
-    conn.close()
+    cursor.close()
 
     # Foreign key chunks
     for fk_pair in db_schema.get("foreign_keys", []):
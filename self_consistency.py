@@ -0,0 +1,162 @@
+import os
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import db_pool
+from sql_validator import validate_sql
+
+# "off", "hard" (only questions estimated hard/extra) or "always"
+SELF_CONSISTENCY = os.environ.get("TEXT2SQL_SELF_CONSISTENCY", "off")
+N_CANDIDATES = int(os.environ.get("TEXT2SQL_CANDIDATES", "5"))
+HARD_LEVELS = ("hard", "extra")
+VOTE_WORKERS = 8
+
+# Question-side stand-ins for the SQL components counted by Evaluator.eval_hardness
+ORDER_WORDS = re.compile(r"\b(most|least|highest|lowest|largest|smallest|top|oldest|youngest|order|sorted|ascending|descending)\b")
+GROUP_WORDS = re.compile(r"\b(each|per|every|for all)\b")
+LIKE_WORDS = re.compile(r"\b(contain|contains|containing|include|includes|substring)\b")
+OR_WORDS = re.compile(r"\b(or|either)\b")
+NESTED_WORDS = re.compile(r"\b(not|never|without|except|both|but|than the average|than average)\b")
+AGG_WORDS = re.compile(r"\b(average|mean|total|sum|maximum|minimum|how many|number of|count)\b")
+
+
+def heuristic_hardness(question, filter_hint=None):
+    """Spider hardness level from keyword counts, using eval_hardness's thresholds."""
+    q = question.lower()
+    filter_hint = filter_hint or {}
+    comp1 = sum([
+        bool(ORDER_WORDS.search(q)),
+        bool(GROUP_WORDS.search(q)),
+        bool(LIKE_WORDS.search(q)) or filter_hint.get("filter_style") == "LIKE",
+        bool(OR_WORDS.search(q)),
+        bool(filter_hint.get("allow_join")),
+    ])
+    comp2 = len(NESTED_WORDS.findall(q))
+    others = int(len(AGG_WORDS.findall(q)) > 1) + int(" and " in q)
+
+    if comp1 <= 1 and others == 0 and comp2 == 0:
+        return "easy"
+    if (others <= 2 and comp1 <= 1 and comp2 == 0) or (comp1 <= 2 and others < 2 and comp2 == 0):
+        return "medium"
+    if (others > 2 and comp1 <= 2 and comp2 == 0) or (2 < comp1 <= 3 and others <= 2 and comp2 == 0) or \
+            (comp1 <= 1 and others == 0 and comp2 <= 1):
+        return "hard"
+    return "extra"
+
+
+def estimate_hardness(question, filter_hint=None):
+    """Hardness voted by the nearest training questions when the few-shot index exists."""
+    from few_shot_index import get_few_shot_index
+    from embedding_service import encode_query
+    index = get_few_shot_index()
+    if index is not None and len(index):
+        return index.predict_hardness(encode_query(question))
+    return heuristic_hardness(question, filter_hint)
+
+
+def enabled_for(question, filter_hint=None, mode=None):
+    mode = mode or SELF_CONSISTENCY
+    if mode == "always":
+        return True
+    if mode == "hard":
+        return estimate_hardness(question, filter_hint) in HARD_LEVELS
+    return False
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor():
+    # Long-lived workers, so each keeps its pooled per-thread connections between votes
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=VOTE_WORKERS, thread_name_prefix="vote")
+    return _executor
+
+
+def _execute(db_id, sql):
+    try:
+        if validate_sql(db_id, sql) is not None:
+            return None
+        return db_pool.execute(db_id, sql)
+    except Exception as e:
+        print(f" Candidate failed: {e}")
+        return None
+
+
+def result_key(result):
+    """Result-set equality, ignoring row order."""
+    return result.truncated, tuple(sorted(repr(row) for row in result.rows))
+
+
+def vote(db_id, sqls):
+    """
+    Execute the candidate queries concurrently and cluster them by result set.
+    Returns (winning SQL, its ResultSet, votes for it, number of valid candidates,
+    number of clusters); the SQL and ResultSet are None when every candidate failed.
+    Ties go to the cluster whose first candidate the model ranked earliest.
+    """
+    distinct = list(dict.fromkeys(sqls))
+    results = dict(zip(distinct, _get_executor().map(lambda sql: _execute(db_id, sql), distinct)))
+
+    clusters = {}
+    for position, sql in enumerate(sqls):
+        result = results[sql]
+        if result is None:
+            continue
+        cluster = clusters.setdefault(result_key(result), {"first": position, "sql": sql, "votes": 0})
+        cluster["votes"] += 1
+
+    if not clusters:
+        return None, None, 0, 0, 0
+    best = max(clusters.values(), key=lambda cluster: (cluster["votes"], -cluster["first"]))
+    valid = sum(cluster["votes"] for cluster in clusters.values())
+    return best["sql"], results[best["sql"]], best["votes"], valid, len(clusters)
+
+
+_stats_lock = threading.Lock()
+_counters = {
+    "requests": 0,
+    "candidates": 0,
+    "valid_candidates": 0,
+    "unanimous": 0,
+    "prompt_tokens": 0,
+    "completion_tokens": 0,
+    "extra_completion_tokens": 0,
+    "generation_seconds": 0.0,
+    "vote_seconds": 0.0,
+}
+
+
+def record(n, valid, votes, clusters, prompt_tokens, completion_tokens, generation_seconds, vote_seconds):
+    """Called once per voted request; prints what the extra candidates cost."""
+    # A single completion would have cost about completion_tokens / n
+    extra_tokens = completion_tokens - completion_tokens // max(n, 1)
+    print(f" Self-consistency: {valid}/{n} valid candidates in {clusters} result groups, winner has {votes} votes; "
+          f"generation {generation_seconds:.2f}s, voting +{vote_seconds:.2f}s, "
+          f"+{extra_tokens} completion tokens")
+    with _stats_lock:
+        _counters["requests"] += 1
+        _counters["candidates"] += n
+        _counters["valid_candidates"] += valid
+        _counters["unanimous"] += int(valid > 0 and votes == valid)
+        _counters["prompt_tokens"] += prompt_tokens
+        _counters["completion_tokens"] += completion_tokens
+        _counters["extra_completion_tokens"] += extra_tokens
+        _counters["generation_seconds"] += generation_seconds
+        _counters["vote_seconds"] += vote_seconds
+
+
+def stats():
+    with _stats_lock:
+        requests = _counters["requests"]
+        return {
+            "mode": SELF_CONSISTENCY,
+            **_counters,
+            "avg_vote_seconds": _counters["vote_seconds"] / requests if requests else 0.0,
+            "avg_extra_completion_tokens": _counters["extra_completion_tokens"] / requests if requests else 0.0,
+        }
@@ -0,0 +1,115 @@
+import os
+import threading
+import time
+
+# Generation retries after the first attempt, and the wall time (seconds, from the
+# start of the first generation) a request may spend on them.
+MAX_CORRECTIONS = int(os.environ.get("TEXT2SQL_MAX_CORRECTIONS", "2"))
+# Each correction adds two graph steps (check_execution, repair_sql) to the ~8 of a
+# request without any; langgraph_workflow raises the recursion limit to match.
+GRAPH_STEPS = 10 + 2 * MAX_CORRECTIONS
+CORRECTION_LATENCY_BUDGET = float(os.environ.get("TEXT2SQL_CORRECTION_BUDGET", "20"))
+# An empty result is often legitimate, but is still worth one more look
+RETRY_ON_EMPTY = True
+
+EXECUTION_ERROR = "execution_error"
+VALIDATION_ERROR = "validation_error"
+EMPTY_RESULT = "empty_result"
+NO_SQL = "no_sql"
+# "[Error] ..." from an API failure (e.g. rate limiting) rather than a bad query: never
+# retried here (batch_runner retries whole requests), only stops the loop
+TRANSIENT_ERROR = "transient_error"
+
+
+def split_output(output):
+    """Split a generation output into (answer, SQL used)."""
+    answer, _, sql = (output or "").partition("\n\n SQL used:\n")
+    return answer.strip(), sql.strip()
+
+
+def retry_reason(output):
+    """Why the generated SQL deserves another attempt, or None."""
+    answer, sql = split_output(output)
+    if answer.startswith("[Validation Error]"):
+        return VALIDATION_ERROR
+    if answer.startswith("[Execution Error]"):
+        return EXECUTION_ERROR
+    if sql == "SQL generation failed":
+        return TRANSIENT_ERROR if answer.startswith("[Error]") else NO_SQL
+    if RETRY_ON_EMPTY and answer == "The result is empty.":
+        return EMPTY_RESULT
+    return None
+
+
+def outcome_rank(reason):
+    """How useful an attempt is when giving up: ran with rows > ran empty > failed > API error."""
+    if reason is None:
+        return 3
+    if reason == EMPTY_RESULT:
+        return 2
+    return 0 if reason == TRANSIENT_ERROR else 1
+
+
+def correction_feedback(output, reason):
+    """The prompt section telling the generator what went wrong with its last query."""
+    answer, sql = split_output(output)
+    if reason == VALIDATION_ERROR:
+        problem = f"It does not match the database schema: {answer.replace('[Validation Error]', '').strip()}"
+    elif reason == EXECUTION_ERROR:
+        problem = f"SQLite rejected it: {answer.replace('[Execution Error]', '').strip()}"
+    elif reason == EMPTY_RESULT:
+        problem = ("It returned no rows. Check table choice, join conditions and the exact "
+                   "spelling/casing of filter values. If no rows is the correct answer, return it unchanged.")
+    else:
+        problem = "It was not a single valid SELECT statement."
+    return f"\n\n Previous attempt:\n{sql}\n\n Problem:\n{problem}\nWrite a corrected query."
+
+
+def within_budget(attempt, generation_started, budget=CORRECTION_LATENCY_BUDGET):
+    """True when one more attempt, as slow as the average so far, still fits the budget."""
+    if generation_started is None or not budget:
+        return True
+    elapsed = time.monotonic() - generation_started
+    return elapsed + elapsed / (attempt + 1) <= budget
+
+
+_stats_lock = threading.Lock()
+_counters = {
+    "checked": 0,
+    "retried": 0,
+    "rescued": 0,
+    "unrescued": 0,
+    "stopped_attempts": 0,
+    "stopped_budget": 0,
+    "stopped_no_progress": 0,
+    "stopped_transient": 0,
+    "corrections": 0,
+}
+_reasons = {}
+
+
+def record_retry(reason):
+    with _stats_lock:
+        _counters["corrections"] += 1
+        _reasons[reason] = _reasons.get(reason, 0) + 1
+
+
+def record_outcome(attempt, reason, stop=None):
+    """Called once per request when the correction loop exits."""
+    with _stats_lock:
+        _counters["checked"] += 1
+        if attempt:
+            _counters["retried"] += 1
+            _counters["unrescued" if reason else "rescued"] += 1
+        if stop:
+            _counters[f"stopped_{stop}"] += 1
+
+
+def stats():
+    with _stats_lock:
+        retried = _counters["retried"]
+        return {
+            **_counters,
+            "rescue_rate": _counters["rescued"] / retried if retried else 0.0,
+            "reasons": dict(sorted(_reasons.items())),
+        }
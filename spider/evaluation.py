@@ -27,12 +27,20 @@ import traceback
 import argparse
 
 from process_sql import tokenize, get_schema, get_tables_with_alias, Schema, get_sql
+from exec_guard import GoldResultCache, QueryBudgetExceeded, execute_with_budget, open_readonly
+from parse_cache import PARSE_CACHE_PATH, configure_parse_cache, get_sql_cached, stats as parse_cache_stats
+from schema_registry import build_foreign_key_map, get_schema_registry
 import csv
+from concurrent.futures import ProcessPoolExecutor
 
 csv_path = "all_predictions_log.csv"
-with open(csv_path, "w", newline='') as f:
-    writer = csv.writer(f)
-    writer.writerow(["status", "db_name", "difficulty", "f1_score", "gold_sql", "predicted_sql"])
+CSV_HEADER = ["status", "db_name", "difficulty", "f1_score", "gold_sql", "predicted_sql"]
+
+# Budget for executing a predicted query in eval_exec_match; exceeding it counts as a mismatch
+EXEC_TIMEOUT = 30.0
+EXEC_MAX_ROWS = 200000
+# Gold results are cached here across runs ('' disables the cache)
+GOLD_CACHE_PATH = "gold_exec_cache.sqlite"
 
 # Flag to disable value evaluation
 DISABLE_VALUE = True
@@ -481,7 +489,120 @@ def print_scores(scores, etype):
             print("{:20} {:<20.3f} {:<20.3f} {:<20.3f} {:<20.3f} {:<20.3f}".format(type_, *this_scores))
 
 
-def evaluate(gold, predict, db_dir, etype, kmaps):
+EMPTY_SQL = {
+    "except": None,
+    "from": {
+        "conds": [],
+        "table_units": []
+    },
+    "groupBy": [],
+    "having": [],
+    "intersect": None,
+    "limit": None,
+    "orderBy": [],
+    "select": [
+        False,
+        []
+    ],
+    "union": None,
+    "where": []
+}
+
+LEVELS = ['easy', 'medium', 'hard', 'extra', 'all']
+PARTIAL_TYPES = ['select', 'select(no AGG)', 'where', 'where(no OP)', 'group(no Having)',
+                 'group', 'order', 'and/or', 'IUEN', 'keywords']
+
+# Schemas are read from sqlite once per database and process instead of once per pair.
+_schema_cache = {}
+
+
+def get_cached_schema(db):
+    schema = _schema_cache.get(db)
+    if schema is None:
+        schema = Schema(get_schema(db))
+        _schema_cache[db] = schema
+    return schema
+
+
+def get_eval_schema(db_name, db):
+    """Schema from the tables.json snapshot when evaluate() was given one, else from the sqlite file."""
+    registry = _worker_context.get('registry')
+    if registry is not None and db_name in registry:
+        return registry.schema(db_name)
+    return get_cached_schema(db)
+
+
+# Set once per worker by _init_worker so kmaps are not pickled with every pair.
+_worker_context = {}
+
+
+def _init_worker(db_dir, etype, kmaps, exec_options=None, parse_cache_path=PARSE_CACHE_PATH, tables_path=None):
+    registry = get_schema_registry(tables_path, db_dir) if tables_path else None
+    _worker_context.update(db_dir=db_dir, etype=etype, kmaps=kmaps, registry=registry)
+    if exec_options is not None:
+        configure_exec(**exec_options)
+    configure_parse_cache(parse_cache_path)
+
+
+def evaluate_pair(pair):
+    """Score one (prediction, gold) pair; returns a plain record that evaluate() merges."""
+    p, g = pair
+    db_dir = _worker_context['db_dir']
+    etype = _worker_context['etype']
+    kmaps = _worker_context['kmaps']
+    evaluator = Evaluator()
+
+    p_str = p[0]
+    g_str, db = g
+    db_name = db
+    db = os.path.join(db_dir, db, db + ".sqlite")
+    schema = get_eval_schema(db_name, db)
+    g_sql = get_sql_cached(schema, g_str, db_name)
+    hardness = evaluator.eval_hardness(g_sql)
+
+    eval_err = False
+    try:
+        # predictions change between runs, so they are only cached in memory
+        p_sql = get_sql_cached(schema, p_str, db_name, persist=False)
+    except:
+        # If p_sql is not valid, then we will use an empty sql to evaluate with the correct sql
+        p_sql = json.loads(json.dumps(EMPTY_SQL))
+        eval_err = True
+
+    # rebuild sql for value evaluation
+    kmap = kmaps[db_name]
+    g_valid_col_units = build_valid_col_units(g_sql['from']['table_units'], schema)
+    g_sql = rebuild_sql_val(g_sql)
+    g_sql = rebuild_sql_col(g_valid_col_units, g_sql, kmap)
+    p_valid_col_units = build_valid_col_units(p_sql['from']['table_units'], schema)
+    p_sql = rebuild_sql_val(p_sql)
+    p_sql = rebuild_sql_col(p_valid_col_units, p_sql, kmap)
+
+    record = {
+        'p_str': p_str,
+        'g_str': g_str,
+        'db_name': db_name,
+        'hardness': hardness,
+        'eval_err': eval_err,
+        'exec': None,
+        'exec_aborted': None,
+        'exact': None,
+        'partial': None,
+    }
+
+    if etype in ["all", "exec"]:
+        record['exec'], record['exec_aborted'] = exec_match_with_budget(db, p_str, g_str, p_sql, g_sql)
+
+    if etype in ["all", "match"]:
+        record['exact'] = evaluator.eval_exact_match(p_sql, g_sql)
+        record['partial'] = evaluator.partial_scores
+
+    return record
+
+
+def evaluate(gold, predict, db_dir, etype, kmaps, workers=1, exec_timeout=EXEC_TIMEOUT,
+             exec_max_rows=EXEC_MAX_ROWS, gold_cache_path=GOLD_CACHE_PATH, parse_cache_path=PARSE_CACHE_PATH,
+             tables_path=None):
     with open(gold) as f:
         glist = [l.strip().split('\t') for l in f.readlines() if len(l.strip()) > 0]
 
@@ -489,11 +610,9 @@ def evaluate(gold, predict, db_dir, etype, kmaps):
         plist = [l.strip().split('\t') for l in f.readlines() if len(l.strip()) > 0]
     # plist = [("select max(Share),min(Share) from performance where Type != 'terminal'", "orchestra")]
     # glist = [("SELECT max(SHARE) ,  min(SHARE) FROM performance WHERE TYPE != 'Live final'", "orchestra")]
-    evaluator = Evaluator()
 
-    levels = ['easy', 'medium', 'hard', 'extra', 'all']
-    partial_types = ['select', 'select(no AGG)', 'where', 'where(no OP)', 'group(no Having)',
-                     'group', 'order', 'and/or', 'IUEN', 'keywords']
+    levels = LEVELS
+    partial_types = PARTIAL_TYPES
     entries = []
     scores = {}
 
@@ -503,107 +622,100 @@ def evaluate(gold, predict, db_dir, etype, kmaps):
         for type_ in partial_types:
             scores[level]['partial'][type_] = {'acc': 0., 'rec': 0., 'f1': 0.,'acc_count':0,'rec_count':0}
 
+    exec_options = {'timeout': exec_timeout, 'max_rows': exec_max_rows, 'gold_cache_path': gold_cache_path}
+    pairs = list(zip(plist, glist))
+    if tables_path:
+        # build the snapshot (verified against db_dir) once here rather than in every worker
+        get_schema_registry(tables_path, db_dir)
+    if workers > 1:
+        # Pairs are sharded in contiguous chunks (dev files are grouped by db, so each
+        # worker mostly reuses its cached schemas); map() keeps the input order, so the
+        # merge below adds scores in exactly the same order as the serial path.
+        chunksize = max(1, len(pairs) // (workers * 4))
+        pool = ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                   initargs=(db_dir, etype, kmaps, exec_options, parse_cache_path, tables_path))
+        records = pool.map(evaluate_pair, pairs, chunksize=chunksize)
+    else:
+        pool = None
+        _init_worker(db_dir, etype, kmaps, exec_options, parse_cache_path, tables_path)
+        records = map(evaluate_pair, pairs)
+
     eval_err_num = 0
-    for p, g in zip(plist, glist):
-        p_str = p[0]
-        g_str, db = g
-        db_name = db
-        db = os.path.join(db_dir, db, db + ".sqlite")
-        schema = Schema(get_schema(db))
-        g_sql = get_sql(schema, g_str)
-        hardness = evaluator.eval_hardness(g_sql)
-        scores[hardness]['count'] += 1
-        scores['all']['count'] += 1
+    aborted = []
+    csv_file = open(csv_path, "w", newline='')
+    writer = csv.writer(csv_file)
+    writer.writerow(CSV_HEADER)
+    try:
+        for record in records:
+            p_str = record['p_str']
+            g_str = record['g_str']
+            db_name = record['db_name']
+            hardness = record['hardness']
+            scores[hardness]['count'] += 1
+            scores['all']['count'] += 1
+
+            if record['eval_err']:
+                eval_err_num += 1
+                print("eval_err_num:{}".format(eval_err_num))
+
+            if etype in ["all", "exec"]:
+                exec_score = record['exec']
+                if record['exec_aborted']:
+                    aborted.append((db_name, record['exec_aborted'], p_str))
+                if exec_score:
+                    scores[hardness]['exec'] += 1.0
+                    scores['all']['exec'] += 1.0
+
+            if etype in ["all", "match"]:
+                exact_score = record['exact']
+                partial_scores = record['partial']
+                f1_score = partial_scores.get("select", {}).get("f1", 0.0)
+
+                status = "correct" if exact_score == 1 else "wrong"
+
+                if status == "wrong":
+                    print("❌ WRONG PREDICTION")
+                else:
+                    print("✅ CORRECT PREDICTION")
 
-        try:
-            p_sql = get_sql(schema, p_str)
-        except:
-            # If p_sql is not valid, then we will use an empty sql to evaluate with the correct sql
-            p_sql = {
-            "except": None,
-            "from": {
-                "conds": [],
-                "table_units": []
-            },
-            "groupBy": [],
-            "having": [],
-            "intersect": None,
-            "limit": None,
-            "orderBy": [],
-            "select": [
-                False,
-                []
-            ],
-            "union": None,
-            "where": []
-            }
-            eval_err_num += 1
-            print("eval_err_num:{}".format(eval_err_num))
-
-        # rebuild sql for value evaluation
-        kmap = kmaps[db_name]
-        g_valid_col_units = build_valid_col_units(g_sql['from']['table_units'], schema)
-        g_sql = rebuild_sql_val(g_sql)
-        g_sql = rebuild_sql_col(g_valid_col_units, g_sql, kmap)
-        p_valid_col_units = build_valid_col_units(p_sql['from']['table_units'], schema)
-        p_sql = rebuild_sql_val(p_sql)
-        p_sql = rebuild_sql_col(p_valid_col_units, p_sql, kmap)
+                print(f"🔍 Difficulty: {hardness}")
+                print(f"🗂️ Database: {db_name}")
+                print(f"❓ Gold SQL:\n{g_str}")
+                print(f"🤖 Predicted SQL:\n{p_str}")
+                print("-" * 80)
 
-        if etype in ["all", "exec"]:
-            exec_score = eval_exec_match(db, p_str, g_str, p_sql, g_sql)
-            if exec_score:
-                scores[hardness]['exec'] += 1.0
-                scores['all']['exec'] += 1.0
-
-        if etype in ["all", "match"]:
-            exact_score = evaluator.eval_exact_match(p_sql, g_sql)
-            partial_scores = evaluator.partial_scores
-            f1_score = partial_scores.get("select", {}).get("f1", 0.0)
-
-            status = "correct" if exact_score == 1 else "wrong"
-
-            if status == "wrong":
-                print("❌ WRONG PREDICTION")
-            else:
-                print("✅ CORRECT PREDICTION")
-
-            print(f"🔍 Difficulty: {hardness}")
-            print(f"🗂️ Database: {db_name}")
-            print(f"❓ Gold SQL:\n{g_str}")
-            print(f"🤖 Predicted SQL:\n{p_str}")
-            print("-" * 80)
-
-            # Log to CSV
-            with open(csv_path, "a", newline='') as f:
-                writer = csv.writer(f)
+                # Log to CSV
                 writer.writerow([status, db_name, hardness, f"{f1_score:.2f}", g_str, p_str])
 
-
-            scores[hardness]['exact'] += exact_score
-            scores['all']['exact'] += exact_score
-            for type_ in partial_types:
-                if partial_scores[type_]['pred_total'] > 0:
-                    scores[hardness]['partial'][type_]['acc'] += partial_scores[type_]['acc']
-                    scores[hardness]['partial'][type_]['acc_count'] += 1
-                if partial_scores[type_]['label_total'] > 0:
-                    scores[hardness]['partial'][type_]['rec'] += partial_scores[type_]['rec']
-                    scores[hardness]['partial'][type_]['rec_count'] += 1
-                scores[hardness]['partial'][type_]['f1'] += partial_scores[type_]['f1']
-                if partial_scores[type_]['pred_total'] > 0:
-                    scores['all']['partial'][type_]['acc'] += partial_scores[type_]['acc']
-                    scores['all']['partial'][type_]['acc_count'] += 1
-                if partial_scores[type_]['label_total'] > 0:
-                    scores['all']['partial'][type_]['rec'] += partial_scores[type_]['rec']
-                    scores['all']['partial'][type_]['rec_count'] += 1
-                scores['all']['partial'][type_]['f1'] += partial_scores[type_]['f1']
-
-            entries.append({
-                'predictSQL': p_str,
-                'goldSQL': g_str,
-                'hardness': hardness,
-                'exact': exact_score,
-                'partial': partial_scores
-            })
+                scores[hardness]['exact'] += exact_score
+                scores['all']['exact'] += exact_score
+                for type_ in partial_types:
+                    if partial_scores[type_]['pred_total'] > 0:
+                        scores[hardness]['partial'][type_]['acc'] += partial_scores[type_]['acc']
+                        scores[hardness]['partial'][type_]['acc_count'] += 1
+                    if partial_scores[type_]['label_total'] > 0:
+                        scores[hardness]['partial'][type_]['rec'] += partial_scores[type_]['rec']
+                        scores[hardness]['partial'][type_]['rec_count'] += 1
+                    scores[hardness]['partial'][type_]['f1'] += partial_scores[type_]['f1']
+                    if partial_scores[type_]['pred_total'] > 0:
+                        scores['all']['partial'][type_]['acc'] += partial_scores[type_]['acc']
+                        scores['all']['partial'][type_]['acc_count'] += 1
+                    if partial_scores[type_]['label_total'] > 0:
+                        scores['all']['partial'][type_]['rec'] += partial_scores[type_]['rec']
+                        scores['all']['partial'][type_]['rec_count'] += 1
+                    scores['all']['partial'][type_]['f1'] += partial_scores[type_]['f1']
+
+                entries.append({
+                    'predictSQL': p_str,
+                    'goldSQL': g_str,
+                    'hardness': hardness,
+                    'exact': exact_score,
+                    'partial': partial_scores
+                })
+    finally:
+        csv_file.close()
+        if pool is not None:
+            pool.shutdown()
 
     for level in levels:
         if scores[level]['count'] == 0:
@@ -632,39 +744,88 @@ def evaluate(gold, predict, db_dir, etype, kmaps):
                         scores[level]['partial'][type_]['rec'] + scores[level]['partial'][type_]['acc'])
 
     print_scores(scores, etype)
+    print_aborted(aborted)
+    if pool is None:
+        print("\nParse cache: {}".format(parse_cache_stats()))
 
 
-def eval_exec_match(db, p_str, g_str, pred, gold):
+def print_aborted(aborted):
+    if not aborted:
+        return
+    print('\n================= ABORTED PREDICTIONS (EXECUTION BUDGET) =================')
+    print("{} predicted queries exceeded the execution budget and were scored as mismatches".format(len(aborted)))
+    for db_name, reason, p_str in aborted:
+        print("[{}] {}: {}".format(db_name, reason, p_str))
+
+
+# One read-only connection per database and process, reused across pairs
+_exec_connections = {}
+_gold_cache = None
+_gold_cache_path = None
+
+
+def configure_exec(timeout=EXEC_TIMEOUT, max_rows=EXEC_MAX_ROWS, gold_cache_path=GOLD_CACHE_PATH):
+    global EXEC_TIMEOUT, EXEC_MAX_ROWS, _gold_cache, _gold_cache_path
+    EXEC_TIMEOUT = timeout
+    EXEC_MAX_ROWS = max_rows
+    if gold_cache_path != _gold_cache_path:
+        _gold_cache = GoldResultCache(gold_cache_path) if gold_cache_path else None
+        _gold_cache_path = gold_cache_path
+
+
+def get_exec_connection(db):
+    conn = _exec_connections.get(db)
+    if conn is None:
+        conn = open_readonly(db)
+        _exec_connections[db] = conn
+    return conn
+
+
+def exec_match_with_budget(db, p_str, g_str, pred, gold):
     """
-    return 1 if the values between prediction and gold are matching
-    in the corresponding index. Currently not support multiple col_unit(pairs).
+    Like eval_exec_match, but returns (score, abort reason or None). The gold result
+    comes from the on-disk cache when available; the predicted query runs under the
+    EXEC_TIMEOUT / EXEC_MAX_ROWS budget.
     """
-    conn = sqlite3.connect(db)
-    cursor = conn.cursor()
+    conn = get_exec_connection(db)
+
+    q_res = _gold_cache.get(db, g_str) if _gold_cache is not None else None
+    if q_res is None:
+        try:
+            q_res = execute_with_budget(conn, g_str)
+        except sqlite3.Error as e:
+            print(f"⚠️ SQLite Execution Error: {e}")
+            return 0, None
+        if _gold_cache is not None:
+            _gold_cache.put(db, g_str, q_res)
+
     try:
-        cursor.execute(p_str)
-        p_res = cursor.fetchall()
+        # never let the row budget reject a prediction that is as large as the gold result
+        p_res = execute_with_budget(conn, p_str, EXEC_TIMEOUT, max(EXEC_MAX_ROWS, len(q_res)))
+    except QueryBudgetExceeded as e:
+        return False, str(e)
     except:
-        return False
+        return False, None
 
-    cursor.execute(g_str)
-    try:
-        q_res = cursor.fetchall()
-    except sqlite3.OperationalError as e:
-        print(f"⚠️ SQLite Execution Error: {e}")
-        return 0
+    p_val_units = [unit[1] for unit in pred['select'][1]]
+    q_val_units = [unit[1] for unit in gold['select'][1]]
+    return res_map(p_res, p_val_units) == res_map(q_res, q_val_units), None
 
 
-    def res_map(res, val_units):
-        rmap = {}
-        for idx, val_unit in enumerate(val_units):
-            key = tuple(val_unit[1]) if not val_unit[2] else (val_unit[0], tuple(val_unit[1]), tuple(val_unit[2]))
-            rmap[key] = [r[idx] for r in res]
-        return rmap
+def res_map(res, val_units):
+    rmap = {}
+    for idx, val_unit in enumerate(val_units):
+        key = tuple(val_unit[1]) if not val_unit[2] else (val_unit[0], tuple(val_unit[1]), tuple(val_unit[2]))
+        rmap[key] = [r[idx] for r in res]
+    return rmap
 
-    p_val_units = [unit[1] for unit in pred['select'][1]]
-    q_val_units = [unit[1] for unit in gold['select'][1]]
-    return res_map(p_res, p_val_units) == res_map(q_res, q_val_units)
+
+def eval_exec_match(db, p_str, g_str, pred, gold):
+    """
+    return 1 if the values between prediction and gold are matching
+    in the corresponding index. Currently not support multiple col_unit(pairs).
+    """
+    return exec_match_with_budget(db, p_str, g_str, pred, gold)[0]
 
 
 # Rebuild SQL functions for value evaluation
@@ -825,46 +986,6 @@ def rebuild_sql_col(valid_col_units, sql, kmap):
     return sql
 
 
-def build_foreign_key_map(entry):
-    cols_orig = entry["column_names_original"]
-    tables_orig = entry["table_names_original"]
-
-    # rebuild cols corresponding to idmap in Schema
-    cols = []
-    for col_orig in cols_orig:
-        if col_orig[0] >= 0:
-            t = tables_orig[col_orig[0]]
-            c = col_orig[1]
-            cols.append("__" + t.lower() + "." + c.lower() + "__")
-        else:
-            cols.append("__all__")
-
-    def keyset_in_list(k1, k2, k_list):
-        for k_set in k_list:
-            if k1 in k_set or k2 in k_set:
-                return k_set
-        new_k_set = set()
-        k_list.append(new_k_set)
-        return new_k_set
-
-    foreign_key_list = []
-    foreign_keys = entry["foreign_keys"]
-    for fkey in foreign_keys:
-        key1, key2 = fkey
-        key_set = keyset_in_list(key1, key2, foreign_key_list)
-        key_set.add(key1)
-        key_set.add(key2)
-
-    foreign_key_map = {}
-    for key_set in foreign_key_list:
-        sorted_list = sorted(list(key_set))
-        midx = sorted_list[0]
-        for idx in sorted_list:
-            foreign_key_map[cols[idx]] = cols[midx]
-
-    return foreign_key_map
-
-
 def build_foreign_key_map_from_json(table):
     with open(table) as f:
         data = json.load(f)
@@ -881,6 +1002,16 @@ if __name__ == "__main__":
     parser.add_argument('--db', dest='db', type=str)
     parser.add_argument('--table', dest='table', type=str)
     parser.add_argument('--etype', dest='etype', type=str)
+    parser.add_argument('--workers', dest='workers', type=int, default=1,
+                        help='evaluate pairs across this many processes')
+    parser.add_argument('--exec_timeout', dest='exec_timeout', type=float, default=EXEC_TIMEOUT,
+                        help='seconds a predicted query may run before it is aborted')
+    parser.add_argument('--exec_max_rows', dest='exec_max_rows', type=int, default=EXEC_MAX_ROWS,
+                        help='rows a predicted query may return before it is aborted')
+    parser.add_argument('--gold_cache', dest='gold_cache', type=str, default=GOLD_CACHE_PATH,
+                        help="on-disk cache of gold results ('' to disable)")
+    parser.add_argument('--parse_cache', dest='parse_cache', type=str, default=PARSE_CACHE_PATH,
+                        help="on-disk cache of parsed gold SQL ('' to disable)")
     args = parser.parse_args()
 
     gold = args.gold
@@ -891,6 +1022,9 @@ if __name__ == "__main__":
 
     assert etype in ["all", "exec", "match"], "Unknown evaluation method"
 
-    kmaps = build_foreign_key_map_from_json(table)
+    # the schema snapshot holds the kmaps too, so tables.json is only read when it changed
+    kmaps = get_schema_registry(table, db_dir).kmaps
 
-    evaluate(gold, pred, db_dir, etype, kmaps)
+    evaluate(gold, pred, db_dir, etype, kmaps, workers=args.workers, exec_timeout=args.exec_timeout,
+             exec_max_rows=args.exec_max_rows, gold_cache_path=args.gold_cache, parse_cache_path=args.parse_cache,
+             tables_path=args.table)
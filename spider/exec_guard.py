@@ -0,0 +1,110 @@
+################################
+# Execution helpers for eval_exec_match:
+#   - GoldResultCache: gold query results persisted on disk, keyed by (db file, gold SQL)
+#   - execute_with_budget: run a (predicted) query under a wall-time and row budget,
+#     enforced from inside SQLite through a progress handler
+################################
+
+import hashlib
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from urllib.request import pathname2url
+
+# SQLite VM instructions between two budget checks
+PROGRESS_STEPS = 10000
+
+
+class QueryBudgetExceeded(Exception):
+    def __init__(self, reason, elapsed):
+        Exception.__init__(self, "{} after {:.2f}s".format(reason, elapsed))
+        self.reason = reason
+        self.elapsed = elapsed
+
+
+def open_readonly(db):
+    uri = "file:{}?mode=ro".format(pathname2url(os.path.abspath(db)))
+    return sqlite3.connect(uri, uri=True, check_same_thread=False)
+
+
+def execute_with_budget(conn, sql, max_seconds=None, max_rows=None):
+    """
+    Execute `sql` and fetch its rows, raising QueryBudgetExceeded when it runs longer
+    than `max_seconds` or produces more than `max_rows` rows.
+    """
+    start = time.monotonic()
+    timed_out = []
+
+    if max_seconds:
+        deadline = start + max_seconds
+
+        def check_deadline():
+            if time.monotonic() > deadline:
+                timed_out.append(True)
+                return 1  # non-zero aborts the statement with "interrupted"
+            return 0
+
+        conn.set_progress_handler(check_deadline, PROGRESS_STEPS)
+
+    try:
+        cursor = conn.cursor()
+        cursor.execute(sql)
+        rows = []
+        while True:
+            batch = cursor.fetchmany(1000)
+            if not batch:
+                break
+            rows.extend(batch)
+            if max_rows and len(rows) > max_rows:
+                raise QueryBudgetExceeded("more than {} rows".format(max_rows), time.monotonic() - start)
+        return rows
+    except sqlite3.OperationalError:
+        if timed_out:
+            raise QueryBudgetExceeded("time limit of {}s".format(max_seconds), time.monotonic() - start)
+        raise
+    finally:
+        if max_seconds:
+            conn.set_progress_handler(None, PROGRESS_STEPS)
+
+
+class GoldResultCache:
+    """
+    Gold SQL never changes between runs, so its result set is stored once per
+    (db file, mtime, gold SQL) in a small SQLite file shared by all workers.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS gold_results (key TEXT PRIMARY KEY, result BLOB)")
+        self._conn.commit()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(db, g_str):
+        mtime = os.path.getmtime(db) if os.path.exists(db) else 0
+        payload = "{}\x00{}\x00{}".format(os.path.abspath(db), mtime, g_str).encode("utf-8")
+        return hashlib.sha256(payload).hexdigest()
+
+    def get(self, db, g_str):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT result FROM gold_results WHERE key = ?", (self.key(db, g_str),)
+            ).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return pickle.loads(row[0])
+
+    def put(self, db, g_str, result):
+        blob = pickle.dumps(result, protocol=pickle.HIGHEST_PROTOCOL)
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO gold_results VALUES (?, ?)", (self.key(db, g_str), blob)
+            )
+            self._conn.commit()
@@ -0,0 +1,266 @@
+################################
+# Memoized process_sql.get_sql, shared by evaluation.py and sql_validator.py:
+#   - an in-process LRU keyed by (db_id, schema fingerprint, query tokens), so queries
+#     differing only in case, spacing or quote style share one entry (the exact query
+#     text is also remembered, in a second LRU of its own, so repeated strings skip
+#     tokenizing)
+#   - an optional SQLite file keeping parses across runs; `precompute` fills it with
+#     every gold query. Its keys include a digest of process_sql.py, so parses stored
+#     by another version of the parser are never served. Only evaluation configures a
+#     file; everywhere else (e.g. sql_validator when serving) the cache is memory-only
+# Entries are stored pickled and every lookup unpickles a fresh copy: callers may
+# modify the parsed SQL (evaluation's rebuild_* functions do) without touching the
+# cache. Queries get_sql rejects are cached too, and raise the same error again.
+################################
+
+import argparse
+import hashlib
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+try:
+    import process_sql
+    from process_sql import Schema, get_schema, parse_tokens, tokenize
+except ImportError:  # imported from the repository root
+    from spider import process_sql
+    from spider.process_sql import Schema, get_schema, parse_tokens, tokenize
+
+PARSE_CACHE_PATH = "parse_cache.sqlite"
+PARSE_CACHE_SIZE = 4096
+# Bump when the stored entry format changes; parser changes are caught by PARSER_DIGEST
+CACHE_FORMAT_VERSION = 1
+GOLD_FILES = ("dev_gold.sql", "train_gold.sql", "test_gold.sql")
+
+
+def _parser_digest():
+    with open(process_sql.__file__, "rb") as f:
+        return hashlib.sha1(f.read()).hexdigest()[:16]
+
+
+PARSER_DIGEST = _parser_digest()
+
+
+class ParseCache:
+    def __init__(self, path=PARSE_CACHE_PATH, capacity=PARSE_CACHE_SIZE):
+        self.path = path
+        self.capacity = capacity
+        self.pid = os.getpid()
+        self._lock = threading.Lock()
+        self._memory = OrderedDict()
+        # exact query text -> parse; bounded separately so they do not halve `capacity`
+        self._texts = OrderedDict()
+        self._conn = None
+        if path:
+            self._conn = sqlite3.connect(path, timeout=60, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS parses (key TEXT PRIMARY KEY, parsed BLOB)")
+            self._conn.commit()
+        self.counters = {
+            "memory_hits": 0, "text_hits": 0, "disk_hits": 0, "misses": 0, "parse_errors": 0, "evictions": 0,
+        }
+
+    @staticmethod
+    def key(db_id, schema, toks):
+        return "{}\x00{}\x00{}\x00{}\x00{}".format(
+            CACHE_FORMAT_VERSION, PARSER_DIGEST, db_id, schema.fingerprint, "\x00".join(toks))
+
+    @staticmethod
+    def disk_key(key):
+        return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+    def _lookup(self, key, text_key):
+        with self._lock:
+            blob = self._memory.get(key)
+            if blob is not None:
+                self._memory.move_to_end(key)
+                self.counters["memory_hits"] += 1
+            elif self._conn is not None:
+                row = self._conn.execute("SELECT parsed FROM parses WHERE key = ?", (self.disk_key(key),)).fetchone()
+                if row is not None:
+                    blob = row[0]
+                    self.counters["disk_hits"] += 1
+                    self._remember(key, blob)
+            if blob is None:
+                self.counters["misses"] += 1
+            else:
+                self._remember_text(text_key, blob)
+            return blob
+
+    def _remember(self, key, blob):
+        self._memory[key] = blob
+        if len(self._memory) > self.capacity:
+            self._memory.popitem(last=False)
+            self.counters["evictions"] += 1
+
+    def _remember_text(self, text_key, blob):
+        self._texts[text_key] = blob
+        if len(self._texts) > self.capacity:
+            self._texts.popitem(last=False)
+
+    def _store(self, key, text_key, blob, persist):
+        with self._lock:
+            self._remember(key, blob)
+            self._remember_text(text_key, blob)
+            if persist and self._conn is not None:
+                self._conn.execute("INSERT OR REPLACE INTO parses VALUES (?, ?)", (self.disk_key(key), blob))
+                self._conn.commit()
+
+    def get_sql(self, schema, query, db_id="", persist=True):
+        """
+        process_sql.get_sql(schema, query), parsed once per distinct query and schema.
+        `persist` also writes a new parse to disk; use False for one-off queries.
+        """
+        # The exact text is remembered too, so a repeated query is not even tokenized
+        text_key = "{}\x00{}\x00{}".format(db_id, schema.fingerprint, query)
+        with self._lock:
+            blob = self._texts.get(text_key)
+            if blob is not None:
+                self._texts.move_to_end(text_key)
+                self.counters["text_hits"] += 1
+
+        if blob is None:
+            toks = tokenize(query)
+            key = self.key(db_id, schema, toks)
+            blob = self._lookup(key, text_key)
+        if blob is None:
+            try:
+                entry = (True, parse_tokens(schema, toks))
+            except Exception as e:
+                entry = (False, e)
+                with self._lock:
+                    self.counters["parse_errors"] += 1
+            blob = pickle.dumps(entry, protocol=pickle.HIGHEST_PROTOCOL)
+            self._store(key, text_key, blob, persist)
+        parsed, value = pickle.loads(blob)
+        if not parsed:
+            raise value
+        return value
+
+    def disk_entries(self):
+        if self._conn is None:
+            return 0
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM parses").fetchone()[0]
+
+    def stats(self):
+        with self._lock:
+            counters = dict(self.counters)
+            size = len(self._memory)
+            texts = len(self._texts)
+        hits = counters["memory_hits"] + counters["text_hits"] + counters["disk_hits"]
+        lookups = hits + counters["misses"]
+        return {
+            **counters,
+            "hit_rate": hits / lookups if lookups else 0.0,
+            "memory_entries": size,
+            "text_entries": texts,
+            "path": self.path,
+        }
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def configure_parse_cache(path=PARSE_CACHE_PATH, capacity=PARSE_CACHE_SIZE):
+    """Use `path` ('' for memory only) from now on; each process opens its own connection."""
+    global _cache
+    with _cache_lock:
+        if _cache is None or _cache.path != path or _cache.capacity != capacity or _cache.pid != os.getpid():
+            _cache = ParseCache(path, capacity)
+        return _cache
+
+
+def get_parse_cache():
+    """The configured cache; memory-only unless configure_parse_cache named a file."""
+    cache = _cache
+    if cache is None or cache.pid != os.getpid():
+        cache = configure_parse_cache(_cache.path if _cache is not None else "")
+    return cache
+
+
+def get_sql_cached(schema, query, db_id="", persist=True):
+    return get_parse_cache().get_sql(schema, query, db_id, persist)
+
+
+def stats():
+    return get_parse_cache().stats() if _cache is not None else None
+
+
+def read_gold_file(path):
+    """(query, db_id) pairs of a gold SQL file."""
+    with open(path) as f:
+        return [tuple(line.strip().split("\t")) for line in f if line.strip()]
+
+
+def precompute(paths, db_dir, path=PARSE_CACHE_PATH):
+    """Parse every query of the gold files `paths` once and store the parses in `path`."""
+    cache = configure_parse_cache(path)
+    schemas = {}
+    missing_dbs = set()
+    queries = 0
+    errors = 0
+    parse_seconds = 0.0
+    hit_seconds = 0.0
+
+    for gold_path in paths:
+        pairs = read_gold_file(gold_path)
+        for query, db_id in pairs:
+            if db_id not in schemas:
+                db = os.path.join(db_dir, db_id, db_id + ".sqlite")
+                schemas[db_id] = Schema(get_schema(db)) if os.path.exists(db) else None
+            schema = schemas[db_id]
+            if schema is None:
+                missing_dbs.add(db_id)
+                continue
+            t0 = time.perf_counter()
+            try:
+                cache.get_sql(schema, query, db_id)
+            except Exception:
+                errors += 1
+            t1 = time.perf_counter()
+            try:
+                cache.get_sql(schema, query, db_id)
+            except Exception:
+                pass
+            parse_seconds += t1 - t0
+            hit_seconds += time.perf_counter() - t1
+            queries += 1
+        print(" {}: {} queries".format(gold_path, len(pairs)))
+
+    if missing_dbs:
+        print(" Skipped queries of {} databases not found under {}".format(len(missing_dbs), db_dir))
+    print(" {} queries, {} rejected by get_sql, {} entries in {}".format(
+        queries, errors, cache.disk_entries(), path))
+    if queries:
+        # the first lookup parses unless an earlier precompute already stored the query
+        print(" first lookup {:.1f}us/query, cached lookup {:.1f}us/query".format(
+            parse_seconds / queries * 1e6, hit_seconds / queries * 1e6))
+    return cache.stats()
+
+
+if __name__ == "__main__":
+    spider_dir = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(description="On-disk cache of process_sql.get_sql parses.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    precompute_parser = subparsers.add_parser("precompute", help="parse every gold query once")
+    precompute_parser.add_argument("files", nargs="*", default=[os.path.join(spider_dir, name) for name in GOLD_FILES])
+    precompute_parser.add_argument("--db", default=os.path.join(spider_dir, "database"), help="database directory")
+    precompute_parser.add_argument("--path", default=PARSE_CACHE_PATH)
+
+    stats_parser = subparsers.add_parser("stats", help="count the stored parses")
+    stats_parser.add_argument("--path", default=PARSE_CACHE_PATH)
+
+    args = parser.parse_args()
+    if args.command == "precompute":
+        precompute(args.files, args.db, args.path)
+    else:
+        cache = configure_parse_cache(args.path)
+        print(" {} parses in {} ({:.1f} MB)".format(
+            cache.disk_entries(), args.path, os.path.getsize(args.path) / 1e6))
@@ -24,9 +24,14 @@
 # }
 ################################
 
+import argparse
+import hashlib
 import json
+import os
+import re
 import sqlite3
-from nltk import word_tokenize
+import sys
+import time
 
 CLAUSE_KEYWORDS = ('select', 'from', 'where', 'group', 'order', 'limit', 'intersect', 'union', 'except')
 JOIN_KEYWORDS = ('join', 'on', 'as')
@@ -49,9 +54,10 @@ class Schema:
     """
     Simple schema which maps table&column to a unique identifier
     """
-    def __init__(self, schema):
+    def __init__(self, schema, idMap=None):
         self._schema = schema
-        self._idMap = self._map(self._schema)
+        self._idMap = self._map(self._schema) if idMap is None else idMap
+        self._fingerprint = None
 
     @property
     def schema(self):
@@ -61,6 +67,14 @@ class Schema:
     def idMap(self):
         return self._idMap
 
+    @property
+    def fingerprint(self):
+        """Digest of the table and column names, which is all get_sql depends on."""
+        if self._fingerprint is None:
+            names = sorted((table, sorted(cols)) for table, cols in self._schema.items())
+            self._fingerprint = hashlib.sha1(json.dumps(names).encode("utf-8")).hexdigest()
+        return self._fingerprint
+
     def _map(self, schema):
         idMap = {'*': "__all__"}
         id = 1
@@ -113,7 +127,106 @@ def get_schema_from_json(fpath):
     return schema
 
 
+# tokenize() reproduces NLTK word_tokenize on SQL in a single regex pass. Characters
+# word_tokenize always splits off; a period is also split off when only closing
+# brackets follow it, and ',' / ':' when not followed by a digit.
+_SPLIT_CHARS = "!?;@#$%&*()\\[\\]{}<>\u00ab\u00bb\u201c\u201d\u2018\u2019\u201e\u2012-\u2015"
+_PERIOD_CLOSERS = "\\]\\)}>\u00bb\u201d\u2019 "
+_WORD = "(?:[^\\s'\"`.\\-" + _SPLIT_CHARS + "]+|\\.(?!\\.|[" + _PERIOD_CLOSERS + "]*\\s*$)|-(?!-))"
+_SQL_TOKEN = re.compile(
+    "(['\"])([^'\"]*)(['\"])?"  # quoted value (groups 1-3)
+    "|(`+|--|\\.{2,}|\\.(?=[" + _PERIOD_CLOSERS + "]*\\s*$)|[" + _SPLIT_CHARS + "])"  # token on its own
+    "|(" + _WORD + "+)"  # word
+)
+# Text or a quoted value directly after a quoted value joins its token
+_ATTACHED = re.compile("['\"]|" + _WORD)
+_QUOTES = ("'", '"')
+_COMMA_SPLITS = [(re.compile(r"([:,])([^\d])"), r" \1 \2"), (re.compile(r"([:,])$"), r" \1 ")]
+# NLTK's MacIntyre contractions that contain no quote
+_CONTRACTIONS = [
+    re.compile(pattern) for pattern in (
+        r"(?i)\b(can)(not)\b", r"(?i)\b(gim)(me)\b", r"(?i)\b(gon)(na)\b",
+        r"(?i)\b(got)(ta)\b", r"(?i)\b(lem)(me)\b", r"(?i)\b(wan)(na)(?=\s)",
+    )
+]
+_CONTRACTION_WORDS = ("cannot", "gimme", "gonna", "gotta", "lemme", "wanna")
+_EQ_PREFIX = ('!', '>', '<')
+
+
+def _add_token(toks, tok):
+    # join !=, >= and <=
+    if tok == "=" and toks and toks[-1] in _EQ_PREFIX:
+        toks[-1] += "="
+    else:
+        toks.append(tok)
+
+
+def _add_word(toks, text, vals, contractions):
+    if "," in text or ":" in text:
+        for regexp, substitution in _COMMA_SPLITS:
+            text = regexp.sub(substitution, text)
+    if contractions:
+        text = " " + text + " "
+        for regexp in _CONTRACTIONS:
+            text = regexp.sub(r" \1 \2 ", text)
+    for tok in text.lower().split():
+        _add_token(toks, vals.get(tok, tok))
+
+
 def tokenize(string):
+    """
+    Split a SQL string into lowercase tokens; quoted values are kept whole, in double quotes.
+    Gives the tokens of the NLTK-based tokenize_nltk in one pass; see check_tokenize.
+    """
+    string = str(string)
+    lowered = string.lower()
+    contractions = any(word in lowered for word in _CONTRACTION_WORDS)
+    toks = []
+    vals = {}
+    # Quoted values attached to text share one token, with the value spelled as its
+    # placeholder key, as in tokenize_nltk
+    attached = []
+    for match in _SQL_TOKEN.finditer(string):
+        kind = match.lastindex
+        if kind == 4:
+            alone = match.group(4)
+            if len(alone) > 2 and alone[0] == "`":
+                # a run of backticks becomes `` pairs
+                toks.extend(["``"] * (len(alone) // 2) + ["`"] * (len(alone) % 2))
+            else:
+                _add_token(toks, alone)
+            continue
+
+        if kind == 5:
+            piece = match.group(5)
+            end = match.end()
+            joined = string[end:end + 1] in _QUOTES
+        else:
+            assert kind == 3, "Unexpected quote"
+            start, end = match.span()
+            piece = "__val_{}_{}__".format(start, end - 1)
+            vals[piece] = '"' + match.group(2) + '"'
+            joined = _ATTACHED.match(string, end) is not None
+
+        if joined:
+            attached.append(piece)
+        elif attached:
+            attached.append(piece)
+            _add_word(toks, "".join(attached), vals, contractions)
+            attached = []
+        elif kind == 3:
+            toks.append(vals[piece])
+        elif contractions or "," in piece or ":" in piece:
+            _add_word(toks, piece, vals, contractions)
+        else:
+            _add_token(toks, piece.lower())
+    return toks
+
+
+def tokenize_nltk(string, preserve_line=False):
+    """The original NLTK-based tokenizer, kept as the reference for check_tokenize."""
+    from nltk import word_tokenize
+
     string = str(string)
     string = string.replace("\'", "\"")  # ensures all string values wrapped by "" problem??
     quote_idxs = [idx for idx, char in enumerate(string) if char == '"']
@@ -129,7 +242,7 @@ def tokenize(string):
         string = string[:qidx1] + key + string[qidx2+1:]
         vals[key] = val
 
-    toks = [word.lower() for word in word_tokenize(string, language='english')]
+    toks = [word.lower() for word in word_tokenize(string, language='english', preserve_line=preserve_line)]
 
     # replace with string value token
     for i in range(len(toks)):
@@ -549,7 +662,11 @@ def load_data(fpath):
 
 
 def get_sql(schema, query):
-    toks = tokenize(query)
+    return parse_tokens(schema, tokenize(query))
+
+
+def parse_tokens(schema, toks):
+    """get_sql for an already tokenized query."""
     tables_with_alias = get_tables_with_alias(schema.schema, toks)
     _, sql = parse_sql(toks, 0, tables_with_alias, schema)
 
@@ -561,3 +678,68 @@ def skip_semicolon(toks, start_idx):
     while idx < len(toks) and toks[idx] == ";":
         idx += 1
     return idx
+
+
+GOLD_FILES = ("dev_gold.sql", "train_gold.sql", "test_gold.sql")
+
+
+def _tokens_or_error(tokenizer, query, *args):
+    try:
+        return tokenizer(query, *args)
+    except AssertionError as e:
+        return "AssertionError: {}".format(e)
+
+
+def check_tokenize(paths, repeat=3):
+    """
+    Compare tokenize with tokenize_nltk on every query of the gold SQL files `paths`,
+    print the mismatches and the time per query of both; returns the mismatch count.
+    """
+    try:
+        tokenize_nltk("SELECT 1")
+        preserve_line = False
+    except LookupError:
+        # Without punkt there is no sentence splitting; it only matters for '.', '?' or '!'
+        # followed by whitespace outside quoted values
+        print(" NLTK punkt data not installed, comparing with word_tokenize(preserve_line=True)")
+        preserve_line = True
+
+    queries = []
+    for path in paths:
+        with open(path) as f:
+            queries.extend(line.split("\t")[0].strip() for line in f if line.strip())
+
+    mismatches = 0
+    for query in queries:
+        expected = _tokens_or_error(tokenize_nltk, query, preserve_line)
+        actual = _tokens_or_error(tokenize, query)
+        if actual != expected:
+            mismatches += 1
+            print(" Mismatch: {}\n   nltk: {}\n   fast: {}".format(query, expected, actual))
+
+    timings = {}
+    for name, tokenizer, args in (("nltk", tokenize_nltk, (preserve_line,)), ("fast", tokenize, ())):
+        best = None
+        for _ in range(repeat):
+            t0 = time.perf_counter()
+            for query in queries:
+                _tokens_or_error(tokenizer, query, *args)
+            elapsed = time.perf_counter() - t0
+            best = elapsed if best is None else min(best, elapsed)
+        timings[name] = best
+
+    print(" {} queries from {} file(s), {} mismatches".format(len(queries), len(paths), mismatches))
+    for name, elapsed in timings.items():
+        print(" {:5} {:8.2f}us/query".format(name, elapsed / max(len(queries), 1) * 1e6))
+    print(" speedup {:.1f}x".format(timings["nltk"] / timings["fast"]))
+    return mismatches
+
+
+if __name__ == "__main__":
+    spider_dir = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(description="Check tokenize against the NLTK-based tokenizer.")
+    parser.add_argument("files", nargs="*", default=[os.path.join(spider_dir, name) for name in GOLD_FILES],
+                        help="gold SQL files (query<TAB>db_id per line)")
+    parser.add_argument("--repeat", type=int, default=3, help="timing runs per tokenizer (the best is kept)")
+    args = parser.parse_args()
+    sys.exit(1 if check_tokenize(args.files, args.repeat) else 0)
@@ -0,0 +1,293 @@
+################################
+# process_sql Schemas of every database, built from tables.json in one pass instead of
+# opening each sqlite file and running PRAGMA table_info per table:
+#   - SchemaRegistry.build reads tables.json; given a database directory it also
+#     verifies each schema against its sqlite file and keeps the file's version when
+#     they differ, so parsing stays exactly what get_schema would give
+#   - the tables, idMaps and evaluation's foreign-key maps (kmaps) are saved to a
+#     pickle snapshot next to tables.json, which later processes load in milliseconds;
+#     it is rebuilt when tables.json changes, or when a database directory is asked for
+#     and the snapshot was not verified against it
+# Snapshots hold plain dicts only, so they load under either import path of process_sql.
+################################
+
+import argparse
+import json
+import os
+import pickle
+import threading
+import time
+
+try:
+    from process_sql import Schema, get_schema
+except ImportError:  # imported from the repository root
+    from spider.process_sql import Schema, get_schema
+
+SNAPSHOT_VERSION = 3
+
+
+def snapshot_path(tables_path):
+    return os.path.splitext(tables_path)[0] + "_schemas.pickle"
+
+
+def _source_stamp(tables_path, db_dir=None):
+    """tables.json identity plus the database directory the schemas were verified against."""
+    stat = os.stat(tables_path)
+    return os.path.abspath(tables_path), stat.st_size, stat.st_mtime_ns, db_dir and os.path.abspath(db_dir)
+
+
+def _stamp_matches(stamp, tables_path, db_dir):
+    # An unverified snapshot only serves callers that do not name a database directory
+    current = _source_stamp(tables_path, db_dir)
+    return stamp[:3] == current[:3] and (db_dir is None or stamp[3] == current[3])
+
+
+def schema_from_entry(entry):
+    """{table: [columns]} of a tables.json entry, lowercased like get_schema."""
+    schema = {table.lower(): [] for table in entry["table_names_original"]}
+    tables = [table.lower() for table in entry["table_names_original"]]
+    for table_idx, column in entry["column_names_original"]:
+        if table_idx >= 0:
+            schema[tables[table_idx]].append(column.lower())
+    return schema
+
+
+def build_foreign_key_map(entry):
+    """
+    Map every column linked by a foreign key to the representative of its key set, as
+    evaluation's kmaps. A key pair joins the first set already holding either key;
+    sets are never merged, which the scores depend on, so this is not a union-find.
+    """
+    cols_orig = entry["column_names_original"]
+    tables_orig = entry["table_names_original"]
+
+    # rebuild cols corresponding to idmap in Schema
+    cols = []
+    for col_orig in cols_orig:
+        if col_orig[0] >= 0:
+            t = tables_orig[col_orig[0]]
+            c = col_orig[1]
+            cols.append("__" + t.lower() + "." + c.lower() + "__")
+        else:
+            cols.append("__all__")
+
+    foreign_key_list = []
+    # index of the first set holding each key, so a pair finds its set without a scan
+    first_set = {}
+    for key1, key2 in entry["foreign_keys"]:
+        candidates = [first_set[key] for key in (key1, key2) if key in first_set]
+        if candidates:
+            set_idx = min(candidates)
+        else:
+            set_idx = len(foreign_key_list)
+            foreign_key_list.append(set())
+        foreign_key_list[set_idx].update((key1, key2))
+        # set_idx is never past a key's current first set
+        first_set[key1] = first_set[key2] = set_idx
+
+    foreign_key_map = {}
+    for key_set in foreign_key_list:
+        sorted_list = sorted(key_set)
+        midx = sorted_list[0]
+        for idx in sorted_list:
+            foreign_key_map[cols[idx]] = cols[midx]
+
+    return foreign_key_map
+
+
+def schema_differences(expected, actual):
+    """Table and column differences that change parsing; column order does not."""
+    differences = []
+    for table in sorted(set(expected) - set(actual)):
+        differences.append("table {} not in the database".format(table))
+    for table in sorted(set(actual) - set(expected)):
+        differences.append("table {} not in tables.json".format(table))
+    for table in sorted(set(expected) & set(actual)):
+        missing = sorted(set(expected[table]) - set(actual[table]))
+        extra = sorted(set(actual[table]) - set(expected[table]))
+        if missing:
+            differences.append("{}: columns {} not in the database".format(table, ", ".join(missing)))
+        if extra:
+            differences.append("{}: columns {} not in tables.json".format(table, ", ".join(extra)))
+    return differences
+
+
+def _db_file(db_dir, db_id):
+    return os.path.join(db_dir, db_id, db_id + ".sqlite")
+
+
+class SchemaRegistry:
+    def __init__(self, tables, id_maps, kmaps, source=None, verified=0, replaced=()):
+        self.tables = tables
+        self.id_maps = id_maps
+        self.kmaps = kmaps
+        self.source = source
+        self.verified = verified
+        self.replaced = list(replaced)
+        self._schemas = {}
+        self._lock = threading.Lock()
+
+    def __contains__(self, db_id):
+        return db_id in self.tables
+
+    def __len__(self):
+        return len(self.tables)
+
+    def db_ids(self):
+        return sorted(self.tables)
+
+    def schema(self, db_id):
+        """The process_sql.Schema of `db_id`; KeyError when it is not registered."""
+        schema = self._schemas.get(db_id)
+        if schema is None:
+            with self._lock:
+                schema = self._schemas.get(db_id)
+                if schema is None:
+                    schema = Schema(self.tables[db_id], self.id_maps[db_id])
+                    self._schemas[db_id] = schema
+        return schema
+
+    @classmethod
+    def build(cls, tables_path, db_dir=None):
+        """Read tables.json; with `db_dir`, verify against (and defer to) the sqlite files."""
+        with open(tables_path) as f:
+            entries = json.load(f)
+
+        tables = {}
+        kmaps = {}
+        verified = 0
+        replaced = []
+        for entry in entries:
+            db_id = entry["db_id"]
+            # from tables.json as is, like build_foreign_key_map_from_json
+            kmaps[db_id] = build_foreign_key_map(entry)
+            schema = schema_from_entry(entry)
+            db = _db_file(db_dir, db_id) if db_dir else None
+            if db and os.path.exists(db):
+                verified += 1
+                actual = get_schema(db)
+                differences = schema_differences(schema, actual)
+                if differences:
+                    replaced.append((db_id, differences))
+                    schema = actual
+            tables[db_id] = schema
+
+        id_maps = {db_id: Schema(schema).idMap for db_id, schema in tables.items()}
+        return cls(tables, id_maps, kmaps, _source_stamp(tables_path, db_dir), verified, replaced)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "rb") as f:
+            data = pickle.load(f)
+        if data.get("version") != SNAPSHOT_VERSION:
+            raise ValueError("snapshot version {} != {}".format(data.get("version"), SNAPSHOT_VERSION))
+        return cls(
+            data["tables"], data["id_maps"], data["kmaps"], data["source"], data["verified"], data["replaced"]
+        )
+
+    def save(self, path):
+        data = {
+            "version": SNAPSHOT_VERSION,
+            "source": self.source,
+            "verified": self.verified,
+            "replaced": self.replaced,
+            "tables": self.tables,
+            "id_maps": self.id_maps,
+            "kmaps": self.kmaps,
+        }
+        tmp = path + ".tmp"
+        with open(tmp, "wb") as f:
+            pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, path)
+
+    def verify(self, db_dir):
+        """Compare with the sqlite files under `db_dir`: ({db_id: differences}, databases checked)."""
+        mismatches = {}
+        checked = 0
+        for db_id in self.db_ids():
+            db = _db_file(db_dir, db_id)
+            if not os.path.exists(db):
+                continue
+            checked += 1
+            differences = schema_differences(self.tables[db_id], get_schema(db))
+            if differences:
+                mismatches[db_id] = differences
+        return mismatches, checked
+
+
+def load_schema_registry(tables_path, db_dir=None, path=None):
+    """
+    Load the snapshot of `tables_path`, (re)building and saving it when missing, stale,
+    or not verified against `db_dir`.
+    """
+    path = path or snapshot_path(tables_path)
+    if os.path.exists(path):
+        try:
+            registry = SchemaRegistry.load(path)
+            if _stamp_matches(registry.source, tables_path, db_dir):
+                return registry
+        except (OSError, ValueError, KeyError, pickle.UnpicklingError) as e:
+            print(" Rebuilding schema snapshot {}: {}".format(path, e))
+
+    t0 = time.perf_counter()
+    registry = SchemaRegistry.build(tables_path, db_dir)
+    try:
+        registry.save(path)
+    except OSError as e:
+        print(" Could not save schema snapshot {}: {}".format(path, e))
+    print(" Built schemas of {} databases from {} ({} verified, {} taken from sqlite) in {:.2f}s".format(
+        len(registry), tables_path, registry.verified, len(registry.replaced), time.perf_counter() - t0))
+    return registry
+
+
+_registries = {}
+_registries_lock = threading.Lock()
+
+
+def get_schema_registry(tables_path, db_dir=None):
+    """Process-wide registry of `tables_path`, verified against `db_dir` when given."""
+    key = (tables_path, db_dir)
+    registry = _registries.get(key)
+    if registry is None:
+        with _registries_lock:
+            registry = _registries.get(key)
+            if registry is None:
+                registry = load_schema_registry(tables_path, db_dir)
+                _registries[key] = registry
+    return registry
+
+
+if __name__ == "__main__":
+    spider_dir = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(description="Schema snapshot built from tables.json.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    build_parser = subparsers.add_parser("build", help="build and save the snapshot")
+    build_parser.add_argument("--tables", default=os.path.join(spider_dir, "tables.json"))
+    build_parser.add_argument("--db", help="verify against the sqlite files of this database directory")
+
+    verify_parser = subparsers.add_parser("verify", help="compare the snapshot with the sqlite files")
+    verify_parser.add_argument("--tables", default=os.path.join(spider_dir, "tables.json"))
+    verify_parser.add_argument("--db", default=os.path.join(spider_dir, "database"))
+
+    args = parser.parse_args()
+    path = snapshot_path(args.tables)
+    if args.command == "build":
+        t0 = time.perf_counter()
+        registry = SchemaRegistry.build(args.tables, args.db)
+        built = time.perf_counter() - t0
+        registry.save(path)
+        for db_id, differences in registry.replaced:
+            print(" {} (using the sqlite schema): {}".format(db_id, "; ".join(differences)))
+        t0 = time.perf_counter()
+        SchemaRegistry.load(path)
+        print(" {} databases -> {} ({} KB); built in {:.1f}ms, loads in {:.1f}ms".format(
+            len(registry), path, os.path.getsize(path) // 1024, built * 1000, (time.perf_counter() - t0) * 1000))
+    else:
+        registry = load_schema_registry(args.tables, args.db)
+        t0 = time.perf_counter()
+        mismatches, checked = registry.verify(args.db)
+        for db_id, differences in sorted(mismatches.items()):
+            print(" {}: {}".format(db_id, "; ".join(differences)))
+        print(" {} of {} databases checked against {} in {:.2f}s, {} differ".format(
+            checked, len(registry), args.db, time.perf_counter() - t0, len(mismatches)))
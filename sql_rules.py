@@ -0,0 +1,215 @@
+import re
+import threading
+
+from spider.process_sql import tokenize
+
+# Rules of the rewriter prompt (langgraph_workflow._rewriter_prompt) that can be
+# checked on the token stream. Only violated rules justify the rewriter LLM call.
+ALIAS_WITHOUT_JOIN = "alias_without_join"
+COLUMN_RENAME = "column_rename"
+IS_NOT_NULL = "is_not_null"
+IN_SUBQUERY = "in_subquery"
+IN_LIST = "in_list"
+UNPARSED = "unparsed"
+
+CLAUSE_TOKENS = ("select", "from", "where", "group", "order", "having", "limit", "intersect", "union", "except")
+NOT_ALIAS_TOKENS = CLAUSE_TOKENS + ("join", "on", "as", "inner", "left", "right", "outer", "cross", "natural", "using")
+IDENTIFIER = re.compile(r"^[a-z_][a-z0-9_]*$")
+NUMBER = re.compile(r"^-?\d+(\.\d+)?$")
+
+# x IN ('a', "b", 3) outside of NOT IN; literals may not contain quotes or parentheses.
+# The column is never the NOT keyword, so `x NOT IN (...)` does not match at all, and
+# `NOT x IN (...)` matches with the `not` group set and is left alone.
+_LITERAL = r"""(?:'[^'()]*'|"[^"()]*"|-?\d+(?:\.\d+)?)"""
+IN_LIST_PATTERN = re.compile(
+    r"(?P<not>\bnot\s+)?(?P<col>\b(?!not\b)[A-Za-z_][\w.]*)\s+in\s*\(\s*(?P<vals>" + _LITERAL + r"(?:\s*,\s*" + _LITERAL + r")*)\s*\)",
+    re.IGNORECASE,
+)
+LITERAL_PATTERN = re.compile(_LITERAL)
+BOOLEAN_PATTERN = re.compile(r"\b(and|or)\b", re.IGNORECASE)
+
+
+def _is_literal(tok):
+    return tok.startswith('"') or NUMBER.match(tok) is not None
+
+
+def scan(sql):
+    """Tokenize `sql` and return (violated rule names, table aliases)."""
+    try:
+        toks = tokenize(sql)
+    except Exception:
+        return [UNPARSED], {}
+
+    violations = []
+    aliases = {}
+    has_join = False
+    clause = []  # current clause keyword per parenthesis depth
+    current = None
+
+    for i, tok in enumerate(toks):
+        prev = toks[i - 1] if i > 0 else None
+        nxt = toks[i + 1] if i + 1 < len(toks) else None
+
+        if tok == "(":
+            clause.append(current)
+            continue
+        if tok == ")":
+            current = clause.pop() if clause else None
+            continue
+        if tok in CLAUSE_TOKENS:
+            current = tok
+        if tok == "join" or (tok == "," and current == "from"):
+            has_join = True
+
+        if tok == "as" and nxt is not None:
+            if current == "from":
+                aliases[nxt] = prev
+            elif COLUMN_RENAME not in violations:
+                violations.append(COLUMN_RENAME)
+        elif prev in ("from", "join") and IDENTIFIER.match(tok) and nxt is not None:
+            # FROM singer s: a table name directly followed by a bare identifier
+            if IDENTIFIER.match(nxt) and nxt not in NOT_ALIAS_TOKENS:
+                aliases[nxt] = tok
+
+        if tok == "is" and nxt == "not" and i + 2 < len(toks) and toks[i + 2] == "null":
+            if IS_NOT_NULL not in violations:
+                violations.append(IS_NOT_NULL)
+
+        if tok == "in" and nxt == "(" and prev != "not" and i + 2 < len(toks):
+            rule = IN_SUBQUERY if toks[i + 2] == "select" else IN_LIST if _is_literal(toks[i + 2]) else None
+            if rule and rule not in violations:
+                violations.append(rule)
+
+    if aliases and not has_join:
+        violations.append(ALIAS_WITHOUT_JOIN)
+    return violations, aliases
+
+
+def find_violations(sql):
+    return scan(sql)[0]
+
+
+def rewrite_in_lists(sql):
+    """x IN ('a', 'b') -> x = 'a' OR x = 'b', parenthesised when other conditions exist."""
+    def replace(match):
+        if match.group("not"):
+            return match.group(0)
+        values = LITERAL_PATTERN.findall(match.group("vals"))
+        chain = " OR ".join(f"{match.group('col')} = {value}" for value in values)
+        rest = sql[:match.start()] + sql[match.end():]
+        if len(values) > 1 and BOOLEAN_PATTERN.search(rest):
+            chain = f"({chain})"
+        return chain
+
+    return IN_LIST_PATTERN.sub(replace, sql)
+
+
+def remove_single_table_alias(sql, aliases):
+    """Drop the alias of the only table of a join-free, subquery-free query."""
+    if len(aliases) != 1 or len(re.findall(r"\bselect\b", sql, re.IGNORECASE)) != 1:
+        return sql
+    alias, table = next(iter(aliases.items()))
+    pattern = re.escape(alias)
+    sql = re.sub(rf"(\bfrom\s+{re.escape(table)})\s+(?:as\s+)?{pattern}\b", r"\1", sql, flags=re.IGNORECASE)
+    return re.sub(rf"(?<![\w.]){pattern}\.", "", sql, flags=re.IGNORECASE)
+
+
+def apply_local_rewrites(sql, validate=None):
+    """
+    Fix the mechanical violations without a model call.
+    Returns (sql, rules fixed locally, rules still violated). `validate(sql)` returns
+    None for SQL that may run; a rewrite it rejects is dropped and the original SQL
+    kept, leaving its violations to the rewriter.
+    """
+    violations, aliases = scan(sql)
+    fixed = []
+    if IN_LIST in violations or ALIAS_WITHOUT_JOIN in violations:
+        rewritten = sql
+        if IN_LIST in violations:
+            rewritten = rewrite_in_lists(rewritten)
+        if ALIAS_WITHOUT_JOIN in violations:
+            rewritten = remove_single_table_alias(rewritten, aliases)
+        error = validate(rewritten) if validate is not None and rewritten != sql else None
+        if error is not None:
+            print(f" Local rewrite rejected, keeping the original SQL: {error}")
+            _record_rejected()
+        else:
+            sql = rewritten
+            remaining = find_violations(sql)
+            fixed = [rule for rule in violations if rule not in remaining]
+            violations = remaining
+    _record(fixed, violations)
+    return sql, fixed, violations
+
+
+_stats_lock = threading.Lock()
+_checked = 0
+_conforming = 0
+_fixed_locally = 0
+_needs_rewriter = 0
+_rejected_rewrites = 0
+_rule_counts = {}
+
+
+def _record(fixed, remaining):
+    global _checked, _conforming, _fixed_locally, _needs_rewriter
+    with _stats_lock:
+        _checked += 1
+        if remaining:
+            _needs_rewriter += 1
+        elif fixed:
+            _fixed_locally += 1
+        else:
+            _conforming += 1
+        for rule in fixed + remaining:
+            _rule_counts[rule] = _rule_counts.get(rule, 0) + 1
+
+
+def _record_rejected():
+    global _rejected_rewrites
+    with _stats_lock:
+        _rejected_rewrites += 1
+
+
+def stats():
+    with _stats_lock:
+        return {
+            "checked": _checked,
+            "conforming": _conforming,
+            "fixed_locally": _fixed_locally,
+            "needs_rewriter": _needs_rewriter,
+            "rejected_rewrites": _rejected_rewrites,
+            "rules": dict(sorted(_rule_counts.items())),
+        }
+
+
+# (sql, expected rewrite_in_lists output); `python sql_rules.py` checks them
+IN_LIST_CASES = [
+    ("SELECT name FROM singer WHERE country IN ('France', 'USA')",
+     "SELECT name FROM singer WHERE country = 'France' OR country = 'USA'"),
+    ("SELECT name FROM singer WHERE country IN ('France','USA') AND age NOT IN (1,2)",
+     "SELECT name FROM singer WHERE (country = 'France' OR country = 'USA') AND age NOT IN (1,2)"),
+    ("SELECT name FROM singer WHERE age NOT IN (1, 2) AND country IN ('France')",
+     "SELECT name FROM singer WHERE age NOT IN (1, 2) AND country = 'France'"),
+    ("SELECT name FROM singer WHERE NOT country IN ('France', 'USA')",
+     "SELECT name FROM singer WHERE NOT country IN ('France', 'USA')"),
+    ("SELECT name FROM singer WHERE age not in (1, 2)",
+     "SELECT name FROM singer WHERE age not in (1, 2)"),
+]
+
+
+def check_in_lists(cases=IN_LIST_CASES):
+    """Number of cases whose rewrite differs from the expected SQL, printing each one."""
+    failures = 0
+    for sql, expected in cases:
+        actual = rewrite_in_lists(sql)
+        if actual != expected:
+            failures += 1
+            print(f" {sql}\n   expected: {expected}\n   got:      {actual}")
+    print(f" {len(cases) - failures}/{len(cases)} IN list rewrites as expected")
+    return failures
+
+
+if __name__ == "__main__":
+    import sys
+    sys.exit(1 if check_in_lists() else 0)
@@ -0,0 +1,148 @@
+import difflib
+import os
+import sqlite3
+import threading
+
+import db_pool
+from spider.parse_cache import get_sql_cached
+from spider.process_sql import Schema
+from spider.schema_registry import get_schema_registry
+
+# Also compile the statement with SQLite's EXPLAIN (runs nothing). SQLite has the final
+# word; the Spider parser only covers a subset of SQLite, so without EXPLAIN only its
+# unknown table and column errors are reported.
+VALIDATE_WITH_EXPLAIN = True
+TABLES_PATH = os.path.join("spider", "tables.json")
+
+UNKNOWN_TABLE = "unknown_table"
+UNKNOWN_COLUMN = "unknown_column"
+SYNTAX = "syntax"
+SQLITE = "sqlite"
+
+_schemas = {}
+_schemas_lock = threading.Lock()
+_stats_lock = threading.Lock()
+_counters = {"validated": 0, "parsed": 0, "parser_unsupported": 0, "rejected": 0}
+_rejections = {}
+
+
+def _registered_schema(db_id):
+    try:
+        registry = get_schema_registry(TABLES_PATH, db_pool.SPIDER_PATH)
+    except OSError as e:
+        print(f" No schema snapshot: {e}")
+        return None
+    return registry.schema(db_id) if db_id in registry else None
+
+
+def get_parser_schema(db_id, db_path=None):
+    """
+    process_sql.Schema of `db_id`: from the tables.json snapshot, or read once per
+    process from the database itself for databases it does not cover.
+    """
+    if db_path is None:
+        schema = _registered_schema(db_id)
+        if schema is not None:
+            return schema
+    schema = _schemas.get(db_id)
+    if schema is not None:
+        return schema
+    with _schemas_lock:
+        schema = _schemas.get(db_id)
+        if schema is None:
+            conn = db_pool.get_connection(db_id, db_path)
+            tables = [row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type='table'")]
+            schema = Schema({
+                table.lower(): [col[1].lower() for col in conn.execute(f"PRAGMA table_info('{table}')")]
+                for table in tables
+            })
+            _schemas[db_id] = schema
+    return schema
+
+
+def _error(kind, message, identifier=None, suggestions=None):
+    return {"kind": kind, "message": message, "identifier": identifier, "suggestions": suggestions or []}
+
+
+def _close_matches(name, candidates):
+    return difflib.get_close_matches(name, candidates, n=3, cutoff=0.6)
+
+
+def parse_error(schema, sql, db_id=""):
+    """Run the Spider parser; None when it succeeds, else a structured error."""
+    try:
+        get_sql_cached(schema, sql, db_id, persist=False)
+        return None
+    except KeyError as e:
+        missing = str(e.args[0]) if e.args else ""
+        if "." in missing:
+            table, column = missing.split(".", 1)
+            return _error(
+                UNKNOWN_COLUMN, f"no such column: {missing}", missing,
+                _close_matches(column, schema.schema.get(table, [])),
+            )
+        return _error(UNKNOWN_TABLE, f"no such table: {missing}", missing, _close_matches(missing, list(schema.schema)))
+    except AssertionError as e:
+        message = str(e)
+        if message.startswith("Error col: "):
+            column = message[len("Error col: "):]
+            columns = sorted({col for cols in schema.schema.values() for col in cols})
+            return _error(UNKNOWN_COLUMN, f"no such column: {column}", column, _close_matches(column, columns))
+        return _error(SYNTAX, message or "could not parse the query")
+    except Exception as e:
+        return _error(SYNTAX, f"could not parse the query ({type(e).__name__})")
+
+
+def explain_error(db_id, sql, db_path=None):
+    conn = db_pool.get_connection(db_id, db_path)
+    try:
+        conn.execute(f"EXPLAIN {sql}").close()
+        return None
+    except sqlite3.Error as e:
+        return _error(SQLITE, str(e))
+
+
+def validate_sql(db_id, sql, explain=VALIDATE_WITH_EXPLAIN, db_path=None):
+    """
+    Check `sql` against the schema of `db_id` without executing it.
+    Returns None when it may run, else {"kind", "message", "identifier", "suggestions"}.
+    """
+    error = parse_error(get_parser_schema(db_id, db_path), sql, db_id)
+    if error is None:
+        _count("parsed")
+    if explain:
+        sqlite_error = explain_error(db_id, sql, db_path)
+        if sqlite_error is None:
+            if error is not None:
+                # Valid SQLite the Spider parser does not cover (e.g. ORDER BY a select alias)
+                _count("parser_unsupported")
+            error = None
+        elif error is None or error["kind"] == SYNTAX:
+            error = sqlite_error
+    elif error is not None and error["kind"] == SYNTAX:
+        _count("parser_unsupported")
+        error = None
+
+    _count("validated")
+    if error is not None:
+        _count("rejected")
+        with _stats_lock:
+            _rejections[error["kind"]] = _rejections.get(error["kind"], 0) + 1
+    return error
+
+
+def format_error(error):
+    message = error["message"]
+    if error["suggestions"]:
+        message += f" (did you mean: {', '.join(error['suggestions'])}?)"
+    return message
+
+
+def _count(name):
+    with _stats_lock:
+        _counters[name] += 1
+
+
+def stats():
+    with _stats_lock:
+        return {**_counters, "rejections": dict(sorted(_rejections.items())), "schemas": len(_schemas)}
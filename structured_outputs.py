@@ -0,0 +1,25 @@
+from typing import Literal
+
+from pydantic import BaseModel, Field
+
+# Response formats for model_runner.run_gpt4_structured. Every field is required and
+# has no default, as OpenAI's strict JSON-schema mode expects.
+
+
+class FilterHint(BaseModel):
+    """SQL style preferences returned by the question analyzer."""
+    filter_style: Literal["LIKE", "="]
+    range_style: Literal["between", "comparison"]
+    allow_in: bool
+    date_style: Literal["direct"]
+    having_count: str = Field(description='"*" or a column name')
+    allow_join: bool
+    allow_aliases: bool
+    group_by_primary: bool
+    use_count_star: bool
+    use_count_distinct: bool
+
+
+class GeneratedSQL(BaseModel):
+    """One SQLite query answering the question."""
+    sql: str = Field(description="a single SQLite SELECT statement, without markdown or trailing semicolon")
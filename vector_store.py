@@ -1,37 +1,149 @@
-from chromadb import Client
-import chromadb.config
-from sentence_transformers import SentenceTransformer, util
-
-class RAGRetriever:
-    def __init__(self, collection_name="schema_chunks"):
-        self.client = Client(settings=chromadb.config.Settings(allow_reset=True))
-        if collection_name in [col.name for col in self.client.list_collections()]:
-            self.collection = self.client.get_collection(name=collection_name)
-        else:
-            self.collection = self.client.create_collection(name=collection_name)
-
-        self.embedder = SentenceTransformer("all-MiniLM-L6-v2")
-
-    def add_chunks(self, chunks):
-        documents = []
-        metadatas = []
-        ids = []
-
-        for i, chunk in enumerate(chunks):
-            documents.append(chunk)
-            metadatas.append({"chunk_id": i})
-            ids.append(str(i))
-
-        self.collection.add(
-            documents=documents,
-            metadatas=metadatas,
-            ids=ids
+import argparse
+import os
+import threading
+import time
+
+import numpy as np
+from embedding_service import encode, encode_query
+
+SPIDER_PATH = "spider/database"
+SCHEMA_INDEX_DIR = "schema_index"
+
+
+def schema_index_path(db_id, index_dir=SCHEMA_INDEX_DIR):
+    return os.path.join(index_dir, f"{db_id}.npz")
+
+
+def _mtime(path):
+    try:
+        return os.path.getmtime(path)
+    except OSError:
+        return -1.0
+
+
+def source_mtimes():
+    """mtimes of what the chunks are built from: tables.json and descriptions (databases are immutable)."""
+    from schema_catalog import get_catalog
+    catalog = get_catalog()
+    return tuple(_mtime(path) for path in (catalog.tables_path, catalog.descriptions_path))
+
+
+def embed_chunks(chunks):
+    return encode(chunks, batch_size=64, normalize=True)
+
+
+def save_schema_index(db_id, chunks, embeddings, sources, index_dir=SCHEMA_INDEX_DIR):
+    os.makedirs(index_dir, exist_ok=True)
+    path = schema_index_path(db_id, index_dir)
+    # Written beside the index and swapped in, so a concurrent load never sees half a file.
+    # A file object keeps np.savez from appending ".npz" to the temporary name.
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        # float16 halves the file size; cosine ranking is unaffected at this precision.
+        np.savez(
+            f,
+            embeddings=np.asarray(embeddings, dtype=np.float16),
+            chunks=np.array(chunks, dtype=np.str_),
+            sources=np.array(sources, dtype=np.float64),
         )
+    os.replace(tmp_path, path)
+    return path
+
+
+class SchemaIndex:
+    """
+    Read-only, pre-embedded schema chunks of one database.
+    Only the question is embedded at query time. `sources` are the source_mtimes the
+    chunks were built from (None for indexes saved before they were recorded).
+    """
+    def __init__(self, db_id, chunks, embeddings, sources=None):
+        self.db_id = db_id
+        self.sources = tuple(sources) if sources is not None else None
+        self.chunks = list(chunks)
+        self.embeddings = np.asarray(embeddings, dtype=np.float32)
+        self.embeddings.flags.writeable = False
+
+    @classmethod
+    def load(cls, db_id, index_dir=SCHEMA_INDEX_DIR):
+        with np.load(schema_index_path(db_id, index_dir), allow_pickle=False) as data:
+            sources = data["sources"].tolist() if "sources" in data.files else None
+            return cls(db_id, data["chunks"].tolist(), data["embeddings"], sources)
+
+    @classmethod
+    def from_chunks(cls, db_id, chunks, sources=None):
+        return cls(db_id, chunks, embed_chunks(chunks), sources)
 
     def retrieve(self, query, k=3):
-        query_embedding = self.embedder.encode(query).tolist()
-        results = self.collection.query(
-            query_embeddings=[query_embedding],
-            n_results=k
-        )
-        return results["documents"][0]
+        return [chunk for chunk, _ in self.retrieve_scored(query, k)]
+
+    def retrieve_scored(self, query, k=3):
+        """Top `k` chunks as (chunk, cosine similarity) pairs, best first."""
+        if not self.chunks:
+            return []
+        scores = self.embeddings @ encode_query(query)
+        top = np.argsort(-scores, kind="stable")[:k]
+        return [(self.chunks[i], float(scores[i])) for i in top]
+
+
+_indexes = {}  # db_id -> (SchemaIndex, time its sources were last checked)
+_indexes_lock = threading.Lock()
+
+
+def get_schema_index(db_id, db_path=None, index_dir=SCHEMA_INDEX_DIR):
+    """
+    Return the schema index of `db_id`, loaded once per process and rebuilt when
+    tables.json or the descriptions change (checked like the catalog,
+    at most every RECHECK_INTERVAL). A stale prebuilt index is re-embedded and saved;
+    without one, the catalog chunks are embedded in memory.
+    """
+    from schema_catalog import RECHECK_INTERVAL, get_catalog
+    cached = _indexes.get(db_id)
+    if cached is not None and time.monotonic() - cached[1] < RECHECK_INTERVAL:
+        return cached[0]
+
+    with _indexes_lock:
+        db_path = db_path or f"{SPIDER_PATH}/{db_id}/{db_id}.sqlite"
+        sources = source_mtimes()
+        cached = _indexes.get(db_id)
+        index = cached[0] if cached is not None and cached[0].sources == sources else None
+        path = schema_index_path(db_id, index_dir)
+        prebuilt = os.path.exists(path)
+        if index is None and prebuilt:
+            index = SchemaIndex.load(db_id, index_dir)
+            if index.sources != sources:
+                print(f" Schema index {path} is older than its sources, rebuilding it")
+                index = None
+        if index is None:
+            if not prebuilt:
+                print(f" No prebuilt schema index for '{db_id}', embedding chunks in memory")
+            index = SchemaIndex.from_chunks(db_id, get_catalog().get_chunks(db_id, db_path), sources)
+            if prebuilt:
+                save_schema_index(db_id, index.chunks, index.embeddings, sources, index_dir)
+        _indexes[db_id] = (index, time.monotonic())
+    return index
+
+
+def build_schema_indexes(db_ids=None, index_dir=SCHEMA_INDEX_DIR):
+    from schema_catalog import get_catalog
+    catalog = get_catalog()
+    db_ids = db_ids or catalog.db_ids()
+
+    for db_id in db_ids:
+        db_path = f"{SPIDER_PATH}/{db_id}/{db_id}.sqlite"
+        if not os.path.exists(db_path):
+            print(f" Skipping {db_id}: {db_path} not found")
+            continue
+        t0 = time.time()
+        sources = source_mtimes()
+        chunks = catalog.get_chunks(db_id, db_path)
+        path = save_schema_index(db_id, chunks, embed_chunks(chunks), sources, index_dir)
+        print(f" {db_id}: {len(chunks)} chunks -> {path} ({time.time() - t0:.2f}s)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Pre-embed the schema chunks of every Spider database.")
+    parser.add_argument("--db", dest="db_ids", nargs="*", help="only rebuild these databases")
+    parser.add_argument("--out", default=SCHEMA_INDEX_DIR)
+    args = parser.parse_args()
+
+    build_schema_indexes(args.db_ids, args.out)